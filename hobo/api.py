@@ -1,18 +1,41 @@
 from __future__ import print_function
 import os
 import sys
+import json
 import time
+import hashlib
 import signal
-import itertools
+import threading
 import subprocess
 
+from six.moves import queue
+
 from commandsession import CommandError, CommandSession, ParamDict
 
-from hobo.util import is_rh_family, Timeout, timeout, tempname, Config
-from hobo.net import mac_in_arp_cache, populate_arp_cache, get_hostname
-from hobo.libvirt import Libvirt, Libguestfs
+from hobo.util import is_rh_family, Timeout, timeout, tempname, LazyConfig
+from hobo.util import NoLimit, expand_names, mkdir_all, print_table
+from hobo.util import Db, file_lock, allocated_size, sparse_copy, human_size
+from hobo.util import FileReaper
+from hobo.net import get_hostname
+from hobo.libvirt import Libvirt, Libguestfs, DomainError
+from hobo.inventory import render_info, jsonl_line, InventoryCache
+
+# read on first use, see LazyConfig
+config = LazyConfig()
+
+
+class _ConfigAttr(object):
+    """Class attribute read through from `config`, which instances and
+    subclasses can still replace."""
+    def __init__(self, name):
+        self.name = name
 
-config = Config()
+    def __get__(self, obj, cls):
+        return getattr(config, self.name)
+
+
+# seconds a customization layer is protected from eviction after use
+LAYER_GRACE = 3600
 
 class Hobo(object):
     """
@@ -22,23 +45,38 @@ class Hobo(object):
         - add vms to known_hosts
         - inject environment vars to debug libguestf (commandsession) 
     """
-    images_dir = config.images_dir
-    template_file = config.template_file
-    db = config.db
+    images_dir = _ConfigAttr('images_dir')
+    template_file = _ConfigAttr('template_file')
+    # replaced with a fresh connection in build workers
+    db = _ConfigAttr('db')
+
+    # limits on concurrent guestfs appliances and disk-heavy steps;
+    # only bounded inside a `_build_many` worker
+    appliance_slots = NoLimit()
+    io_slots = NoLimit()
 
-    def __init__(self, session=None):
+    def __init__(self, session=None, check_templates=True):
         self.session = session or CommandSession()
         self.libvirt = Libvirt(
             config.bridge_device,
             images_dir=self.images_dir,
-            session=self.session
+            session=self.session,
+            resolvers=config.resolvers,
+            resolver_ttl=config.resolver_ttl,
+            virsh=config.virsh_backend,
+            uri=config.libvirt_uri,
+            backend=config.libvirt_backend,
+            events=config.libvirt_events,
         )
         self.libgf = Libguestfs(
             template_file=self.template_file,
             libvirt=self.libvirt,
+            cache_dir=config.cache_dir,
+            catalog_ttl=config.catalog_ttl,
         )
 
-        self._check_template_file()
+        # validated on first use by a command that reads or writes templates
+        self.check_templates = check_templates
 
     def base(self, image_name, image_desc, base_os, upload=None, install=None, run=None, size=None, compress=True):
         """Generate a base os image built upon another base image.
@@ -47,6 +85,7 @@ class Hobo(object):
         if image_desc is None:
             image_desc = image_name
 
+        self._check_template_file()
         if self.libgf.template_available(image_name):
             raise ValueError('Template for base image {} exists.'.format(image_name))
 
@@ -97,27 +136,15 @@ class Hobo(object):
 
             try:
 
-                print('Creating sparse image')
-                self.libgf.virt_sparsify(self.libvirt.disk_path(image_name))
-
                 image_path = self.libvirt.disk_path(image_name)
-                print('Running sysprep')
-                self.libgf.virt_sysprep_img(
-                    ['udev-persistent-net'], image_name
-                )
+                print('Running sysprep and creating sparse image')
+                self.libgf.finalize(image_path, ['udev-persistent-net'])
 
                 image_sz = os.stat(os.path.join(image_path)).st_size
                 ## compress the image?
                 compressed_size = None
                 if compress:
-                    print('Compressing using {}'.format(config.compress_flags))
-                    print('Warning: this can take a long time.')
-                    _stream = self.session._stream
-                    self.session._stream = True
-                    self.session.call("xz {} {}".format(config.compress_flags, image_path))
-                    self.session._stream = _stream
-                    image_path = self.libvirt.disk_path(image_name) + '.xz'
-                    compressed_size = os.stat(os.path.join(image_path)).st_size
+                    image_path, compressed_size = self._compress(image_name, image_path)
 
                 # manually remove this template from the cache, it is flaky 
                 self.libgf.delete_cache(image_name)
@@ -150,8 +177,84 @@ class Hobo(object):
             return True
 
 
-    def build(self, base_os, name, hostname=None, size=None, ram=None, cpus=None, tags=None):
+    def build(self, base_os, name, hostname=None, size=None, ram=None, cpus=None, tags=None, linked=False):
+        """clone a base image, or several.
+        :param name: domain name, or a list of names to build concurrently
+        """
+        self._check_template_file()
+        names = expand_names(name if isinstance(name, list) else [name])
+        if len(names) > 1:
+            if hostname:
+                raise ValueError('--hostname cannot be used with multiple names')
+            return self._build_many(
+                base_os, names, size=size, ram=ram, cpus=cpus, tags=tags,
+                linked=linked
+            )
+
+        record = self._build(
+            base_os, names[0], hostname=hostname, size=size, ram=ram,
+            cpus=cpus, tags=tags, linked=linked
+        )
+        self.db.write('domains', names[0], record)
+        self._domains_changed()
+        return True
+
+    def _build_many(self, base_os, names, **kwargs):
+        """Build several domains in a process pool.
+        guestfs appliance launches and disk-heavy steps are limited
+        separately, see `Config.appliance_slots` and `Config.io_slots`.
+        A failed build does not stop the others.
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # managed semaphores can be passed with each task, which the py2
+        # futures backport allows, having no pool initializer
+        manager = multiprocessing.Manager()
+        slots = (
+            manager.BoundedSemaphore(config.appliance_slots),
+            manager.BoundedSemaphore(config.io_slots),
+        )
+        mkdir_all(config.log_dir)
+
+        results = []
+        try:
+            with ProcessPoolExecutor(
+                max_workers=min(config.build_workers, len(names))
+            ) as pool:
+                futures = []
+                for name in names:
+                    log_path = os.path.join(config.log_dir, 'build-{}.log'.format(name))
+                    futures.append((name, log_path, pool.submit(
+                        _build_worker, base_os, name, log_path, kwargs, slots
+                    )))
+                for name, log_path, future in futures:
+                    try:
+                        results.append(future.result())
+                    except Exception as ex:
+                        # the worker died, e.g. BrokenProcessPool
+                        results.append({
+                            'name': name, 'log': log_path, 'record': None,
+                            'status': 'failed', 'seconds': None,
+                            'error': str(ex).splitlines()[0] if str(ex) else repr(ex),
+                        })
+        finally:
+            # record every domain that was built, whatever became of the rest
+            with self.db.transaction():
+                for result in results:
+                    if result['record']:
+                        self.db.write('domains', result['name'], result['record'])
+            self._domains_changed()
+            manager.shutdown()
+
+        print_table(results, ['name', 'status', 'seconds', 'log', 'error'])
+        return all(result['status'] == 'ok' for result in results)
+
+    def _build(self, base_os, name, hostname=None, size=None, ram=None, cpus=None, tags=None, linked=False,
+               timeline=None):
         """clone a base image
+        With `linked`, the domain disk is a thin qcow2 overlay on a shared,
+        read-only copy of the base template, see `Libguestfs.materialize_base`.
         TODO: the image for this clone should not go into the images dir, it should
         instead go into the current dirextory, or somewhere else.
         TODO: if size is not provided, get size somehow to store in db
@@ -159,8 +262,14 @@ class Hobo(object):
         TODO: need to add a github privkey to the root account in v
 
         note - resize will fail if size given is less than current size.  issue?
+
+        `timeline`, if given, is marked 'imaged' once the disk is ready and
+        'defined' once virt-install is done, see `hobo.bench.BootTimeline`.
         """
 
+        if linked and size:
+            raise ValueError('--size is not supported for linked clones')
+
         params = ParamDict()
         
         #params['root_password'] = 'password:.hobo'
@@ -190,20 +299,56 @@ class Hobo(object):
         cpus = cpus or config.base_cpu
         hostname = hostname or '{}.local'.format(name)
 
+        disk = self.libvirt.disk_path(name)
+        layered = config.layer_cache_size > 0 and not size
+        backing = None
+        layer = None
+
         print('Importing image for {}'.format(name))
-        self.libgf.virt_build(
-            name,
-            base_os,
-            'selinux-relabel',
-            hostname=hostname,
-            **params
-        )
+        if layered:
+            # everything but the hostname comes from a cached layer
+            layer = self._customization_layer(base_os, params, pubkey)
+            with self.io_slots:
+                if linked:
+                    backing = layer
+                    self.libgf.create_overlay(disk, layer)
+                else:
+                    self.libgf.convert(layer, disk)
+        elif linked:
+            backing = self._base_image(base_os)
+            with self.io_slots:
+                self.libgf.create_overlay(disk, backing)
+        else:
+            with self.appliance_slots:
+                self.libgf.virt_build(
+                    name,
+                    base_os,
+                    'selinux-relabel',
+                    hostname=hostname,
+                    **params
+                )
         
         try:
+            if layered:
+                print('Setting hostname')
+                with self.appliance_slots:
+                    self.libgf.virt_customize(disk, hostname=hostname)
+            elif linked:
+                print('Customizing overlay')
+                with self.appliance_slots:
+                    self.libgf.virt_customize(
+                        disk,
+                        'selinux-relabel',
+                        hostname=hostname,
+                        **params
+                    )
+
             if size:
                 print('Creating sparse image')
-                self.libgf.virt_sparsify(self.libvirt.disk_path(name))
+                with self.appliance_slots:
+                    self.libgf.virt_sparsify(self.libvirt.disk_path(name))
 
+            if timeline: timeline.mark('imaged')
             print('Creating domain')
             self.libgf.virt_import(
                 name,
@@ -218,39 +363,168 @@ class Hobo(object):
             except ValueError:
                 print('domain was not created!')
                 raise
+            if timeline: timeline.mark('defined')
 
         except (Exception, KeyboardInterrupt):
-            self.libvirt.delete_disk(name)
+            with self.io_slots:
+                self.libvirt.delete_disk(name)
             raise
 
-        else:
-            if tags and not isinstance(tags, list):
-                tags = [tags]
-            elif not tags:
-                tags = []
+        if tags and not isinstance(tags, list):
+            tags = [tags]
+        elif not tags:
+            tags = []
+
+        return {
+            'user': 'root', 
+            'hostname': hostname,
+            'disk_size': size, 
+            'bridge_iface': bridge, 
+            'memory': ram, 
+            'cpus': cpus, 
+            'tags': tags,
+            'backing': backing,
+            'layer': layer,
+        }
+
+    def _customization_layer(self, base_os, params, pubkey):
+        """Get `base_os` with `params` applied, as a cached read-only image.
+        Layers are keyed by a hash of the base image, the params and the
+        pubkey, and are only built on a miss. Least recently used layers
+        are evicted once the cache exceeds `Config.layer_cache_size`.
+        :returns: path of the layer image
+        """
+        base = self._base_image(base_os)
+        digest = _layer_digest(base, ['selinux-relabel'], params, pubkey)
+        path = self.libgf.layer_path(digest)
+        mkdir_all(os.path.dirname(path))
+
+        with file_lock(path + '.lock'):
+            if os.path.exists(path):
+                print('Using cached layer {}'.format(digest[:12]))
+            else:
+                print('Customizing layer {}'.format(digest[:12]))
+                partial = path + '.partial'
+                if os.path.exists(partial):
+                    os.remove(partial)
+                try:
+                    with self.io_slots:
+                        self.libgf.create_overlay(partial, base)
+                    with self.appliance_slots:
+                        self.libgf.virt_customize(
+                            partial, 'selinux-relabel', **params
+                        )
+                except (Exception, KeyboardInterrupt):
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                    raise
+                os.chmod(partial, 0o444)
+                os.rename(partial, path)
+
+            record = self.db.read('layers', digest) or {
+                'base_os': base_os, 'base': base, 'path': path, 'created': time.time()
+            }
+            record['atime'] = time.time()
+            self.db.write('layers', digest, record)
+
+        self._evict_layers(keep=digest)
+        return path
+
+    def _base_image(self, base_os):
+        """The current backing image of a base template, written out if
+        need be; anything built from older versions of it is retired.
+        :returns: path of the backing image
+        """
+        with self.appliance_slots:
+            base = self.libgf.materialize_base(base_os)
+        self._retire_bases(base_os, base)
+        return base
+
+    def _retire_bases(self, base_os, current):
+        """Delete the layers and backing images made from earlier versions
+        of a base template, except those a domain is still built on.
+        """
+        domains = self.db.read('domains') or {}
+        in_use = set(record.get('backing') for record in domains.values())
 
-            self.db.write(
-                'domains', 
-                name,
-                {
-                    'user': 'root', 
-                    'hostname': hostname,
-                    'disk_size': size, 
-                    'bridge_iface': bridge, 
-                    'memory': ram, 
-                    'cpus': cpus, 
-                    'tags': tags
-                }
-            )
+        for digest, record in (self.db.read('layers') or {}).items():
+            if record.get('base_os') != base_os or record.get('base') == current:
+                continue
+            if record['path'] in in_use:
+                # a linked clone sits on this layer, and so on its base
+                in_use.add(record.get('base'))
+                continue
+            print('Evicting stale layer {}'.format(digest[:12]))
+            with file_lock(record['path'] + '.lock'):
+                if os.path.exists(record['path']):
+                    os.remove(record['path'])
+            self.db.delete('layers', digest)
+
+        for path in self.libgf.base_paths(base_os):
+            if path == current or path in in_use:
+                continue
+            print('Removing stale base image {}'.format(path))
+            with file_lock(path + '.lock'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _evict_layers(self, keep=None):
+        """Delete least recently used layers until the cache fits its budget.
+        Layers backing a domain, or used within `LAYER_GRACE` seconds
+        (their builds may still be in flight), are kept.
+        """
+        layers = self.db.read('layers') or {}
+        domains = self.db.read('domains') or {}
+        in_use = set(record.get('backing') for record in domains.values())
 
-        return True
+        sizes = {}
+        for digest, record in layers.items():
+            try:
+                sizes[digest] = allocated_size(record['path'])
+            except OSError:
+                # the file is already gone
+                self.db.delete('layers', digest)
+        total = sum(sizes.values())
+
+        now = time.time()
+        for digest in sorted(sizes, key=lambda d: layers[d]['atime']):
+            if total <= config.layer_cache_size:
+                break
+            record = layers[digest]
+            if digest == keep or record['path'] in in_use \
+                    or now - record['atime'] < LAYER_GRACE:
+                continue
+            print('Evicting layer {}'.format(digest[:12]))
+            with file_lock(record['path'] + '.lock'):
+                os.remove(record['path'])
+            self.db.delete('layers', digest)
+            total -= sizes[digest]
+
+
+    def flatten(self, domain):
+        """Detach a linked clone from its backing image."""
+        record = self.db.read('domains', domain)
+        assert record is not None, 'unknown domain {}'.format(domain)
+        if not record.get('backing'):
+            print('{} is not a linked clone'.format(domain))
+            return True
 
+        if not self.libvirt.get_domain(domain).stopped:
+            print('Error: cannot flatten a domain that is running')
+            return False
+
+        print('Flattening {}'.format(domain))
+        self.libgf.flatten(domain)
+        record['backing'] = None
+        self.db.write('domains', domain, record)
+        return True
 
     def package(self, domain_name, image_name, image_desc, install=False, compress=True):
         """Grab a domain's disk and package it.
         #TODO: this disk abstraxtion needs a fixup.
         """
 
+        self._check_template_file()
         if self.libgf.template_available(image_name):
             raise ValueError('Template for base image {} exists.'.format(image_name))
 
@@ -264,17 +538,23 @@ class Hobo(object):
             return False
 
         dest = self.libvirt.disk_path(image_name)
+        record = self.db.read('domains', domain_name) or {}
 
-        print('Copying disk')
-        self.session.check_call([
-            'cp', '--preserve=all',
-            self.libvirt.disk_path(domain_name),
-            dest
-        ])
+        if record.get('backing'):
+            # a linked clone's overlay names its base by a local path, so
+            # the package gets the whole chain written out as one image
+            print('Flattening disk')
+            self.libgf.convert(self.libvirt.disk_path(domain_name), dest)
+        else:
+            print('Copying disk')
+            copied = sparse_copy(self.libvirt.disk_path(domain_name), dest)
+            print('Copied using {}, {} moved'.format(
+                copied.method, human_size(copied.bytes_moved)
+            ))
 
         try:
             print('Creating sparse image')
-            self.libgf.virt_sparsify(dest)
+            self.libgf.finalize(dest)
 
             print('Running sysprep')
             sysprep_ops = [
@@ -296,14 +576,7 @@ class Hobo(object):
             image_sz = os.stat(os.path.join(image_path)).st_size
             compressed_size = None
             if compress:
-                print('Compressing using {}'.format(config.compress_flags))
-                print('Warning: this can take a long time.')
-                _stream = self.session._stream
-                self.session._stream = True
-                self.session.call("xz {} {}".format(config.compress_flags, image_path))
-                self.session._stream = _stream
-                image_path = self.libvirt.disk_path(image_name) + '.xz'
-                compressed_size = os.stat(os.path.join(image_path)).st_size
+                image_path, compressed_size = self._compress(image_name, image_path)
 
             # manually remove this template from the cache, it is flaky 
             self.libgf.delete_cache(image_name)
@@ -343,105 +616,298 @@ class Hobo(object):
         return True
 
 
-    def info(self, domain=None, format=None):
+    def _compress(self, image_name, image_path):
+        """Compress a finished image in place of the original.
+        With `compress_target` configured, the codec and level are chosen
+        by sampling the image; the decision, its estimate and the actual
+        result are kept in the db 'templates' section.
+        :returns: (path of the compressed image, its size), or
+            (image_path, None) when compression is disabled
+        """
+        from hobo.compress import get_codec, parse_xz_flags, choose as choose_compression
+
+        level, block_size = parse_xz_flags(config.compress_flags)
+        decision = None
+        if config.compress_target:
+            print('Sampling image to choose compression settings')
+            decision = choose_compression(
+                image_path, config.compress_target, block_size=block_size
+            )
+            codec = get_codec(
+                decision['codec'], decision['level'], block_size=block_size
+            )
+        else:
+            codec = get_codec(
+                config.compress_codec,
+                level if config.compress_codec == 'xz' else None,
+                block_size=block_size
+            )
+        if not codec.virt_builder_compatible:
+            raise ValueError(
+                'virt-builder cannot read {} compressed images'.format(codec.name)
+            )
+        if not codec.suffix:
+            self._record_compression(image_name, decision, None)
+            return image_path, None
+
+        print('Compressing using {} -{}'.format(codec.name, codec.level))
+        print('Warning: this can take a long time.')
+        compressed_path = image_path + codec.suffix
+        try:
+            result = codec.compress(image_path, compressed_path)
+        except (Exception, KeyboardInterrupt):
+            if os.path.exists(compressed_path):
+                os.remove(compressed_path)
+            raise
+        os.remove(image_path)
+        print(result)
+        self._record_compression(image_name, decision, result)
+        return compressed_path, result.out_bytes
+
+    def _record_compression(self, image_name, decision, result):
+        """Keep how a template was compressed, and how well the
+        estimate held up, with the template's metadata.
+        """
+        record = self.db.read('templates', image_name) or {}
+        record['compression'] = {
+            'decision': decision,
+            'actual': result.as_dict() if result else None,
+        }
+        self.db.write('templates', image_name, record)
+
+    def info(self, domain=None, format=None, timeout=None):
         """Print some info about a domain"""
-        if not self.db.read('domains'):
+        if format == 'jsonl':
+            # print each domain as soon as it is resolved
+            printed = False
+            for name, record in self.iter_info_records(domain, timeout=timeout):
+                print(jsonl_line(name, record))
+                sys.stdout.flush()
+                printed = True
+            return printed
+
+        records = self.info_records(domain, timeout=timeout)
+        if records is None:
             return False
 
+        render_info(records, format)
+        return True
+
+    def info_records(self, domain=None, timeout=None):
+        """Gather what `info` prints: each domain's db record, plus its
+        current mac, ip and state.
+        :param timeout: if given, resolve ips under this deadline the way
+            `iter_info_records` does, marking the rest 'timed_out'
+        :returns: dict of domain name to record, or None if there are
+            no domains
+        """
+        if timeout is not None:
+            return dict(self.iter_info_records(domain, timeout=timeout)) or None
+
+        targets = self._info_targets(domain)
+        if targets is None:
+            return None
+        db_records, domain_objs = targets
+
+        # resolve the ips of every running domain in one pass
+        ips = self.libvirt.resolve_ips([d for d in domain_objs if d.running])
+        return dict(
+            (d.name, self._info_record(db_records[d.name], d, ips.get(d.name)))
+            for d in domain_objs
+        )
+
+    def iter_info_records(self, domain=None, workers=None, timeout=None):
+        """Like `info_records`, but yield (name, record) pairs as they
+        are ready. Stopped domains come first; running ones are resolved
+        on a pool of `workers` threads, under one deadline `timeout`
+        seconds from now. Once it passes, every domain not yet resolved,
+        queued or in progress, is yielded with 'timed_out' set instead
+        of waited for.
+        """
+        targets = self._info_targets(domain)
+        if targets is None:
+            return
+        db_records, domain_objs = targets
+        workers = workers or config.info_workers
+        timeout = config.info_timeout if timeout is None else timeout
+
+        running = []
+        for domain_obj in domain_objs:
+            if domain_obj.running:
+                running.append(domain_obj)
+            else:
+                yield domain_obj.name, self._info_record(
+                    db_records[domain_obj.name], domain_obj, None
+                )
+
+        # daemon threads rather than an executor, so a resolver stuck
+        # past the deadline cannot hold up exit
+        deadline = time.time() + timeout
+        todo = queue.Queue()
+        done = queue.Queue()
+        for domain_obj in running:
+            todo.put(domain_obj)
+
+        def work():
+            while time.time() < deadline:
+                try:
+                    domain_obj = todo.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    ip = self.libvirt.resolve_ips([domain_obj])[domain_obj.name]
+                except Exception:
+                    ip = None
+                done.put((domain_obj, ip))
+
+        for i in range(min(workers, len(running))):
+            thread = threading.Thread(target=work, name='hobo-info-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+        pending = dict((d.name, d) for d in running)
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                domain_obj, ip = done.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.pop(domain_obj.name)
+            yield domain_obj.name, self._info_record(
+                db_records[domain_obj.name], domain_obj, ip
+            )
+
+        for domain_obj in running:
+            if domain_obj.name in pending:
+                record = self._info_record(db_records[domain_obj.name], domain_obj, None)
+                record['timed_out'] = True
+                yield domain_obj.name, record
+
+    def _info_targets(self, domain=None):
+        """:returns: (db records, list of `Domain`), or None if there
+            are no domains
+        """
+        db_records = self.db.read('domains')
+        if not db_records:
+            return None
+
         if domain:
-            assert domain in self.db.read('domains').keys()
+            assert domain in db_records
             domains = [domain]
         else:
-            domains = self.db.read('domains').keys()
+            domains = db_records.keys()
 
-        records = {}
+        # one fresh snapshot serves every domain below
+        self.libvirt.refresh()
+        domain_objs = []
         for item in domains:
             try:
-                domain_obj = self.libvirt.get_domain(item)
-            except CommandError:
+                domain_objs.append(self.libvirt.get_domain(item))
+            except ValueError:
                 #FIXME - the database is out of sync with what exists in system
                 continue
-            state = domain_obj.state
-            if not domain_obj.ip_address and state=='running':
-                state = 'booting'
-
-            info = self.db.read('domains', item)
-            info.update({
-                'mac': domain_obj.mac_address, 
-                'ip': domain_obj.ip_address if state=='running' else '',  # if not running, it may not still have cached ip 
-                'state': state
-            })
-            records[item] = info
-
-        if not format:
-            for k, v in records.items():
-                print('{}: {}'.format(k, v))
-
-        elif format == 'ansible':
-            # generate a hosts file
-            #MAYBE use inventory script
-            def ansible_host(record):
-                args = [record['hostname']]
-                if record['user']: args.append('ansible_ssh_user={}'.format(record['user']))
-                if record['ip']: args.append('ansible_ssh_host={}'.format(record['ip']))
-                return ' '.join(args)
-
-            running = [d for d in records.keys() if records[d]['state'] == 'running']
-            for dom in running:
-                rec = records[dom]
-                print(ansible_host(rec))
-
-            if len(running): print()
-
-            tags = list(set(itertools.chain(*[t['tags'] for t in records.values()])))
-            for tag in tags:
-                matches = [k for k in records.keys() if tag in records[k]['tags'] and k in running]
-                if len(matches):
-                    print('[{}]'.format(tag))
-                for dom in matches:
-                    print(ansible_host(records[dom]))
-                if len(matches):
-                    print()
+        return db_records, domain_objs
+
+    def _info_record(self, info, domain_obj, ip):
+        state = domain_obj.state
+        # if not running, it may not still have cached ip
+        if state != 'running':
+            ip = None
+        elif not ip:
+            state = 'booting'
+
+        info.update({
+            'mac': domain_obj.mac_address,
+            'ip': ip or '',
+            'state': state
+        })
+        return info
+
+    def wait(self, domains, port=22, timeout=None):
+        """Wait until every listed domain accepts ssh.
+        :returns: True if all of them did within `timeout`
+        """
+        names = expand_names(domains)
+        timeout = config.ready_timeout if timeout is None else timeout
+        domain_objs = []
+        for name in names:
+            try:
+                domain_objs.append(self.libvirt.get_domain(name))
+            except ValueError:
+                print('no such domain {}'.format(name))
+                return False
+        try:
+            results = self.libvirt.wait_ready(domain_objs, port, timeout)
+        except RuntimeError as ex:
+            print(ex)
+            return False
 
-        return True
+        print_table(
+            [{'name': name, 'ready': results[name] is not None, 'seconds': results[name]}
+             for name in names],
+            ['name', 'ready', 'seconds']
+        )
+        return all(results[name] is not None for name in names)
 
-    def destroy(self, domain=None):
+    def destroy(self, domain=None, timeout=None):
         """Remove a domain fro the system completely.
+        Every domain is asked to shut down at once and given `timeout`
+        seconds, together, before being forced off. Each is undefined as
+        soon as it is off, and its disk removed in the background.
         :returns: False if all calls have failed, else True
         """
-        if not self.db.read('domains'):
+        known = self.db.keys('domains')
+        if not known:
             print('No domains exist')
             return False
 
         if domain:
-            assert domain in self.db.read('domains').keys()
+            assert domain in known
             domains = [domain]
         else:
-            domains = self.db.read('domains').keys()
-        
-        for domain in domains:
+            domains = known
+        timeout = config.shutdown_timeout if timeout is None else timeout
+
+        reaper = FileReaper()
+        def stopped(domain):
             try:
-                self.session.call(
-                    'virsh shutdown {}'.format(domain)
-                )
-                self.session.call(
-                    'virsh destroy {}'.format(domain)
-                )
-                self.session.call(
-                    'virsh undefine {}'.format(domain)
-                )
-                #FIXME
-                self.session.call('rm -f /home/mike/hobo/images/{}.qcow2'.format(domain))
-            except CommandError: pass
-            finally:
-                self.db.delete('domains', domain)
+                self.libvirt.backend.undefine(domain)
+            except DomainError: pass
+            reaper.put(self.libvirt.disk_path(domain))
 
+        try:
+            forced = self.libvirt.shutdown_many(domains, timeout, on_stopped=stopped)
+        finally:
+            with self.db.transaction():
+                for domain in domains:
+                    self.db.delete('domains', domain)
+            failed = reaper.join()
+            self._domains_changed()
+
+        if forced:
+            print('{} did not shut down within {}s, forced off.'.format(forced, timeout))
+        for path, ex in failed:
+            print('could not remove {}: {}'.format(path, ex))
         print('{} deleted.'.format(domains))
 
         return True
 
+    def _domains_changed(self):
+        """Drop what is cached about the set of domains: the inventory
+        cache, and hobod's records if it is running.
+        """
+        from hobo.daemon import query
+        InventoryCache(config.inventory_cache).invalidate()
+        query(config.daemon_socket, {'op': 'invalidate'}, timeout=0.5)
+
     def _check_template_file(self):
         """Verify that template file is present, configured, and is well-formed."""
+        if not self.check_templates:
+            return
+        self.check_templates = False
+
         #TODO: this is an install task, belongs in Makefile
         if not os.path.exists('/etc/virt-builder/repos.d/hobo.conf'):
             with open('/etc/virt-builder/repos.d/hobo.conf', 'w') as fh:
@@ -457,3 +923,49 @@ class Hobo(object):
         if not self.libgf.check_template_file():
             raise RuntimeError('Base template file {}'.format(self.template_file))
 
+
+
+def _layer_digest(base, flags, params, pubkey):
+    """Hash everything that goes into a customization layer."""
+    st = os.stat(base)
+    with open(pubkey, 'rb') as fh:
+        key = fh.read()
+    canonical = json.dumps({
+        'base': [base, st.st_size, int(st.st_mtime)],
+        'flags': list(flags),
+        'params': [[k, str(v)] for k, v in params.items(multi=True)],
+    }, sort_keys=True)
+    digest = hashlib.sha256(canonical.encode('utf-8'))
+    digest.update(key)
+    return digest.hexdigest()
+
+
+def _build_worker(base_os, name, log_path, kwargs, slots):
+    """Build one domain in a pool worker, with its own CommandSession.
+    The session log is written to `log_path`.
+    :param slots: (appliance_slots, io_slots) semaphores shared by the pool
+    :returns: dict summarizing the build, with the db record on success
+    """
+    Hobo.appliance_slots, Hobo.io_slots = slots
+    # never share a sqlite connection across fork
+    Hobo.db = Db(config.db_path)
+
+    session = CommandSession()
+    result = {'name': name, 'log': log_path, 'record': None, 'error': ''}
+    start = time.time()
+    try:
+        hobo = Hobo(session=session, check_templates=False)
+        result['record'] = hobo._build(base_os, name, **kwargs)
+        result['status'] = 'ok'
+    except (Exception, KeyboardInterrupt) as ex:
+        result['status'] = 'failed'
+        result['error'] = str(ex).splitlines()[0] if str(ex) else repr(ex)
+    result['seconds'] = round(time.time() - start, 1)
+
+    with open(log_path, 'w') as fh:
+        for cmd, returncode, output in session.log:
+            fh.write('$ {}\n'.format(cmd))
+            for line in output:
+                fh.write('{}\n'.format(line))
+            fh.write('[{}]\n'.format(returncode))
+    return result
@@ -0,0 +1,580 @@
+"""Micro-benchmarks for hobo internals.
+
+Run with `hobo bench <target>`; each target prints a table of timings.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import itertools
+import pickle
+import shutil
+import tempfile
+import subprocess
+
+from hobo.util import Db, PickleDb, print_table, parse_size
+from hobo.net import NeighbourTable, DEVNULL
+from hobo.compress import get_codec, zstandard
+from hobo.templates import TemplateCatalog, validate_cached
+from hobo.virsh import VIRSH_BACKENDS, get_virsh
+from hobo.libvirt import DomainError
+from hobo.inventory import InventoryCache, ansible_inventory, ansible_host, render_info
+
+# the per-mac lookup Domain.ip_address used to run
+ARP_PIPELINE = "arp -an |grep {} |awk '{{print $2}}' |sed 's/[()]//g' |perl -pe 'chomp'"
+
+DB_SIZES = (10, 1000, 100000)
+
+# (codec, level) pairs compared by `hobo bench compress`
+COMPRESS_SETTINGS = (
+    ('none', None),
+    ('xz', 0),
+    ('xz', 1),
+    ('xz', 6),
+    ('xz', 9),
+    ('zstd', 3),
+    ('zstd', 9),
+    ('zstd', 19),
+)
+
+
+def _timeit(func, repeat):
+    """Mean wall time of `func` over `repeat` calls."""
+    start = time.time()
+    for i in range(repeat):
+        func(i)
+    return (time.time() - start) / repeat
+
+
+def _domain_record(i, tags=50):
+    return {
+        'user': 'root',
+        'hostname': 'dom{}.local'.format(i),
+        'disk_size': None,
+        'bridge_iface': 'hob0',
+        'memory': '1024',
+        'cpus': '1',
+        'tags': ['tag{}'.format(i % tags)],
+    }
+
+
+def _populate(db, size):
+    """Fill a db with `size` domain records as quickly as the backend allows."""
+    records = dict(
+        ('dom{}'.format(i), _domain_record(i)) for i in range(size)
+    )
+    if isinstance(db, PickleDb):
+        with open(db.path, 'wb') as pkl:
+            pickle.dump({'domains': records}, pkl)
+    else:
+        with db.transaction():
+            for k, v in records.items():
+                db.write('domains', k, v)
+
+
+def bench_db(sizes=DB_SIZES, repeat=20):
+    """Compare the pickle and sqlite `Db` backends.
+    :returns: list of result rows, mean seconds per operation
+    """
+    rows = []
+    workdir = tempfile.mkdtemp(prefix='hobo-bench-')
+    try:
+        for size in sizes:
+            for backend in (PickleDb, Db):
+                path = os.path.join(
+                    workdir, '{}-{}.db'.format(backend.__name__, size)
+                )
+                db = backend(path)
+                start = time.time()
+                _populate(db, size)
+                row = {
+                    'backend': backend.__name__,
+                    'records': size,
+                    'populate': time.time() - start,
+                    'read_key': _timeit(
+                        lambda i: db.read('domains', 'dom{}'.format(i % size)),
+                        repeat
+                    ),
+                    'read_section': _timeit(
+                        lambda i: db.read('domains'), max(1, repeat // 10)
+                    ),
+                    'write': _timeit(
+                        lambda i: db.write(
+                            'domains', 'new{}'.format(i), _domain_record(i)
+                        ),
+                        repeat
+                    ),
+                    'delete': _timeit(
+                        lambda i: db.delete('domains', 'new{}'.format(i)),
+                        repeat
+                    ),
+                }
+                rows.append(row)
+                if isinstance(db, Db):
+                    db.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    return rows
+
+
+def bench_arp(macs=None, repeat=10):
+    """Compare the old arp shell pipeline with `NeighbourTable` lookups.
+    :param macs: macs to resolve, defaults to everything in the ARP table
+    :returns: list of result rows, mean seconds to resolve all macs
+    """
+    table = NeighbourTable()
+    macs = macs or list(table.read().keys()) or ['52:54:00:00:00:01']
+
+    def pipeline(i):
+        for mac in macs:
+            subprocess.call(
+                ARP_PIPELINE.format(mac), shell=True,
+                stdout=DEVNULL, stderr=subprocess.STDOUT
+            )
+
+    def cold(i):
+        NeighbourTable().resolve(macs)
+
+    def warm(i):
+        table.resolve(macs)
+
+    return [
+        {'method': method, 'macs': len(macs), 'seconds': _timeit(func, repeat)}
+        for method, func in (
+            ('arp pipeline', pipeline),
+            ('resolve_macs (cold)', cold),
+            ('resolve_macs (warm)', warm),
+        )
+    ]
+
+
+def bench_compress(image, sample=256 * 1024 * 1024, settings=COMPRESS_SETTINGS):
+    """Run every codec over the first `sample` bytes of an image.
+    :returns: list of CompressResult dicts
+    """
+    workdir = tempfile.mkdtemp(prefix='hobo-bench-')
+    try:
+        src = os.path.join(workdir, 'sample')
+        with open(image, 'rb') as fin, open(src, 'wb') as fout:
+            if sample:
+                fout.write(fin.read(sample))
+            else:
+                shutil.copyfileobj(fin, fout)
+
+        rows = []
+        for name, level in settings:
+            if name == 'zstd' and zstandard is None:
+                continue
+            codec = get_codec(name, level)
+            dst = src + codec.suffix + '.out'
+            row = codec.compress(src, dst).as_dict()
+            row['virt_builder'] = 'yes' if codec.virt_builder_compatible else 'no'
+            rows.append(row)
+            if os.path.exists(dst):
+                os.remove(dst)
+    finally:
+        shutil.rmtree(workdir)
+
+    return rows
+
+
+def bench_templates(count=200, repeat=20):
+    """Cold and warm timings of template validation and catalog loads,
+    over a generated template file of `count` templates.
+    :returns: list of result rows, mean seconds per call
+    """
+    workdir = tempfile.mkdtemp(prefix='hobo-bench-')
+    try:
+        template_file = os.path.join(workdir, 'hobo.templates')
+        with open(template_file, 'w') as fh:
+            for i in range(count):
+                image = 'base{}.qcow2.xz'.format(i)
+                open(os.path.join(workdir, image), 'w').close()
+                fh.write(
+                    '[base{0}]\nname=base {0}\narch=x86_64\nfile={1}\n'
+                    'format=qcow2\nsize=6442450944\ncompressed_size=1\n\n'.format(i, image)
+                )
+        repos_dir = os.path.join(workdir, 'repos.d')
+        os.mkdir(repos_dir)
+        with open(os.path.join(repos_dir, 'hobo.conf'), 'w') as fh:
+            fh.write('[hobo]\nuri=file://{}\nproxy=off\n'.format(template_file))
+        validated = os.path.join(workdir, 'validated.json')
+        catalog_cache = os.path.join(workdir, 'templates.json')
+
+        def uncached(path, func):
+            def call(i):
+                if os.path.exists(path):
+                    os.remove(path)
+                func(i)
+            return call
+
+        def validate(i):
+            validate_cached(template_file, validated, [repos_dir])
+
+        def catalog(i):
+            TemplateCatalog(catalog_cache, repos_dirs=[repos_dir]).load()
+
+        warm_catalog = TemplateCatalog(catalog_cache, repos_dirs=[repos_dir])
+
+        return [
+            {'operation': operation, 'templates': count, 'seconds': _timeit(func, repeat)}
+            for operation, func in (
+                ('validate (cold)', uncached(validated, validate)),
+                ('validate (warm)', validate),
+                ('catalog (cold)', uncached(catalog_cache, catalog)),
+                ('catalog (disk cache)', catalog),
+                ('catalog (in memory)', lambda i: warm_catalog.load()),
+            )
+        ]
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_virsh(queries=1000, uri='test:///default', domain='test'):
+    """Time `domstate` queries through each virsh backend. The default
+    uri is libvirt's built-in test driver, which needs no libvirtd.
+    :returns: list of result rows
+    """
+    from commandsession import CommandSession
+    rows = []
+    for name in sorted(VIRSH_BACKENDS):
+        virsh = get_virsh(name, CommandSession(), uri=uri)
+        try:
+            start = time.time()
+            for i in range(queries):
+                virsh.check_output(['domstate', domain])
+            elapsed = time.time() - start
+        finally:
+            virsh.close()
+        rows.append({
+            'backend': name,
+            'queries': queries,
+            'seconds': elapsed,
+            'per_query': elapsed / queries,
+        })
+    return rows
+
+
+def _info_records(domains, tags):
+    records = {}
+    for i in range(domains):
+        record = _domain_record(i, tags)
+        record.update({
+            'mac': '52:54:00:00:{:02x}:{:02x}'.format(i // 256 % 256, i % 256),
+            'ip': '10.0.{}.{}'.format(i // 256 % 256, i % 256),
+            'state': 'running' if i % 10 else 'shut off',
+        })
+        records['dom{}'.format(i)] = record
+    return records
+
+
+def _ini_per_tag_scan(records):
+    """The ansible INI rendering `info` used to do, scanning every
+    domain for every tag, as a baseline.
+    """
+    running = [d for d in records.keys() if records[d]['state'] == 'running']
+    for dom in running:
+        print(ansible_host(records[dom]))
+    if len(running): print()
+    tags = list(set(itertools.chain(*[t['tags'] for t in records.values()])))
+    for tag in tags:
+        matches = [k for k in records.keys() if tag in records[k]['tags'] and k in running]
+        if len(matches):
+            print('[{}]'.format(tag))
+        for dom in matches:
+            print(ansible_host(records[dom]))
+        if len(matches):
+            print()
+
+
+def bench_inventory(domains=1000, tags=50, repeat=20):
+    """Time rendering the ansible inventory of `domains` domains spread
+    over `tags` tags: the old per-tag scan, the one-pass tag index as
+    INI and as JSON, and a JSON read from the inventory cache.
+    :returns: list of result rows, mean seconds per call
+    """
+    records = _info_records(domains, tags)
+    workdir = tempfile.mkdtemp(prefix='hobo-bench-')
+    try:
+        cache = InventoryCache(os.path.join(workdir, 'inventory.json'), ttl=3600)
+        cache.put(json.dumps(ansible_inventory(records), indent=2))
+
+        def quietly(func):
+            def call(i):
+                stdout = sys.stdout
+                with open(os.devnull, 'w') as sys.stdout:
+                    try:
+                        func()
+                    finally:
+                        sys.stdout = stdout
+            return call
+
+        return [
+            {'operation': operation, 'domains': domains, 'tags': tags,
+             'seconds': _timeit(func, repeat)}
+            for operation, func in (
+                ('ini (per-tag scan)', quietly(lambda: _ini_per_tag_scan(records))),
+                ('ini (tag index)', quietly(lambda: render_info(records, 'ansible'))),
+                ('json (tag index)', quietly(lambda: render_info(records, 'json'))),
+                ('json (cached)', lambda i: cache.get()),
+            )
+        ]
+    finally:
+        shutil.rmtree(workdir)
+
+
+# (phase, from milestone, to milestone) timed by `hobo bench boot`
+BOOT_PHASES = (
+    ('virt_builder', 'build', 'imaged'),
+    ('virt_install', 'imaged', 'defined'),
+    ('start_to_ip', 'start', 'visible'),
+    ('ip_to_ssh', 'visible', 'ssh'),
+    ('boot', 'start', 'ssh'),
+)
+
+PERCENTILES = (50, 90, 99)
+
+
+class BootTimeline(object):
+    """(time, milestone) marks of one boot run, oldest first, the way
+    `Domain.states` keeps (time, state) transitions.
+    """
+    def __init__(self):
+        self.marks = []
+
+    def mark(self, milestone, when=None):
+        self.marks.append((when or time.time(), milestone))
+
+    def extend(self, states, since=0):
+        """Add a domain's state transitions from `since` on, e.g.
+        'running' as libvirt saw it.
+        """
+        for when, state in states:
+            if when >= since:
+                self.mark(state, when)
+
+    def at(self, milestone):
+        """:returns: time of the first `milestone`, or None"""
+        for when, name in self.marks:
+            if name == milestone:
+                return when
+        return None
+
+    def phases(self, phases=BOOT_PHASES):
+        """:returns: dict of phase to seconds, or to None if either of its
+            milestones was not reached
+        """
+        durations = {}
+        for phase, first, last in phases:
+            start, end = self.at(first), self.at(last)
+            durations[phase] = end - start if start is not None and end is not None else None
+        return durations
+
+
+class BootDriver(object):
+    """What `bench_boot` does to a domain, through hobo and libvirt.
+    Tests substitute a fake with the same methods.
+    """
+    def __init__(self, hobo, port=22, timeout=300):
+        self.hobo = hobo
+        self.port = port
+        self.timeout = timeout
+
+    def exists(self, name):
+        return name in self.hobo.libvirt.snapshot(refresh=True)
+
+    def build(self, base_os, name, timeline):
+        record = self.hobo._build(base_os, name, timeline=timeline)
+        self.hobo.db.write('domains', name, record)
+        self.hobo._domains_changed()
+
+    def remove(self, name):
+        if name in self.hobo.db.keys('domains'):
+            # tells hobod and the inventory cache itself
+            self.hobo.destroy(name, self.timeout)
+        else:
+            try:
+                self.hobo.libvirt.undefine_with_prejudice(name)
+            except DomainError:
+                pass
+            try:
+                self.hobo.libvirt.delete_disk(name)
+            except OSError:
+                pass
+            self.hobo._domains_changed()
+
+    def stop(self, name):
+        self.hobo.libvirt.shutdown_many([name], self.timeout)
+
+    def start(self, name, timeline):
+        domain = self.hobo.libvirt.get_domain(name)
+        since = time.time()
+        domain.start()
+        timeline.extend(domain.states, since)
+        return domain
+
+    def wait_visible(self, domain):
+        """:returns: the domain's ip once DHCP or ARP knows it, or None"""
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            ip = self.hobo.libvirt.resolve_ips([domain])[domain.name]
+            if ip:
+                return ip
+            time.sleep(0.2)
+        return None
+
+    def wait_ssh(self, domain, ip):
+        from hobo.ready import wait_ready
+        return wait_ready({domain.name: ip}, self.port, self.timeout)[domain.name] is not None
+
+
+def percentile(values, pct):
+    """Linearly interpolated percentile of a list of numbers."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(runs, phases=BOOT_PHASES, percentiles=PERCENTILES):
+    """Per-phase count, mean, min, max and percentiles over many runs.
+    :param runs: list of dicts of phase to seconds or None
+    """
+    summary = {}
+    for phase, _, _ in phases:
+        values = [run[phase] for run in runs if run.get(phase) is not None]
+        stats = {'count': len(values)}
+        if values:
+            stats.update({
+                'mean': sum(values) / len(values),
+                'min': min(values),
+                'max': max(values),
+            })
+            for pct in percentiles:
+                stats['p{}'.format(pct)] = percentile(values, pct)
+        summary[phase] = stats
+    return summary
+
+
+def bench_boot(driver, base_os, runs=5, name=None, rebuild=False):
+    """Time how long a domain of `base_os` takes to build and boot.
+    The domain is built on the first run, and on every run with
+    `rebuild`; otherwise an existing one is reused and only booted.
+    :param driver: `BootDriver`
+    :returns: dict with every run's phase timings and their summary
+    """
+    name = name or 'hobo-bench-{}'.format(base_os)
+    results = []
+    for i in range(runs):
+        timeline = BootTimeline()
+        exists = driver.exists(name)
+        if rebuild or not exists:
+            if exists:
+                driver.remove(name)
+            timeline.mark('build')
+            driver.build(base_os, name, timeline)
+        driver.stop(name)
+
+        timeline.mark('start')
+        domain = driver.start(name, timeline)
+        ip = driver.wait_visible(domain)
+        if ip:
+            timeline.mark('visible')
+            if driver.wait_ssh(domain, ip):
+                timeline.mark('ssh')
+
+        result = timeline.phases()
+        result['run'] = i
+        result['ok'] = timeline.at('ssh') is not None
+        results.append(result)
+
+    return {
+        'base_os': base_os,
+        'domain': name,
+        'runs': results,
+        'phases': summarize(results),
+    }
+
+
+def run(target, **kwargs):
+    """cli entry point for `hobo bench`."""
+    if target == 'db':
+        sizes = kwargs.get('sizes')
+        sizes = tuple(int(s) for s in sizes.split(',')) if sizes else DB_SIZES
+        print_table(
+            bench_db(sizes),
+            ['backend', 'records', 'populate', 'read_key', 'read_section', 'write', 'delete']
+        )
+        return True
+
+    if target == 'arp':
+        print_table(bench_arp(), ['method', 'macs', 'seconds'])
+        return True
+
+    if target == 'compress':
+        print_table(
+            bench_compress(kwargs['image'], parse_size(kwargs.get('sample') or '256M')),
+            ['codec', 'level', 'in_bytes', 'out_bytes', 'seconds', 'mb_per_s', 'ratio', 'virt_builder']
+        )
+        return True
+
+    if target == 'templates':
+        print_table(
+            bench_templates(int(kwargs.get('count') or 200)),
+            ['operation', 'templates', 'seconds']
+        )
+        return True
+
+    if target == 'virsh':
+        print_table(
+            bench_virsh(
+                int(kwargs.get('queries') or 1000),
+                kwargs.get('uri') or 'test:///default',
+                kwargs.get('domain') or 'test',
+            ),
+            ['backend', 'queries', 'seconds', 'per_query']
+        )
+        return True
+
+    if target == 'boot':
+        if sys.version_info[0] < 3:
+            print('hobo bench boot requires Python 3')
+            return False
+        from commandsession import CommandSession
+        from hobo.api import Hobo
+        hobo = Hobo(session=CommandSession(), check_templates=False)
+        results = bench_boot(
+            BootDriver(hobo, timeout=float(kwargs.get('timeout') or 300)),
+            kwargs['base_os'],
+            runs=int(kwargs.get('runs') or 5),
+            name=kwargs.get('name'),
+            rebuild=kwargs.get('rebuild'),
+        )
+        text = json.dumps(results, indent=2, sort_keys=True)
+        if not kwargs.get('output'):
+            print(text)
+        else:
+            with open(kwargs['output'], 'w') as fh:
+                fh.write(text + '\n')
+            print_table(
+                [dict(phase=phase, **results['phases'][phase]) for phase, _, _ in BOOT_PHASES],
+                ['phase', 'count', 'mean', 'min', 'p50', 'p90', 'p99', 'max']
+            )
+        return all(result['ok'] for result in results['runs'])
+
+    if target == 'inventory':
+        print_table(
+            bench_inventory(
+                int(kwargs.get('domains') or 1000),
+                int(kwargs.get('tags') or 50),
+            ),
+            ['operation', 'domains', 'tags', 'seconds']
+        )
+        return True
+
+    raise ValueError('unknown benchmark {}'.format(target))
@@ -1,13 +1,11 @@
 import os
-from six.moves import input
-import yaml
-from copy import deepcopy
+import sys
 from argparse import ArgumentParser
 
-from hobo.api import Hobo
-from commandsession import CommandSession
+# hobo.api, commandsession and yaml are imported once the arguments are
+# parsed, so --help and bad arguments stay fast
 
-def main():
+def main(argv=None):
     """cli entry point.
     """
     argparser = ArgumentParser()
@@ -68,8 +66,11 @@ def main():
         help='Desired os/platform for build.'
     )
     build_parser.add_argument(
-        '--name',
-        help='Domain names. Multiple names will create additional domains.'
+        '--name', nargs='+', required=True,
+        help=(
+            'Domain names. Multiple names will create additional domains, '
+            'concurrently; accepts comma-separated lists and ranges like web{1..20}.'
+        )
     )
     build_parser.add_argument(
         '--size',
@@ -91,6 +92,19 @@ def main():
         '--tags', nargs='?', action='append',
         help='Tags.'
     )
+    build_parser.add_argument(
+        '--linked', action='store_true',
+        help='Create a thin overlay on a shared base image instead of a full copy.'
+    )
+
+    flatten_parser = subparsers.add_parser(
+        'flatten',
+        help='Detach a linked clone from its base image.'
+    )
+    flatten_parser.add_argument(
+        'domain',
+        help='Which domain to flatten.'
+    )
 
     info_parser = subparsers.add_parser('info')
     info_parser.add_argument(
@@ -99,7 +113,36 @@ def main():
     )
     info_parser.add_argument(
         '--format',
-        help='output format.'
+        help='output format: ansible, json or jsonl.'
+    )
+    info_parser.add_argument(
+        '--timeout', type=float,
+        help=(
+            'Seconds to wait for the domains\' ips, or for hobod to refresh them, '
+            'before marking the rest timed out.'
+        )
+    )
+    info_parser.add_argument(
+        '--direct',
+        action='store_true',
+        help='Query libvirt directly, even if hobod is running.'
+    )
+
+    wait_parser = subparsers.add_parser(
+        'wait',
+        help='Wait until domains accept ssh.'
+    )
+    wait_parser.add_argument(
+        'domains', nargs='+',
+        help='Domain names; accepts comma-separated lists and ranges like web{1..20}.'
+    )
+    wait_parser.add_argument(
+        '--port', type=int, default=22,
+        help='ssh port, default 22.'
+    )
+    wait_parser.add_argument(
+        '--timeout', type=float,
+        help='Seconds to wait for all of them.'
     )
 
     destroy_parser = subparsers.add_parser('destroy')
@@ -107,6 +150,24 @@ def main():
         '--domain',
         help='Which domain to delete.'
     )
+    destroy_parser.add_argument(
+        '--timeout', type=float,
+        help='Seconds to wait for domains to shut down before forcing them off.'
+    )
+
+    inventory_parser = subparsers.add_parser(
+        'inventory',
+        help='Ansible dynamic inventory of the running domains, as JSON.'
+    )
+    inventory_parser_grp = inventory_parser.add_mutually_exclusive_group(required=True)
+    inventory_parser_grp.add_argument(
+        '--list', dest='list_hosts', action='store_true',
+        help='Every group and host.'
+    )
+    inventory_parser_grp.add_argument(
+        '--host',
+        help='Variables of one host.'
+    )
 
     package_parser = subparsers.add_parser('package')
     package_parser.add_argument(
@@ -130,7 +191,107 @@ def main():
         help='Compress?.'
     )
 
-    args = vars(argparser.parse_args())
+    bench_parser = subparsers.add_parser(
+        'bench',
+        help='Run micro-benchmarks.'
+    )
+    bench_subparsers = bench_parser.add_subparsers(dest='target')
+    bench_db_parser = bench_subparsers.add_parser(
+        'db',
+        help='Compare the pickle and sqlite db backends.'
+    )
+    bench_db_parser.add_argument(
+        '--sizes',
+        help='Comma-separated record counts.'
+    )
+
+    bench_subparsers.add_parser(
+        'arp',
+        help='Compare the arp shell pipeline with the in-process ARP table.'
+    )
+
+    bench_compress_parser = bench_subparsers.add_parser(
+        'compress',
+        help='Compare compression codecs on a sample of an image.'
+    )
+    bench_compress_parser.add_argument(
+        'image',
+        help='Image to sample.'
+    )
+    bench_compress_parser.add_argument(
+        '--sample',
+        help='How much of the image to compress, e.g. 256M; 0 for all of it.'
+    )
+
+    bench_templates_parser = bench_subparsers.add_parser(
+        'templates',
+        help='Time template validation and catalog loads, cold and warm.'
+    )
+    bench_templates_parser.add_argument(
+        '--count',
+        help='Number of templates in the generated template file.'
+    )
+
+    bench_virsh_parser = bench_subparsers.add_parser(
+        'virsh',
+        help='Compare virsh backends over repeated domstate queries.'
+    )
+    bench_virsh_parser.add_argument(
+        '--queries',
+        help='Number of queries per backend, default 1000.'
+    )
+    bench_virsh_parser.add_argument(
+        '--uri',
+        help='libvirt uri, default test:///default.'
+    )
+    bench_virsh_parser.add_argument(
+        '--domain',
+        help='Domain to query, default test.'
+    )
+
+    bench_boot_parser = bench_subparsers.add_parser(
+        'boot',
+        help='Time building and booting a domain, phase by phase.'
+    )
+    bench_boot_parser.add_argument(
+        'base_os',
+        help='Template to build the domain from.'
+    )
+    bench_boot_parser.add_argument(
+        '--runs',
+        help='Number of boots, default 5.'
+    )
+    bench_boot_parser.add_argument(
+        '--name',
+        help='Domain to build or reuse, default hobo-bench-<base_os>.'
+    )
+    bench_boot_parser.add_argument(
+        '--rebuild', action='store_true',
+        help='Build the domain again on every run, not just the first.'
+    )
+    bench_boot_parser.add_argument(
+        '--timeout',
+        help='Seconds to wait for each phase, default 300.'
+    )
+    bench_boot_parser.add_argument(
+        '--output',
+        help='Write the JSON results here and print a summary table.'
+    )
+
+    bench_inventory_parser = bench_subparsers.add_parser(
+        'inventory',
+        help='Time rendering the ansible inventory, with and without the tag index and cache.'
+    )
+    bench_inventory_parser.add_argument(
+        '--domains',
+        help='Number of domains, default 1000.'
+    )
+    bench_inventory_parser.add_argument(
+        '--tags',
+        help='Number of tags, default 50.'
+    )
+
+    args = vars(argparser.parse_args(argv))
     
     verbose = args.pop('verbose')
     debug = args.pop('debug')
@@ -150,6 +311,7 @@ def main():
         template = args.pop('template')
         image_file = args.pop('image_file')
 
+        import yaml
         with open(image_file, 'r') as yml:
             templates = yaml.load(yml.read())
             if template not in templates:
@@ -165,11 +327,27 @@ def main():
             return False
 
     if command == 'destroy' and not args.get('domain'):
+        from six.moves import input
         print('danger, will robinson:')
         resp = input('y/n')
         if not resp.strip() == 'y':
             return
 
+    if command == 'bench':
+        from hobo import bench
+        return 0 if bench.run(**args) else 1
+
+    if command == 'info' and not args.pop('direct'):
+        ret = _daemon_info(**args)
+        if ret is not None:
+            return 0 if ret else 1
+
+    if command == 'inventory':
+        return 0 if _inventory(**args) else 1
+
+    from commandsession import CommandSession
+    from hobo.api import Hobo
+
     env = {} if not debug else {'LIBGUESTFS_DEBUG': '1'}
     session = CommandSession(stream=verbose)  # , env=env)  #FIXME this hangs due to proxy.
     hobo = Hobo(session=session)
@@ -181,3 +359,86 @@ def main():
     return 0 if ret else 1
 
 
+def inventory_main():
+    """hobo-inventory entry point, for ansible's `-i`."""
+    return main(['inventory'] + sys.argv[1:])
+
+
+def _daemon_records(domain=None, timeout=None):
+    """Ask hobod for info records. Its errors go to stderr, and the
+    caller falls back to asking libvirt itself.
+    :param timeout: seconds hobod waits for a refresh it owes us; if
+        none comes, the records it has are marked 'timed_out'
+    :returns: (answered, records); records is None if there are no
+        domains
+    """
+    from hobo.util import LazyConfig
+    from hobo.daemon import query, DEFAULT_TIMEOUT
+    request = {'op': 'info', 'domain': domain}
+    if timeout is not None:
+        request['timeout'] = timeout
+    response = query(
+        LazyConfig().daemon_socket, request,
+        timeout=2.0 + (DEFAULT_TIMEOUT if timeout is None else timeout)
+    )
+    if response is None:
+        return False, None
+    if not response['ok'] or (response['records'] is None and response.get('error')):
+        sys.stderr.write('hobod: {}, querying libvirt directly\n'.format(response['error']))
+        return False, None
+    records = response['records']
+    if response.get('stale'):
+        if records is None:
+            # nothing gathered yet
+            return False, None
+        for record in records.values():
+            record['timed_out'] = True
+    return True, records
+
+
+def _daemon_info(domain=None, format=None, timeout=None):
+    """Answer `info` from hobod, waiting for it as long as `info` would
+    wait for libvirt.
+    :returns: None if hobod did not answer, else whether info succeeded
+    """
+    from hobo.util import LazyConfig
+    if timeout is None:
+        timeout = LazyConfig().info_timeout
+    answered, records = _daemon_records(domain, timeout)
+    if not answered:
+        return None
+    if records is None:
+        return False
+
+    from hobo.inventory import render_info
+    render_info(records, format)
+    return True
+
+
+def _inventory(list_hosts=False, host=None):
+    """Print the JSON inventory, from the inventory cache when fresh,
+    else from hobod's records or libvirt's.
+    """
+    import json
+    from hobo.util import LazyConfig
+    from hobo.inventory import InventoryCache, ansible_inventory
+
+    config = LazyConfig()
+    cache = InventoryCache(config.inventory_cache, config.inventory_ttl)
+    text = cache.get()
+    if text is None:
+        answered, records = _daemon_records()
+        if not answered:
+            from commandsession import CommandSession
+            from hobo.api import Hobo
+            records = Hobo(session=CommandSession(), check_templates=False).info_records()
+        text = json.dumps(ansible_inventory(records or {}), indent=2)
+        cache.put(text)
+
+    if host:
+        hostvars = json.loads(text)['_meta']['hostvars']
+        print(json.dumps(hostvars.get(host, {}), indent=2))
+    else:
+        print(text)
+    return True
+
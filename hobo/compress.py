@@ -0,0 +1,320 @@
+"""Image compression.
+
+Codecs compress a file in-process, spreading independent blocks across
+all cores. Only xz output (and no compression at all) can be consumed by
+virt-builder; other codecs are there for comparison.
+"""
+from __future__ import print_function
+import os
+import re
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import lzma
+except ImportError:
+    from backports import lzma  # py2
+
+from hobo.util import data_extents, parse_size
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ['CODECS', 'CompressResult', 'get_codec', 'parse_xz_flags', 'choose']
+
+# libvirt recommends 16M blocks for virt-builder templates
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+class CompressResult(object):
+    """Outcome of compressing one file."""
+    def __init__(self, codec, level, in_bytes, out_bytes, seconds):
+        self.codec = codec
+        self.level = level
+        self.in_bytes = in_bytes
+        self.out_bytes = out_bytes
+        self.seconds = seconds
+
+    @property
+    def ratio(self):
+        return float(self.in_bytes) / self.out_bytes if self.out_bytes else 0.0
+
+    @property
+    def mb_per_s(self):
+        return self.in_bytes / 1024.0 / 1024.0 / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return {
+            'codec': self.codec,
+            'level': self.level,
+            'in_bytes': self.in_bytes,
+            'out_bytes': self.out_bytes,
+            'seconds': round(self.seconds, 3),
+            'mb_per_s': round(self.mb_per_s, 1),
+            'ratio': round(self.ratio, 2),
+        }
+
+    def __str__(self):
+        return '{} -{}: {} -> {} bytes, ratio {:.2f}, {:.1f} MB/s'.format(
+            self.codec, self.level, self.in_bytes, self.out_bytes,
+            self.ratio, self.mb_per_s
+        )
+
+
+class XzCodec(object):
+    """xz, compressed as independent fixed-size blocks in parallel.
+    Each block is written as its own xz stream; concatenated streams
+    are valid xz, and are what `xz -T0` based tooling expects to read.
+    """
+    name = 'xz'
+    suffix = '.xz'
+    virt_builder_compatible = True
+    default_level = 1
+
+    def __init__(self, level=None, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+        self.level = self.default_level if level is None else level
+        self.block_size = block_size
+        self.threads = threads or multiprocessing.cpu_count()
+
+    def compress_block(self, data):
+        return lzma.compress(
+            data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64,
+            preset=self.level
+        )
+
+    def compress(self, src, dst):
+        """Compress `src` into `dst`.
+        :returns: CompressResult
+        """
+        start = time.time()
+        in_bytes = out_bytes = 0
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout, \
+                ThreadPoolExecutor(max_workers=self.threads) as pool:
+            # keep a bounded number of blocks in flight, in order
+            pending = []
+            while True:
+                data = fin.read(self.block_size)
+                if data:
+                    in_bytes += len(data)
+                    pending.append(pool.submit(self.compress_block, data))
+                if pending and (not data or len(pending) >= 2 * self.threads):
+                    out = pending.pop(0).result()
+                    out_bytes += len(out)
+                    fout.write(out)
+                elif not data:
+                    break
+
+        return CompressResult(
+            self.name, self.level, in_bytes, out_bytes, time.time() - start
+        )
+
+
+class ZstdCodec(XzCodec):
+    """zstd, through the optional `zstandard` module, on all cores.
+    virt-builder cannot read it.
+    """
+    name = 'zstd'
+    suffix = '.zst'
+    virt_builder_compatible = False
+    default_level = 3
+
+    def __init__(self, level=None, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+        if zstandard is None:
+            raise ValueError('zstd codec requires the zstandard module')
+        super(ZstdCodec, self).__init__(level, block_size, threads)
+
+    def compress_block(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def compress(self, src, dst):
+        start = time.time()
+        cctx = zstandard.ZstdCompressor(level=self.level, threads=self.threads)
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            in_bytes, out_bytes = cctx.copy_stream(
+                fin, fout, read_size=self.block_size
+            )
+        return CompressResult(
+            self.name, self.level, in_bytes, out_bytes, time.time() - start
+        )
+
+
+class NoneCodec(object):
+    """No compression; the image is used as is."""
+    name = 'none'
+    suffix = ''
+    virt_builder_compatible = True
+    default_level = 0
+
+    def __init__(self, level=None, block_size=None, threads=None):
+        self.level = 0
+
+    def compress_block(self, data):
+        return data
+
+    def compress(self, src, dst):
+        size = os.stat(src).st_size
+        return CompressResult(self.name, self.level, size, size, 0.0)
+
+
+CODECS = {
+    'xz': XzCodec,
+    'zstd': ZstdCodec,
+    'none': NoneCodec,
+}
+
+
+def get_codec(name, level=None, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+    try:
+        codec = CODECS[name]
+    except KeyError:
+        raise ValueError('unknown compression codec {}'.format(name))
+    return codec(level, block_size=block_size, threads=threads)
+
+
+def parse_xz_flags(flags):
+    """Pull the preset and block size out of xz command line flags,
+    as found in the `compress_flags` setting.
+    :returns: (level, block_size)
+    """
+    level = XzCodec.default_level
+    block_size = DEFAULT_BLOCK_SIZE
+    for flag in (flags or '').split():
+        if re.match(r'^-\d$', flag):
+            level = int(flag[1:])
+        elif flag == '--best':
+            level = 9
+        elif flag == '--fast':
+            level = 0
+        elif flag.startswith('--block-size='):
+            block_size = int(flag.split('=', 1)[1])
+    return level, block_size
+
+
+# virt-builder compatible settings the sampler chooses between
+CANDIDATES = (
+    ('none', None),
+    ('xz', 0),
+    ('xz', 1),
+    ('xz', 3),
+    ('xz', 6),
+)
+
+
+def sample_blocks(path, fraction=0.01, block_size=DEFAULT_BLOCK_SIZE):
+    """Read an even spread of blocks from the allocated parts of a file.
+    :returns: (list of sampled blocks, total allocated bytes)
+    """
+    extents = data_extents(path)
+    allocated = sum(length for _, length in extents)
+    if not allocated:
+        return [], 0
+
+    count = max(1, int(allocated * fraction) // block_size)
+    stride = allocated // count
+    blocks = []
+    with open(path, 'rb') as fh:
+        for i in range(count):
+            # block_size bytes from position i*stride within the
+            # concatenated data extents
+            want = i * stride
+            need = block_size
+            chunks = []
+            for start, length in extents:
+                if want >= length:
+                    want -= length
+                    continue
+                fh.seek(start + want)
+                chunk = fh.read(min(need, length - want))
+                chunks.append(chunk)
+                need -= len(chunk)
+                want = 0
+                if need <= 0:
+                    break
+            blocks.append(b''.join(chunks))
+    return blocks, allocated
+
+
+def estimate(codec, blocks, allocated, size=None, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+    """Extrapolate a codec's time and output size from sampled blocks.
+    `compress` reads the whole file, holes included, so the `size -
+    allocated` bytes of holes are costed as zero blocks.
+    :param allocated: bytes of data the blocks were sampled from
+    :param size: bytes compress will read, `allocated` if None
+    :returns: dict with estimated seconds, out_bytes and ratio
+    """
+    threads = threads or multiprocessing.cpu_count()
+    size = allocated if size is None else size
+    sampled = sum(len(block) for block in blocks)
+    start = time.time()
+    out = sum(len(codec.compress_block(block)) for block in blocks)
+    elapsed = time.time() - start
+    seconds = elapsed * allocated / sampled if sampled else 0.0
+    out_bytes = out * float(allocated) / sampled if sampled else 0.0
+
+    holes = size - allocated
+    if holes > 0:
+        zeros = b'\0' * min(block_size, holes)
+        start = time.time()
+        zero_out = len(codec.compress_block(zeros))
+        count = float(holes) / len(zeros)
+        seconds += (time.time() - start) * count
+        out_bytes += zero_out * count
+
+    return {
+        'codec': codec.name,
+        'level': codec.level,
+        'seconds': round(seconds / threads, 3),
+        'out_bytes': int(out_bytes),
+        'ratio': round(float(size) / out_bytes, 2) if out_bytes else 1.0,
+    }
+
+
+def parse_target(target):
+    """Parse a `compress_target` setting, "time:<seconds>" or "size:<bytes>"."""
+    kind, _, value = (target or '').partition(':')
+    if kind == 'time':
+        return kind, float(value)
+    if kind == 'size':
+        return kind, parse_size(value)
+    raise ValueError('bad compress_target {!r}, use time:<sec> or size:<bytes>'.format(target))
+
+
+def choose(path, target, candidates=CANDIDATES, fraction=0.01, block_size=DEFAULT_BLOCK_SIZE):
+    """Pick compression settings for an image from a sample of its blocks.
+
+    With a time target, the smallest output that finishes in time wins;
+    with a size target, the fastest setting that fits wins. If nothing
+    meets the target, the closest miss is taken.
+    :returns: decision dict, suitable for storing with the template
+    """
+    kind, limit = parse_target(target)
+    size = os.stat(path).st_size
+    blocks, allocated = sample_blocks(path, fraction, block_size)
+    estimates = [
+        estimate(get_codec(name, level, block_size), blocks, allocated, size, block_size)
+        for name, level in candidates
+    ]
+
+    if kind == 'time':
+        fits = [e for e in estimates if e['seconds'] <= limit]
+        best = min(fits, key=lambda e: e['out_bytes']) if fits else \
+            min(estimates, key=lambda e: e['seconds'])
+    else:
+        fits = [e for e in estimates if e['out_bytes'] <= limit]
+        best = min(fits, key=lambda e: e['seconds']) if fits else \
+            min(estimates, key=lambda e: e['out_bytes'])
+
+    return {
+        'target': target,
+        'codec': best['codec'],
+        'level': best['level'],
+        'block_size': block_size,
+        'estimate': best,
+        'candidates': estimates,
+        'allocated_bytes': allocated,
+        'size_bytes': size,
+        'sampled_bytes': sum(len(block) for block in blocks),
+    }
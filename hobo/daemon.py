@@ -0,0 +1,238 @@
+"""hobod, a daemon that keeps domain info warm for the hobo cli.
+
+The daemon refreshes `Hobo.info_records` in the background, when libvirt
+events say something changed or at least every `interval` seconds, and
+answers queries from the cli over a Unix socket. The protocol is one
+JSON request line and one JSON response line per connection:
+
+    {"op": "info", "domain": null, "timeout": 5}
+    {"ok": true, "records": {...}, "age": 1.2, "stale": false}
+
+Other ops are "ping" and "invalidate". The cli falls back to doing the
+work itself when no daemon answers, see `query`.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import threading
+from argparse import ArgumentParser
+
+from six.moves import socketserver
+
+__all__ = ['InfoCache', 'Server', 'query', 'main']
+
+DEFAULT_INTERVAL = 10.0
+# seconds an info query waits for a refresh, unless it says otherwise
+DEFAULT_TIMEOUT = 30.0
+
+
+class InfoCache(object):
+    """Info records for every domain, refreshed in the background.
+    Each invalidation bumps a generation; `get` waits for a refresh
+    begun at or after the generation current when it was called, so a
+    query that follows an invalidation never sees the records from
+    before it.
+    :param hobo: `hobo.api.Hobo`
+    :param interval: longest time between refreshes, in seconds
+    """
+    def __init__(self, hobo, interval=DEFAULT_INTERVAL):
+        self.hobo = hobo
+        self.interval = interval
+        self.records = None
+        self.error = None
+        self.refreshed = 0.0
+        self.refreshes = 0
+        # invalidations so far, and how many a finished refresh had seen
+        self.generation = 0
+        self._refreshed_generation = -1
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def refresh(self):
+        with self._cond:
+            generation = self.generation
+        try:
+            records, error = self.hobo.info_records(), None
+        except Exception as ex:
+            # keep serving the last good records
+            records, error = self.records, str(ex) or repr(ex)
+        with self._cond:
+            self.records, self.error = records, error
+            self.refreshed = time.time()
+            self.refreshes += 1
+            self._refreshed_generation = max(self._refreshed_generation, generation)
+            self._cond.notify_all()
+
+    def _wait(self):
+        """Sleep until the next refresh is due, an invalidation, or a
+        libvirt event if the backend tracks them.
+        """
+        tracker = self.hobo.libvirt.backend.tracker
+        generation = tracker.generation if tracker else None
+        deadline = time.time() + self.interval
+        while not self._stop.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if self._wake.wait(min(remaining, 0.1) if tracker else remaining):
+                break
+            if tracker and tracker.generation != generation:
+                break
+        self._wake.clear()
+
+    def run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._wait()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='hobod-refresh')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def invalidate(self):
+        """Refresh now, e.g. after a build or destroy changed the db."""
+        with self._cond:
+            self.generation += 1
+        self._wake.set()
+
+    def get(self, timeout=DEFAULT_TIMEOUT):
+        """Wait for records at least as new as the last invalidation, or
+        `timeout` seconds, whichever is first.
+        :returns: (records, seconds since refreshed, whether the records
+            are older than the last invalidation)
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            generation = self.generation
+            while self._refreshed_generation < generation:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            stale = self._refreshed_generation < generation
+            return self.records, time.time() - self.refreshed, stale
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = self.server.dispatch(request)
+        except ValueError as ex:
+            response = {'ok': False, 'error': 'bad request: {}'.format(ex)}
+        self.wfile.write((json.dumps(response, default=str) + '\n').encode('utf-8'))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Answers cli queries from an `InfoCache`. The socket is bound
+    under a 077 umask, so it is owner-only from the moment it exists.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, cache):
+        self.cache = cache
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def dispatch(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return {'ok': True, 'pid': os.getpid()}
+
+        if op == 'invalidate':
+            self.cache.invalidate()
+            return {'ok': True}
+
+        if op == 'info':
+            timeout = request.get('timeout')
+            records, age, stale = self.cache.get(
+                DEFAULT_TIMEOUT if timeout is None else float(timeout)
+            )
+            domain = request.get('domain')
+            if records is not None and domain:
+                if domain not in records:
+                    return {'ok': False, 'error': 'unknown domain {}'.format(domain)}
+                records = {domain: records[domain]}
+            return {
+                'ok': True,
+                'records': records,
+                'age': round(age, 3),
+                'stale': stale,
+                'error': self.cache.error,
+            }
+
+        return {'ok': False, 'error': 'unknown op {}'.format(op)}
+
+
+def query(path, request, timeout=2.0):
+    """Send one request to hobod.
+    :returns: the response, or None if no daemon answered
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data.decode('utf-8'))
+    except (socket.error, IOError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+
+def main(argv=None):
+    """hobod entry point."""
+    argparser = ArgumentParser(prog='hobod', description='Serve hobo info from a warm cache.')
+    argparser.add_argument('--socket', help='Unix socket to listen on.')
+    argparser.add_argument(
+        '--interval', type=float,
+        help='Longest time between refreshes, in seconds.'
+    )
+    args = argparser.parse_args(argv)
+
+    from hobo.api import Hobo, config
+    path = args.socket or config.daemon_socket
+    interval = args.interval or config.daemon_interval
+
+    if query(path, {'op': 'ping'}, timeout=0.5):
+        print('hobod is already running on {}'.format(path))
+        return 1
+    if os.path.exists(path):
+        os.remove(path)
+
+    cache = InfoCache(Hobo(check_templates=False), interval)
+    cache.start()
+    server = Server(path, cache)
+    signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))
+    print('hobod listening on {}'.format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cache.stop()
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+    return 0
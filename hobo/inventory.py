@@ -0,0 +1,143 @@
+"""Rendering of domain info records.
+
+A record is a domain's db record plus its current 'mac', 'ip' and
+'state', as built by `Hobo.info_records`. Rendering is kept apart from
+gathering so records served by `hobod` print the same as direct ones.
+"""
+from __future__ import print_function
+import os
+import json
+import time
+from collections import OrderedDict
+
+from hobo.util import mkdir_all
+
+__all__ = [
+    'render_info', 'FORMATS', 'tag_index', 'ansible_inventory',
+    'InventoryCache', 'jsonl_line',
+]
+
+FORMATS = (None, 'ansible', 'json', 'jsonl')
+
+
+def ansible_vars(record):
+    """Host variables for a record."""
+    hostvars = OrderedDict()
+    if record['user']: hostvars['ansible_ssh_user'] = record['user']
+    if record['ip']: hostvars['ansible_ssh_host'] = record['ip']
+    return hostvars
+
+
+def ansible_host(record):
+    """One host line of an ansible INI inventory."""
+    args = [record['hostname']]
+    args.extend('{}={}'.format(k, v) for k, v in ansible_vars(record).items())
+    return ' '.join(args)
+
+
+def tag_index(records):
+    """Index the running domains by tag, in one pass over the records.
+    :returns: (list of running domain names,
+        OrderedDict of tag to list of running domain names)
+    """
+    running = []
+    tags = OrderedDict()
+    for name, record in records.items():
+        if record['state'] != 'running':
+            continue
+        running.append(name)
+        for tag in record['tags'] or ():
+            tags.setdefault(tag, []).append(name)
+    return running, tags
+
+
+def ansible_inventory(records):
+    """A dynamic inventory, as ansible expects from `--list`: a group
+    per tag, and every host's variables under _meta so ansible need not
+    ask `--host` for each.
+    :returns: dict
+    """
+    running, tags = tag_index(records)
+    inventory = OrderedDict()
+    inventory['all'] = {'hosts': [records[name]['hostname'] for name in running]}
+    for tag, names in tags.items():
+        inventory[tag] = {'hosts': [records[name]['hostname'] for name in names]}
+    inventory['_meta'] = {'hostvars': dict(
+        (records[name]['hostname'], ansible_vars(records[name])) for name in running
+    )}
+    return inventory
+
+
+class InventoryCache(object):
+    """The rendered `--list` inventory, reused for `ttl` seconds or until
+    `invalidate()`, which build and destroy call.
+    """
+    def __init__(self, path, ttl=30):
+        self.path = path
+        self.ttl = ttl
+
+    def get(self):
+        """:returns: the cached inventory text, or None if stale"""
+        try:
+            if time.time() - os.stat(self.path).st_mtime > self.ttl:
+                return None
+            with open(self.path) as fh:
+                return fh.read()
+        except (IOError, OSError):
+            return None
+
+    def put(self, text):
+        mkdir_all(os.path.dirname(self.path))
+        tmp = '{}.{}'.format(self.path, os.getpid())
+        with open(tmp, 'w') as fh:
+            fh.write(text)
+        os.rename(tmp, self.path)
+
+    def invalidate(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def jsonl_line(name, record):
+    """One domain as a line of JSON, for `info --format jsonl`."""
+    line = OrderedDict([('name', name), ('timed_out', False)])
+    line.update(sorted(record.items()))
+    return json.dumps(line, default=str)
+
+
+def render_info(records, format=None):
+    """Print info records.
+    :param format: None for one line per domain, 'ansible' for an INI
+        inventory of the running domains grouped by tag, 'json' for
+        the dynamic inventory, or 'jsonl' for one JSON object per domain
+    """
+    if not format:
+        for k, v in records.items():
+            print('{}: {}'.format(k, v))
+
+    elif format == 'ansible':
+        # generate a hosts file; see ansible_inventory for the
+        # dynamic inventory
+        running, tags = tag_index(records)
+        for dom in running:
+            print(ansible_host(records[dom]))
+
+        if len(running): print()
+
+        for tag, matches in tags.items():
+            print('[{}]'.format(tag))
+            for dom in matches:
+                print(ansible_host(records[dom]))
+            print()
+
+    elif format == 'json':
+        print(json.dumps(ansible_inventory(records), indent=2))
+
+    elif format == 'jsonl':
+        for name, record in records.items():
+            print(jsonl_line(name, record))
+
+    else:
+        raise ValueError('unknown format {}'.format(format))
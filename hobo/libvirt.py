@@ -1,23 +1,112 @@
 #TODO: implement cahed_property, but only if the return value is
 # available (ip address is an expensive lookup and may fail)
+from __future__ import print_function, absolute_import
 import os
+import re
 import six
+import json
 import time
+import hashlib
+import resource
+import threading
 import subprocess
 from copy import deepcopy
+from collections import namedtuple, defaultdict
 
-from commandsession import CommandSessionMixin
+from commandsession import CommandSessionMixin, CommandError
 
-from hobo.util import cached_property, mkdir_all
-from hobo.net import mac_in_arp_cache, populate_arp_cache
+from hobo.util import cached_property, mkdir_all, file_lock, human_size
+from hobo.net import mac_in_arp_cache, populate_arp_cache, get_resolver, DEFAULT_RESOLVERS
+from hobo.net import NeighbourWatcher, parse_domifaddr
+from hobo.virsh import get_virsh, quote
+from hobo.templates import TemplateCatalog, TemplateWriter, validate_cached
 
-__all__ = ['Libvirt', 'Libguestfs']
+try:
+    import guestfs
+except ImportError:
+    guestfs = None
+
+try:
+    import libvirt as libvirt_api
+except ImportError:
+    libvirt_api = None
+
+__all__ = [
+    'Libvirt', 'Libguestfs', 'DomainTable', 'PipelineStats', 'DomainError',
+    'VirshBackend', 'PythonBackend', 'BACKENDS', 'StateTracker',
+]
 
 LIBVIRT_IMAGES_DIR = '/var/lib/libvirt/images'
 
+
+def _glob_rm(g, *patterns):
+    for pattern in patterns:
+        for path in g.glob_expand(pattern):
+            g.rm_rf(path)
+
+
+def _glob_truncate(g, *patterns):
+    for pattern in patterns:
+        for path in g.glob_expand(pattern):
+            if g.is_file(path):
+                g.truncate(path)
+
+
+# virt-sysprep operations we can apply through an open guestfs handle;
+# anything else is left to virt-sysprep itself.
+GUESTFS_SYSPREP = {
+    'bash-history': lambda g: _glob_rm(
+        g, '/root/.bash_history', '/home/*/.bash_history'
+    ),
+    'udev-persistent-net': lambda g: _glob_rm(
+        g, '/etc/udev/rules.d/70-persistent-net.rules'
+    ),
+    'logfiles': lambda g: _glob_truncate(
+        g, '/var/log/*.log', '/var/log/messages*', '/var/log/secure*',
+        '/var/log/maillog*', '/var/log/cron*', '/var/log/wtmp',
+        '/var/log/btmp', '/var/log/lastlog', '/var/log/audit/*.log'
+    ),
+    'machine-id': lambda g: _glob_truncate(g, '/etc/machine-id'),
+    'package-manager-cache': lambda g: _glob_rm(
+        g, '/var/cache/yum/*', '/var/cache/dnf/*', '/var/cache/apt/archives/*.deb'
+    ),
+    'ssh-hostkeys': lambda g: _glob_rm(g, '/etc/ssh/*_host_*'),
+    'tmp-files': lambda g: _glob_rm(g, '/tmp/*', '/var/tmp/*'),
+    'utmp': lambda g: _glob_truncate(g, '/var/run/utmp', '/run/utmp'),
+}
+
+
+# catalog fields that identify a template's content, besides checksums
+_TEMPLATE_IDENTITY = ('revision', 'file', 'index', 'size', 'compressed_size')
+
+
+class PipelineStats(object):
+    """Cost of one image pipeline: appliance launches, and bytes the
+    pipeline and its children read from disk.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.launches = 0
+        self.engine = None
+        self._start = resource.getrusage(resource.RUSAGE_CHILDREN).ru_inblock
+        self._start_self = resource.getrusage(resource.RUSAGE_SELF).ru_inblock
+
+    @property
+    def bytes_read(self):
+        # ru_inblock counts 512 byte blocks
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_inblock
+        ours = resource.getrusage(resource.RUSAGE_SELF).ru_inblock
+        return 512 * (children - self._start + ours - self._start_self)
+
+    def __str__(self):
+        return '{}: {} appliance launch(es) via {}, {} read'.format(
+            self.name, self.launches, self.engine, human_size(self.bytes_read)
+        )
+
 class Libguestfs(CommandSessionMixin):
 
-    def __init__(self, template_file=None, libvirt=None, session=None):
+    def __init__(self, template_file=None, libvirt=None, session=None,
+                 cache_dir=None, catalog_ttl=86400):
         assert not session, 'do i need this feature?'
         if not libvirt:
             self.libvirt = Libvirt()
@@ -25,67 +114,58 @@ class Libguestfs(CommandSessionMixin):
             self.libvirt = libvirt
         super(Libguestfs, self).__init__(session or self.libvirt.session)
 
+        self.template_file = template_file
+        self.cache_dir = cache_dir
+        self.catalog = TemplateCatalog(
+            cache_path=os.path.join(cache_dir, 'templates.json') if cache_dir else None,
+            extra_indexes=[template_file] if template_file else (),
+            remote_ttl=catalog_ttl,
+            session=self.session,
+        )
+
     def get_arch(self, os_version):
         """Get the arch for a given os template."""
-
-        cmd = "virt-builder --list |grep {} |awk '{{print $2}}'".format(os_version)
-        out = self.session.check_output(cmd)
-        return out
+        return self.catalog[os_version]['arch']
 
     def list_templates(self):
-        return self.session.check_output(
-            ['virt-builder', '--list']
+        """:returns: virt-builder --list style text"""
+        return '\n'.join(
+            '{:<24}{:<10}{}'.format(name, info[1], info[2])
+            for name, info in (
+                (name, self.get_os_template_info(name))
+                for name in self.catalog.names()
+            )
         )
 
     def check_template_file(self):
         """Check to see if template file is valid.
-        virt-builder will fail if there is a missing image or something.
-        Sometimes it fails with a returncode of 0, sometimes not.  wtf?"""
-        ret, output = self.session._exec(
-            ['virt-builder', '--list']
+        virt-builder will fail if there is a missing image or something,
+        sometimes with a returncode of 0, so check it the same way here.
+        The result is cached until the template file or repos.d changes.
+        """
+        problems = validate_cached(
+            self.template_file,
+            os.path.join(self.cache_dir, 'validated.json') if self.cache_dir else None,
         )
-        # if returncode is nonzero, fail
-        if not ret == 0:
-            return False
-
-        # if returncode is zero, but error is in stdout, fail
-        try:
-            output.index('parse error')
-        except ValueError:
-            return True
-
-        return False
+        for problem in problems:
+            print('{}: {}'.format(self.template_file, problem))
+        return not problems
 
     def template_available(self, os_version):
         """Discover whether or not an os template is available."""
-        """Get the arch for a given os template."""
-        returncode = self.session.call(
-            "virt-builder --list |grep {}".format(os_version)
-        )
-        return returncode==0
+        return os_version in self.catalog
 
     def get_os_template_info(self, template):
-        """Wrapper for virt-builder --list
-        :returns: list [name, arch, description] or None
-        """
-        templates = self.session.check_output(
-            "virt-builder --list"
-        )
-        
-        for row in templates.splitlines():
-            record = row.split()
-            if record[0] == template:
-                return record
+        """:returns: list [name, arch, description] or None"""
+        info = self.catalog.get(template)
+        if info is not None:
+            return [template, info.get('arch', ''), info.get('name', '')]
 
     def get_template(self, image_name, image_desc, arch, image_sz, template_file, csz=None):
-        """TODO: refactor shared functionaity with generate_
-        Add an os template to the template file.
+        """Render an os template record for the template file.
         There are more fields that I am not using, see:
             http://libguestfs.org/virt-builder.1.html#create-the-templates
         """
-        #TODO: write this atomically, so the record can be removed if there
-        # is a problem
-
         template = '\n'.join((
             "[{name}]",
             "name={desc}",
@@ -117,48 +197,24 @@ class Libguestfs(CommandSessionMixin):
         templ = templ + '\n'  # required
         return templ
 
-    def generate_template(self, image_name, image_desc, arch, image_sz, template_file, csz=None):
+    def generate_template(self, image_name, image_desc, arch, image_sz, template_file, csz=None, replace=False):
         """Add an os template to the template file.
-        There are more fields that I am not using, see:
-            http://libguestfs.org/virt-builder.1.html#create-the-templates
+        The record is validated before it is written, and the file is
+        replaced atomically, see `TemplateWriter`.
         """
-        #TODO: write this atomically, so the record can be removed if there
-        # is a problem
-
-        template = '\n'.join((
-            "[{name}]",
-            "name={desc}",
-            "arch={arch}",
-            "file={path}",
-            "format={fmt}",
-            "size={size}",
-            #TODO is this always the same? what are the preconditions?
-            "expand={expand}"
-        ))
-        if csz:
-            template = template + "\ncompressed_size={csize}"
-        template = template + '\n'
-
-        image_path = self.libvirt.disk_path(image_name)
-        #TODO: can use qemu-img info <path> to get this info
-        #image_sz = os.stat(os.path.join(image_path)).st_size
-
-        with open(template_file, 'a') as fh:
-            fh.write(template.format(
-                name = image_name, 
-                desc = image_desc,
-                arch = arch, 
-                # this is expected to be a path *relative* to this file
-                path = '{}.qcow2{}'.format(image_name, '.xz' if csz else ''), 
-                fmt = 'qcow2',
-                size = image_sz,
-                csize = csz,
-                expand = '/dev/vda3',
-            ))
-            fh.write('\n')  # required
+        templ = self.get_template(
+            image_name, image_desc, arch, image_sz, template_file, csz=csz
+        )
+        try:
+            TemplateWriter(template_file).write(image_name, templ, replace=replace)
+        except ValueError as ex:
+            raise RuntimeError('Template corrupt, image file may be bad: {}'.format(ex))
 
-        if not self.check_template_file():
-            raise RuntimeError('Template corrupt, image file may be bad')
+    def remove_template(self, image_name, template_file=None):
+        """Remove an os template from the template file.
+        :returns: True if it was there
+        """
+        return TemplateWriter(template_file or self.template_file).remove(image_name)
 
     def delete_cache(self, template=None):
         """Delete a template from the cache"""
@@ -170,24 +226,105 @@ class Libguestfs(CommandSessionMixin):
         :param operations: list of sysprep ops
         :param image_name: the image to operate upon
         """
+        return self._virt_sysprep(
+            operations,
+            os.path.join(
+                self.libvirt.images_dir, 
+                '{}.qcow2'.format(image_name)
+            )
+        )
+
+    def _virt_sysprep(self, operations, img_path):
         if not operations:
             return True
 
         args = [
-            '--operations', ' '.join(operations),
+            # virt-sysprep operation names use dashes
+            '--operations', ','.join(op.replace('_', '-') for op in operations),
+            '-a', img_path,
         ]
 
-        args.extend([
-            '-a', os.path.join(
-                self.libvirt.images_dir, 
-                '{}.qcow2'.format(image_name)
-            )
-        ])
-
         cmd = ['virt-sysprep']
         cmd.extend(args)
         return self.session.call(cmd) == 0
 
+    def finalize(self, img_path, operations=(), run=(), trim=True):
+        """Sysprep, customize and sparsify an image.
+
+        With the guestfs python bindings, this is one appliance session:
+        the image is opened once, `operations` and `run` commands are
+        applied, and free space is trimmed (or zeroed, where trim is not
+        supported). Without them, it falls back to virt-sparsify and
+        virt-sysprep, which boot an appliance each.
+        :param operations: virt-sysprep operation names
+        :param run: shell commands to run in the guest
+        :returns: PipelineStats
+        """
+        stats = PipelineStats(os.path.basename(img_path))
+        operations = [op.replace('_', '-') for op in operations]
+
+        if guestfs is not None:
+            stats.engine = 'guestfs'
+            leftover = self._finalize_guestfs(img_path, operations, run, trim, stats)
+        else:
+            stats.engine = 'cli'
+            if trim:
+                self.virt_sparsify(img_path)
+                stats.launches += 1
+            leftover = operations
+            for cmd in run:
+                self.session.check_call([
+                    'virt-customize', '-a', img_path, '--run-command', cmd
+                ])
+                stats.launches += 1
+
+        if leftover:
+            self._virt_sysprep(leftover, img_path)
+            stats.launches += 1
+
+        print(stats)
+        return stats
+
+    def _finalize_guestfs(self, img_path, operations, run, trim, stats):
+        """Apply the finalize pipeline through one guestfs handle.
+        :returns: list of operations that must still go to virt-sysprep
+        """
+        g = guestfs.GuestFS(python_return_dict=True)
+        g.add_drive_opts(img_path, format='qcow2', readonly=False, discard='besteffort')
+        g.launch()
+        stats.launches += 1
+        try:
+            roots = g.inspect_os()
+            if not roots:
+                raise RuntimeError('no operating system found in {}'.format(img_path))
+            mountpoints = g.inspect_get_mountpoints(roots[0])
+            for mp in sorted(mountpoints, key=len):
+                g.mount(mountpoints[mp], mp)
+
+            leftover = []
+            for op in operations:
+                if op in GUESTFS_SYSPREP:
+                    GUESTFS_SYSPREP[op](g)
+                else:
+                    leftover.append(op)
+
+            for cmd in run:
+                g.sh(cmd)
+
+            if trim:
+                for mp in sorted(mountpoints, key=len, reverse=True):
+                    try:
+                        g.fstrim(mp)
+                    except RuntimeError:
+                        g.zero_free_space(mp)
+
+            g.umount_all()
+            g.shutdown()
+        finally:
+            g.close()
+
+        return leftover
+
     def virt_build(self, img_name, base_image, *flags, **params):
         """Run virt-builder to create a disk image using appropriate os base.
         :param flags, kwargs: extra arguments to pass to virt-builder
@@ -214,6 +351,126 @@ class Libguestfs(CommandSessionMixin):
         #return True
         return self.session.check_call(cmd) == 0
 
+    def template_identity(self, base_os):
+        """Short hash of what the catalog says a template is: its
+        revision, checksum, file and index, and the size and mtime of a
+        local template's image. It changes when the template is
+        re-downloaded, repackaged or installed again under the same name.
+        """
+        info = self.catalog.get(base_os) or {}
+        identity = dict(
+            (k, v) for k, v in info.items()
+            if k in _TEMPLATE_IDENTITY or k.startswith('checksum')
+        )
+        if info.get('index') and info.get('file'):
+            image = os.path.join(os.path.dirname(info['index']), info['file'])
+            if os.path.exists(image):
+                st = os.stat(image)
+                identity['image'] = [st.st_size, int(st.st_mtime)]
+        canonical = json.dumps(identity, sort_keys=True)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:12]
+
+    def base_path(self, base_os, identity=None):
+        """Path of the read-only backing image for a base template, as
+        it is now; see `template_identity`.
+        """
+        return os.path.join(
+            self.libvirt.images_dir, '_base', '{}-{}.qcow2'.format(
+                base_os, identity or self.template_identity(base_os)
+            )
+        )
+
+    def base_paths(self, base_os):
+        """Every backing image written for a base template, current or not."""
+        pattern = re.compile(r'^{}-[0-9a-f]{{12}}\.qcow2$'.format(re.escape(base_os)))
+        base_dir = os.path.join(self.libvirt.images_dir, '_base')
+        if not os.path.isdir(base_dir):
+            return []
+        return sorted(
+            os.path.join(base_dir, name) for name in os.listdir(base_dir)
+            if pattern.match(name)
+        )
+
+    def materialize_base(self, base_os):
+        """Write a base template out once, uncompressed and read-only,
+        for linked clones to use as their backing file. A template that
+        changed in the catalog gets a new backing image; the old one is
+        left for the clones built on it, see `Hobo._retire_bases`.
+        :returns: path of the backing image
+        """
+        path = self.base_path(base_os)
+        mkdir_all(os.path.dirname(path))
+        with file_lock(path + '.lock'):
+            if os.path.exists(path):
+                return path
+
+            partial = path + '.partial'
+            if os.path.exists(partial):
+                os.remove(partial)
+            cmd = [
+                'virt-builder', base_os,
+                '--network',
+                '--format', 'qcow2',
+                '--output', partial,
+            ]
+            self.session.check_call(cmd)
+            os.chmod(partial, 0o444)
+            os.rename(partial, path)
+        return path
+
+    def layer_path(self, digest):
+        """Path of a cached customization layer."""
+        return os.path.join(
+            self.libvirt.images_dir, '_layers', '{}.qcow2'.format(digest)
+        )
+
+    def create_overlay(self, img_path, backing):
+        """Create a thin qcow2 disk on top of a backing image."""
+        if os.path.exists(img_path):
+            raise ValueError('error: disk {} already exists'.format(img_path))
+
+        cmd = [
+            'qemu-img', 'create',
+            '-f', 'qcow2',
+            '-F', 'qcow2',
+            '-b', backing,
+            img_path,
+        ]
+        return self.session.check_call(cmd) == 0
+
+    def convert(self, src_path, img_path):
+        """Write a standalone copy of an image and its backing chain."""
+        if os.path.exists(img_path):
+            raise ValueError('error: disk {} already exists'.format(img_path))
+
+        cmd = ['qemu-img', 'convert', '-O', 'qcow2', src_path, img_path]
+        return self.session.check_call(cmd) == 0
+
+    def flatten(self, img_name):
+        """Copy all data from a disk's backing chain into the disk itself,
+        so it no longer depends on its backing image.
+        """
+        cmd = [
+            'qemu-img', 'rebase',
+            '-f', 'qcow2',
+            '-b', '',
+            self.libvirt.disk_path(img_name),
+        ]
+        return self.session.check_call(cmd) == 0
+
+    def virt_customize(self, img_path, *flags, **params):
+        """Run virt-customize on an existing disk image.
+        :param flags, kwargs: extra arguments to pass to virt-customize
+        """
+        args = self.session.unpack_args(*flags, **params)
+        args.extend([
+            '--format', 'qcow2',
+            '-a', img_path,
+        ])
+        cmd = ['virt-customize']
+        cmd.extend(args)
+        return self.session.check_call(cmd) == 0
+
     def virt_import(self, domain_name, img_name, *flags, **params):
         """Run virt-install --import to create a domain based on an image."""
         args = self.session.unpack_args(*flags, **params)
@@ -233,7 +490,10 @@ class Libguestfs(CommandSessionMixin):
         ])
         cmd = ['virt-install', '-d', '--import']
         cmd.extend(args)
-        return self.session.check_call(cmd) == 0
+        try:
+            return self.session.check_call(cmd) == 0
+        finally:
+            self.libvirt.refresh()
 
     def virt_sparsify(self, img_path):
         """Sparsify an image
@@ -249,22 +509,486 @@ class NotBooted(Exception):
     pass
 
 
-class Domain(CommandSessionMixin):
+DomainInfo = namedtuple('DomainInfo', ['id', 'name', 'state', 'interfaces'])
+Interface = namedtuple('Interface', ['name', 'type', 'source', 'model', 'mac'])
+
+# separates per-domain output of a batched virsh command string
+_VIRSH_MARKER = '@@hobo@@'
 
-    def __init__(self, name, bridge_device, session=None):
-        super(Domain, self).__init__(session)
+
+class DomainError(RuntimeError):
+    """A libvirt operation on a domain failed."""
+
+
+class DomainTable(object):
+    """Immutable snapshot of every domain known to libvirt.
+    Built by `Libvirt.snapshot()`, indexed by domain name.
+    """
+    __slots__ = ('_domains', 'taken')
+
+    def __init__(self, domains, taken=None):
+        object.__setattr__(self, '_domains', dict((d.name, d) for d in domains))
+        object.__setattr__(self, 'taken', taken or time.time())
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DomainTable is immutable')
+
+    def __getitem__(self, name):
+        return self._domains[name]
+
+    def __contains__(self, name):
+        return name in self._domains
+
+    def __iter__(self):
+        return iter(sorted(self._domains))
+
+    def __len__(self):
+        return len(self._domains)
+
+    def get(self, name, default=None):
+        return self._domains.get(name, default)
+
+    def values(self):
+        return [self._domains[name] for name in self]
+
+
+def parse_virsh_list(output):
+    """Parse `virsh list --all` into (id, name, state) tuples."""
+    rows = []
+    for row in output.splitlines()[2:]:
+        fields = row.split(None, 2)
+        if len(fields) < 3:
+            continue
+        rows.append(tuple(fields))
+    return rows
+
+
+def parse_virsh_domiflist(output):
+    """Parse `virsh domiflist <domain>` into a tuple of Interfaces."""
+    interfaces = []
+    for row in output.splitlines():
+        fields = row.split()
+        if len(fields) != 5 or fields[0] == 'Interface':
+            continue
+        interfaces.append(Interface(*fields))
+    return tuple(interfaces)
+
+
+class VirshBackend(object):
+    """Domains through virsh, parsing its text output.
+    :param libvirt: the owning `Libvirt`, whose `virsh` runs commands
+    """
+    name = 'virsh'
+    tracker = None
+
+    def __init__(self, libvirt):
+        self.libvirt = libvirt
+
+    def list_domains(self):
+        """One `virsh list --all` and one batched `domiflist`.
+        :returns: list of DomainInfo
+        """
+        rows = parse_virsh_list(
+            self.libvirt.virsh.check_output(['list', '--all'])
+        )
+        outputs = self.libvirt.virsh_batch("domiflist {}", [row[1] for row in rows])
+        return [
+            DomainInfo(id, name, state, parse_virsh_domiflist(outputs.get(name, '')))
+            for id, name, state in rows
+        ]
+
+    def interface_addresses(self, names, source='lease'):
+        """:returns: dict of lowercase mac to ipv4, for the given domains"""
+        found = {}
+        outputs = self.libvirt.virsh_batch(
+            "domifaddr {} --source " + source, names
+        )
+        for output in outputs.values():
+            found.update(parse_domifaddr(output))
+        return found
+
+    def _run(self, command, name):
+        try:
+            self.libvirt.virsh.check_call([command, name])
+        except CommandError as ex:
+            raise DomainError('{} {}: {}'.format(command, name, ex.output))
+
+    def start(self, name):
+        self._run('start', name)
+
+    def shutdown(self, name):
+        self._run('shutdown', name)
+
+    def destroy(self, name):
+        self._run('destroy', name)
+
+    def undefine(self, name):
+        self._run('undefine', name)
+
+    def run_many(self, command, names):
+        """Run start, shutdown, destroy or undefine on many domains, in
+        one virsh invocation. Failures are ignored.
+        """
+        self.libvirt.virsh_batch(command + " {}", names)
+
+    def close(self):
+        self.libvirt.virsh.close()
+
+
+# virDomainState, as virsh prints it
+_PYTHON_STATES = {
+    0: 'no state',
+    1: 'running',
+    2: 'idle',
+    3: 'paused',
+    4: 'in shutdown',
+    5: 'shut off',
+    6: 'crashed',
+    7: 'pmsuspended',
+}
+
+# virDomainInterfaceAddressesSource
+_PYTHON_ADDR_SOURCES = {'lease': 0, 'agent': 1, 'arp': 2}
+
+
+def parse_interfaces_xml(xml):
+    """Interfaces from a domain's XML, as `virsh domiflist` shows them.
+    :returns: tuple of Interfaces
+    """
+    from xml.etree import ElementTree
+    interfaces = []
+    for iface in ElementTree.fromstring(xml).findall('./devices/interface'):
+        def attr(tag, *names):
+            node = iface.find(tag)
+            for name in names:
+                if node is not None and node.get(name):
+                    return node.get(name)
+            return '-'
+        interfaces.append(Interface(
+            attr('target', 'dev'),
+            iface.get('type', '-'),
+            attr('source', 'bridge', 'network', 'dev'),
+            attr('model', 'type'),
+            attr('mac', 'address'),
+        ))
+    return tuple(interfaces)
+
+
+class LazyInterfaces(object):
+    """A domain's interfaces, read from its XML on first use, so a
+    listing costs no per-domain XMLDesc unless interfaces are wanted.
+    """
+    def __init__(self, dom):
+        self._dom = dom
+        self._interfaces = None
+
+    def _load(self):
+        if self._interfaces is None:
+            self._interfaces = parse_interfaces_xml(self._dom.XMLDesc(0))
+        return self._interfaces
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+# virDomainEventType, as the state a domain is in after the event
+_LIFECYCLE_STATES = {
+    0: None,            # defined; state unchanged, or shut off if new
+    1: 'undefined',
+    2: 'running',       # started
+    3: 'paused',        # suspended
+    4: 'running',       # resumed
+    5: 'shut off',      # stopped
+    6: 'in shutdown',   # shutdown
+    7: 'pmsuspended',
+    8: 'crashed',
+}
+
+# states a domain is no longer using its disk in
+_STOPPED_STATES = (None, 'shut off', 'crashed', 'undefined')
+
+# virConnectDomainEventAgentLifecycleState
+_AGENT_CONNECTED = 1
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def start_event_loop():
+    """Register libvirt's default event loop implementation and run it
+    in a daemon thread, once per process. Must happen before any
+    connection that wants events is opened.
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            libvirt_api.virEventRegisterDefaultImpl()
+
+            def run():
+                while True:
+                    libvirt_api.virEventRunDefaultImpl()
+
+            _event_loop = threading.Thread(target=run, name='libvirt-events')
+            _event_loop.daemon = True
+            _event_loop.start()
+    return _event_loop
+
+
+class StateTracker(object):
+    """In-memory table of domain states, kept current by libvirt
+    lifecycle and guest agent events rather than by polling.
+
+    Every change is kept, so each domain has a timeline of
+    (time, state) transitions, including changes hobo did not make.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._timelines = defaultdict(list)
+        self._agents = {}
+        self._callbacks = []
+        # bumped on every change, see wait_changed
+        self.generation = 0
+
+    def attach(self, conn):
+        """Subscribe to `conn`'s domain events, then record the current
+        state of every domain not already heard from.
+        """
+        self._callbacks = [
+            conn.domainEventRegisterAny(
+                None, libvirt_api.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self.handle_lifecycle, None
+            ),
+            conn.domainEventRegisterAny(
+                None, libvirt_api.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE,
+                self.handle_agent, None
+            ),
+        ]
+        for dom in conn.listAllDomains(0):
+            if dom.name() not in self._timelines:
+                self.record(dom.name(), _PYTHON_STATES.get(dom.state()[0], 'no state'))
+
+    def detach(self, conn):
+        for callback in self._callbacks:
+            try:
+                conn.domainEventDeregisterAny(callback)
+            except libvirt_api.libvirtError:
+                pass
+        self._callbacks = []
+
+    def record(self, name, state, when=None):
+        """Add a transition to a domain's timeline, if its state changed."""
+        with self._cond:
+            timeline = self._timelines[name]
+            if not timeline or timeline[-1][1] != state:
+                timeline.append((when or time.time(), state))
+                self.generation += 1
+            self._cond.notify_all()
+
+    def handle_lifecycle(self, conn, dom, event, detail, opaque):
+        name = dom.name()
+        state = _LIFECYCLE_STATES.get(event)
+        if state is None:
+            if event != 0 or self.state(name) not in (None, 'undefined'):
+                return
+            state = 'shut off'
+        self.record(name, state)
+
+    def handle_agent(self, conn, dom, state, reason, opaque):
+        with self._cond:
+            self._agents[dom.name()] = state == _AGENT_CONNECTED
+            self.generation += 1
+            self._cond.notify_all()
+
+    def __contains__(self, name):
+        with self._cond:
+            return bool(self._timelines.get(name))
+
+    def state(self, name):
+        """:returns: the domain's latest known state, or None"""
+        with self._cond:
+            timeline = self._timelines.get(name)
+            return timeline[-1][1] if timeline else None
+
+    def timeline(self, name):
+        """:returns: list of (time, state) transitions, oldest first"""
+        with self._cond:
+            return list(self._timelines.get(name, ()))
+
+    def was(self, name, state):
+        return state in [s for _, s in self.timeline(name)]
+
+    def agent_connected(self, name):
+        """:returns: True or False once the guest agent was heard from,
+        else None
+        """
+        with self._cond:
+            return self._agents.get(name)
+
+    def wait_changed(self, generation, timeout=None):
+        """Block until anything changes after `generation`.
+        :returns: the current generation
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self.generation == generation:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self.generation
+
+    def wait_for(self, name, state, timeout=None):
+        """Block until the domain reaches `state`.
+        :returns: True, or False on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                timeline = self._timelines.get(name)
+                if timeline and timeline[-1][1] == state:
+                    return True
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+
+
+class PythonBackend(object):
+    """Domains through the libvirt python bindings, over one connection.
+    Domains and their states are listed with a single `getAllDomainStats`;
+    interfaces are read per domain only when looked at, see
+    `LazyInterfaces`. With `events`, domain states are tracked from
+    libvirt events, see `StateTracker`.
+    :param uri: libvirt uri, the default connection if None
+    """
+    name = 'python'
+
+    def __init__(self, libvirt, uri=None, events=False):
+        if libvirt_api is None:
+            raise ValueError('the python libvirt backend requires the libvirt module')
+        self.libvirt = libvirt
+        self.tracker = None
+        if events:
+            start_event_loop()
+        self.conn = libvirt_api.open(uri)
+        if events:
+            self.tracker = StateTracker()
+            self.tracker.attach(self.conn)
+
+    def list_domains(self):
+        """:returns: list of DomainInfo"""
+        stats = self.conn.getAllDomainStats(libvirt_api.VIR_DOMAIN_STATS_STATE, 0)
+        return [
+            DomainInfo(
+                # ID() and name() are kept client-side, not RPCs
+                str(dom.ID()) if dom.ID() >= 0 else '-',
+                dom.name(),
+                _PYTHON_STATES.get(record.get('state.state'), 'no state'),
+                LazyInterfaces(dom),
+            )
+            for dom, record in stats
+        ]
+
+    def interface_addresses(self, names, source='lease'):
+        """:returns: dict of lowercase mac to ipv4, for the given domains"""
+        found = {}
+        for name in names:
+            try:
+                dom = self.conn.lookupByName(name)
+                if not dom.isActive():
+                    continue
+                addresses = dom.interfaceAddresses(_PYTHON_ADDR_SOURCES[source], 0)
+            except libvirt_api.libvirtError:
+                continue
+            for iface in (addresses or {}).values():
+                for addr in iface.get('addrs') or []:
+                    if addr.get('type') == libvirt_api.VIR_IP_ADDR_TYPE_IPV4 and iface.get('hwaddr'):
+                        found[iface['hwaddr'].lower()] = addr['addr']
+        return found
+
+    def _run(self, command, name):
+        try:
+            dom = self.conn.lookupByName(name)
+            if command == 'start':
+                dom.create()
+            else:
+                getattr(dom, command)()
+        except libvirt_api.libvirtError as ex:
+            raise DomainError('{} {}: {}'.format(command, name, ex))
+
+    def start(self, name):
+        self._run('start', name)
+
+    def shutdown(self, name):
+        self._run('shutdown', name)
+
+    def destroy(self, name):
+        self._run('destroy', name)
+
+    def undefine(self, name):
+        self._run('undefine', name)
+
+    def run_many(self, command, names):
+        """Run start, shutdown, destroy or undefine on many domains.
+        Failures are ignored.
+        """
+        for name in names:
+            try:
+                self._run(command, name)
+            except DomainError:
+                pass
+
+    def close(self):
+        if self.tracker:
+            self.tracker.detach(self.conn)
+        self.conn.close()
+
+
+BACKENDS = {
+    'virsh': VirshBackend,
+    'python': PythonBackend,
+}
+
+
+class Domain(CommandSessionMixin):
+    """A libvirt domain.
+    State and interfaces are read from the owning `Libvirt`'s snapshot;
+    methods that change the domain's state invalidate that snapshot.
+    When the backend tracks libvirt events, state and its history come
+    from the `StateTracker` instead.
+    """
+
+    def __init__(self, name, libvirt):
+        super(Domain, self).__init__(libvirt.session)
         self.name = name
+        self.libvirt = libvirt
+        self.tracker = libvirt.backend.tracker
         if not self.exists:
             raise ValueError('invalid domain name')
-        self.states = [(time.time(), self.state)]
+        self._states = [(time.time(), self.state)]
         #TODO; this does not belong here
-        self.bridge_device = bridge_device
+        self.bridge_device = libvirt.bridge_device
 
     def stop(self):
         """Check if a domain is running."""
         if self.running:
-            cmd = ['virsh', 'shutdown', self.name]
-            self.session.check_call(cmd)
+            self.libvirt.backend.shutdown(self.name)
+            self.libvirt.refresh()
 
         # update state if no error occurred
         self._update_state()
@@ -272,8 +996,8 @@ class Domain(CommandSessionMixin):
     def start(self):
         """Check if a domain is running."""
         if not self.running:
-            cmd = ['virsh', 'start', self.name]
-            self.session.check_call(cmd)
+            self.libvirt.backend.start(self.name)
+            self.libvirt.refresh()
 
         # update state if no error occurred
         self._update_state()
@@ -283,13 +1007,24 @@ class Domain(CommandSessionMixin):
         if self.running:
             self.stop()
 
-        cmd = ['virsh', 'undefine', self.name]
-        self.session.check_call(cmd)
+        self.libvirt.backend.undefine(self.name)
+        self.libvirt.refresh()
         self._update_state('undefined')
 
+    @property
+    def states(self):
+        """Timeline of (time, state) transitions, oldest first."""
+        if self.tracker:
+            return self.tracker.timeline(self.name)
+        return self._states
+
     def _update_state(self, state=None):
-        """Update state table with given state or current state."""
-        self.states.append((
+        """Update state table with given state or current state.
+        Tracked domains are updated by libvirt events instead.
+        """
+        if self.tracker:
+            return
+        self._states.append((
             time.time(), state or self.state
         ))
 
@@ -300,17 +1035,29 @@ class Domain(CommandSessionMixin):
         ]
 
     def ping(self):
-        return self.session.call('ping {}'.format(
-            self.ip_address
-        )) == 0
+        """Send one ping, waiting at most a second for the reply."""
+        ip = self.ip_address
+        if not ip:
+            return False
+        return self.session.call(['ping', '-c', '1', '-W', '1', ip]) == 0
+
+    def wait_ready(self, port=22, timeout=300):
+        """Block until the domain accepts ssh on `port`.
+        :returns: True, or False on timeout
+        """
+        return self.libvirt.wait_ready([self], port, timeout)[self.name] is not None
+
+    @property
+    def info(self):
+        """This domain's row in the current snapshot."""
+        return self.libvirt.snapshot()[self.name]
 
     @property
     def state(self):
         """Get current state."""
-        cmd = "virsh list --all | grep {}".format(self.name)
-        output = self.session.check_output(cmd)
-        # assume the domain exists
-        return ' '.join(output.split()[2:])
+        if self.tracker and self.name in self.tracker:
+            return self.tracker.state(self.name)
+        return self.info.state
 
     @property
     def stopped(self):
@@ -323,15 +1070,15 @@ class Domain(CommandSessionMixin):
     @property
     def exists(self):
         """Check if a domain is created."""
-        cmd = "virsh list --all | grep {}".format(self.name)
-        return self.session.check_call(cmd) == 0
+        if self.tracker and self.name in self.tracker:
+            return self.tracker.state(self.name) != 'undefined'
+        return self.name in self.libvirt.snapshot()
 
     @property
     def booted(self):
         """See if a domain has booted yet, by checking if it's available
         on the network.
         """
-        #DONTUSE
         if self.ping():
             return True
 
@@ -347,15 +1094,11 @@ class Domain(CommandSessionMixin):
 
     @property
     def mac_address(self):
-        """Get the mac address of a domain.
-        TODO: suppress the priting of the mac address when stream=True,
-        or at least add a newline or something. This is called in a long loop .
-        """
-        cmd = "virsh domiflist {} |grep {} |awk '{{print $5}}' |perl -pe 'chomp'".format(
-            self.name, self.bridge_device
-        )
-
-        return self.session.check_output(cmd)
+        """Get the mac address of a domain's interface on the bridge."""
+        for iface in self.info.interfaces:
+            if iface.source == self.bridge_device:
+                return iface.mac
+        return ''
 
     @property
     def ip_address(self):
@@ -365,16 +1108,19 @@ class Domain(CommandSessionMixin):
         #if not self.booted:
         #    raise NotBooted
 
-        mac = self.mac_address
-        # if we don't have the domain's mac address in local arp cache,
-        # try to populate the arp cache.  if it's still not cached.
-        # assume the domain's network iface is not up yet.
-        if not mac_in_arp_cache(mac):
-            populate_arp_cache()
+        return self.libvirt.resolve_ips([self])[self.name] or ''
 
-        cmd = "arp -an |grep {} |awk '{{print $2}}' |sed 's/[()]//g' |perl -pe 'chomp'".format(mac)
-        return self.session.check_output(cmd)
-        
+    def wait_for_ip(self, timeout=None):
+        """Block until the domain's mac shows up in the bridge's
+        neighbour table, without polling.
+        :returns: the ip, or None on timeout
+        """
+        mac = self.mac_address
+        if not mac:
+            raise ValueError('domain {} has no interface on {}'.format(
+                self.name, self.bridge_device
+            ))
+        return self.libvirt.neighbours.wait_for(mac, timeout)
 
     def Qsetcpu(self, cpu):
         #stub
@@ -403,25 +1149,126 @@ class Domain(CommandSessionMixin):
 
 class Libvirt(CommandSessionMixin):
 
-    def __init__(self, bridge_device, images_dir=None, session=None):
+    def __init__(self, bridge_device, images_dir=None, session=None,
+                 resolvers=DEFAULT_RESOLVERS, resolver_ttl=30, virsh='exec', uri=None,
+                 backend='virsh', events=False):
         super(Libvirt, self).__init__(session)
+        # how virsh commands are run, see hobo.virsh
+        self.virsh = get_virsh(virsh, self.session, uri=uri)
+        # how domains are listed and controlled, see BACKENDS
+        try:
+            backend_class = BACKENDS[backend]
+        except KeyError:
+            raise ValueError('unknown libvirt backend {}'.format(backend))
+        if backend == 'virsh':
+            self.backend = backend_class(self)
+        else:
+            self.backend = backend_class(self, uri, events=events)
         self.images_dir = images_dir or LIBVIRT_IMAGES_DIR
         if not os.path.exists(self.images_dir):
             mkdir_all(self.images_dir)
         self.bridge_device = bridge_device
+        self._snapshot = None
+        self.resolver = get_resolver(resolvers, self, ttl=resolver_ttl)
+
+    def snapshot(self, refresh=False):
+        """Get a table of all domains, their states and interfaces.
+        The table is built with the backend's bulk listing, e.g. a single
+        `virsh list --all` and a single batched `domiflist`, and is
+        reused until `refresh()` is called.
+        :returns: DomainTable
+        """
+        if self._snapshot is None or refresh:
+            self._snapshot = self._take_snapshot()
+        return self._snapshot
+
+    def refresh(self):
+        """Drop the current snapshot; the next lookup re-reads libvirt."""
+        self._snapshot = None
+
+    def _take_snapshot(self):
+        return DomainTable(self.backend.list_domains())
+
+    def virsh_batch(self, command, names):
+        """Run a virsh command once per domain, in a single virsh invocation.
+        :param command: virsh command string with a `{}` for the domain
+            name, which is quoted for virsh
+        :returns: dict of domain name to that command's output
+        """
+        if not names:
+            return {}
+
+        cmds = []
+        for name in names:
+            cmds.append("echo {} {}".format(_VIRSH_MARKER, quote(name)))
+            cmds.append(command.format(quote(name)))
+        # a vanished domain makes virsh return nonzero, but the
+        # output for every other domain is still good.
+        _, output = self.virsh.run_line(' ; '.join(cmds))
+
+        chunks = {}
+        current = None
+        for line in output.splitlines():
+            if line.startswith(_VIRSH_MARKER):
+                current = line[len(_VIRSH_MARKER):].strip()
+                chunks[current] = []
+            elif current is not None:
+                chunks[current].append(line)
+
+        return dict(
+            (name, '\n'.join(lines)) for name, lines in chunks.items()
+        )
+
+    @cached_property
+    def neighbours(self):
+        """Neighbour table watcher for the bridge, started on first use."""
+        return NeighbourWatcher(self.bridge_device).start()
+
+    def resolve_ips(self, domains):
+        """Find the ips of many domains at once, through the resolver chain.
+        :returns: dict of domain name to ip, or to None if not found
+        """
+        wanted = dict(
+            (dom.mac_address, dom.name) for dom in domains if dom.mac_address
+        )
+        found = self.resolver.resolve(wanted)
+        return dict(
+            (dom.name, found.get(dom.mac_address)) for dom in domains
+        )
 
     def get_domain(self, name):
-        return Domain(name, self.bridge_device, session=self.session)
+        return Domain(name, self)
+
+    def wait_ready(self, domains, port=22, timeout=300):
+        """Wait for many domains to accept ssh, probing them all at once;
+        see `hobo.ready`. Ips are looked up again on each attempt until
+        found, so domains still booting can be waited for.
+        :param domains: list of `Domain`
+        :returns: dict of domain name to seconds until ready, or to None
+            if it was not ready within `timeout`
+        :raises: RuntimeError on Python 2, which `hobo.ready` does not support
+        """
+        if six.PY2:
+            raise RuntimeError('waiting for ssh requires Python 3')
+        from hobo.ready import wait_ready, SSH_BANNER
 
-    def get_domains(self, running=True):
-        """Get a list of all current domains."""
-        cmd = ['virsh', 'list']
-        if not running:
-            cmd.append('--all')
+        def address(domain):
+            return lambda: self.resolve_ips([domain])[domain.name]
+
+        return wait_ready(
+            dict((domain.name, address(domain)) for domain in domains),
+            port=port, timeout=timeout, banner=SSH_BANNER
+        )
 
-        ret = self.session.check_output(cmd)
-        data = [row.split() for row in ret.split('\n')[2:] if row]
-        return data
+    def get_domains(self, running=True):
+        """Get a list of all current domains.
+        :returns: list of [id, name, state words...], as `virsh list` rows
+        """
+        return [
+            [info.id, info.name] + info.state.split()
+            for info in self.snapshot().values()
+            if info.id != '-' or not running
+        ]
 
     def check_perms(self):
         """Check if user can access libvirt images directory.
@@ -447,12 +1294,73 @@ class Libvirt(CommandSessionMixin):
     def delete_disk(self, name):
         os.remove(self.disk_path(name))
 
+    def shutdown_many(self, names, timeout=60, poll=0.5, on_stopped=None):
+        """Shut many domains down together: an ACPI shutdown to all of
+        them at once, a shared `timeout` for the guests to power off, then
+        a forced destroy of whichever are still up. Domains are waited on
+        through the backend's state tracker if it has one, else by
+        re-listing every `poll` seconds.
+        :param on_stopped: called with each domain's name as soon as it
+            is off, whether it went gracefully or was forced
+        :returns: list of the names that had to be forced
+        """
+        tracker = self.backend.tracker
+        pending = set(self._active(names))
+        for name in set(names) - pending:
+            if on_stopped: on_stopped(name)
+        self.backend.run_many('shutdown', sorted(pending))
+
+        deadline = time.time() + timeout
+        while pending:
+            generation = tracker.generation if tracker else None
+            active = set(self._active(pending))
+            for name in sorted(pending - active):
+                if on_stopped: on_stopped(name)
+            pending = active
+            remaining = deadline - time.time()
+            if not pending or remaining <= 0:
+                break
+            if tracker:
+                tracker.wait_changed(generation, remaining)
+            else:
+                time.sleep(min(poll, remaining))
+
+        forced = sorted(pending)
+        self.backend.run_many('destroy', forced)
+        for name in forced:
+            if on_stopped: on_stopped(name)
+        self.refresh()
+        return forced
+
+    def _active(self, names):
+        """:returns: those of `names` whose domain is running, paused or
+            shutting down
+        """
+        tracker = self.backend.tracker
+        snapshot = None
+        active = []
+        for name in names:
+            if tracker and name in tracker:
+                if tracker.state(name) not in _STOPPED_STATES:
+                    active.append(name)
+                continue
+            if snapshot is None:
+                snapshot = self.snapshot(refresh=True)
+            if name in snapshot and snapshot[name].id != '-':
+                active.append(name)
+        return active
+
     def undefine_with_prejudice(self, domain):
         """Undefine a domain.
         This functionality exists on Domain obj also, but
         this impl takes a scorched-earth approach.
         """
-        self.session.call(['virsh', 'shutdown', domain])
-        self.session.call(['virsh', 'destroy', domain])
-        self.session.check_call(['virsh', 'undefine', domain])
-        self._update_state('undefined')
+        for stop in (self.backend.shutdown, self.backend.destroy):
+            try:
+                stop(domain)
+            except DomainError:
+                pass
+        try:
+            self.backend.undefine(domain)
+        finally:
+            self.refresh()
@@ -1,11 +1,17 @@
+import os
+import re
+import glob
+import json
+import time
 import fcntl
 import socket
 import struct
+import itertools
+import threading
 import subprocess
 try:
     from subprocess import DEVNULL # py3k
 except ImportError:
-    import os
     DEVNULL = open(os.devnull, 'wb')
 
 def get_hostname():
@@ -17,7 +23,7 @@ def get_netmask(ifname):
     return socket.inet_ntoa(fcntl.ioctl(
         s.fileno(),
         35099,
-        struct.pack('256s', ifname)
+        struct.pack('256s', ifname[:15].encode('ascii'))
     )[20:24])
 
 
@@ -52,16 +58,89 @@ def get_ip_address(ifname):
     return socket.inet_ntoa(fcntl.ioctl(
         s.fileno(),
         0x8915,  # SIOCGIFADDR
-        struct.pack('256s', ifname[:15])
+        struct.pack('256s', ifname[:15].encode('ascii'))
     )[20:24])
 
 
+SYS_NET = '/sys/class/net'
+
+
+def get_ifindex(ifname, sys_net=SYS_NET):
+    """Get the kernel index of an interface; socket.if_nametoindex is
+    py3 only.
+    """
+    with open(os.path.join(sys_net, ifname, 'ifindex')) as fh:
+        return int(fh.read())
+
+
+ARP_TABLE = '/proc/net/arp'
+
+# flags of a resolved entry in /proc/net/arp (ATF_COM)
+_ATF_COM = 0x2
+
+
+def parse_arp_table(text, device=None):
+    """Parse the contents of /proc/net/arp.
+    :param device: only entries on this interface
+    :returns: dict of lowercase mac to ip, complete entries only
+    """
+    index = {}
+    for row in text.splitlines()[1:]:
+        fields = row.split()
+        if len(fields) < 6:
+            continue
+        ip, _, flags, mac = fields[:4]
+        if not int(flags, 16) & _ATF_COM:
+            continue
+        if device and fields[5] != device:
+            continue
+        index[mac.lower()] = ip
+    return index
+
+
+class NeighbourTable(object):
+    """MAC to IP index over the kernel's ARP table.
+    Reading is a single open(); the file is re-parsed only when its
+    content has changed since the last read.
+    """
+    def __init__(self, path=ARP_TABLE):
+        self.path = path
+        self._raw = None
+        self._indexes = {}
+
+    def read(self, device=None):
+        """:param device: only entries on this interface
+        :returns: dict of lowercase mac to ip
+        """
+        with open(self.path, 'rb') as fh:
+            raw = fh.read()
+        if raw != self._raw:
+            self._indexes = {}
+            self._raw = raw
+        if device not in self._indexes:
+            self._indexes[device] = parse_arp_table(
+                raw.decode('ascii', 'replace'), device
+            )
+        return self._indexes[device]
+
+    def resolve(self, macs):
+        index = self.read()
+        return dict((mac, index.get(mac.lower())) for mac in macs)
+
+
+_neighbours = NeighbourTable()
+
+
+def resolve_macs(macs):
+    """Look up any number of macs in the ARP table in one pass.
+    :returns: dict of mac to ip, or to None if the mac is not cached
+    """
+    return _neighbours.resolve(macs)
+
+
 def mac_in_arp_cache(mac):
     """Determine if we know the ip of a given mac."""
-    return bool(not subprocess.call(
-        'arp -an |grep {}'.format(mac),
-        shell=True, stdout=DEVNULL
-    ))
+    return bool(resolve_macs([mac])[mac])
 
 
 def populate_arp_cache(dev='hob0'):
@@ -79,3 +158,428 @@ def populate_arp_cache(dev='hob0'):
         return False
 
     return True
+
+
+def network_hosts(ip, netmask):
+    """Generate every host address of the network `ip` lives in."""
+    def to_int(addr):
+        return struct.unpack('!I', socket.inet_aton(addr))[0]
+
+    mask = to_int(netmask)
+    network = to_int(ip) & mask
+    broadcast = network | (~mask & 0xffffffff)
+    for addr in range(network + 1, broadcast):
+        yield socket.inet_ntoa(struct.pack('!I', addr))
+
+
+def probe_hosts(ips, port=9):
+    """Send one empty UDP datagram to each ip, so the kernel ARPs for it.
+    Nothing is waited for; answers land in the neighbour table.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        for ip in ips:
+            try:
+                sock.sendto(b'', (ip, port))
+            except socket.error:
+                # unreachable, or the send queue is full; skip it
+                pass
+    finally:
+        sock.close()
+
+
+DNSMASQ_LEASES = (
+    '/var/lib/libvirt/dnsmasq/*.leases',
+    '/var/lib/libvirt/dnsmasq/*.status',
+    '/var/lib/misc/dnsmasq.leases',
+    '/var/lib/dhcp/dhcpd.leases',
+    '/var/lib/dhcpd/dhcpd.leases',
+)
+
+_DHCPD_LEASE = re.compile(
+    r'lease\s+([0-9.]+)\s*{([^}]*)}', re.MULTILINE
+)
+_DHCPD_HWADDR = re.compile(r'hardware\s+ethernet\s+([0-9a-fA-F:]+)')
+
+
+def parse_lease_file(text):
+    """Parse a dnsmasq leases file, a libvirt dnsmasq status file or an
+    ISC dhcpd leases file.
+    :returns: dict of lowercase mac to ip; later leases win
+    """
+    leases = {}
+    stripped = text.strip()
+    if stripped.startswith('['):
+        # libvirt's dnsmasq status file
+        for lease in json.loads(stripped):
+            if 'mac-address' in lease and 'ip-address' in lease:
+                leases[lease['mac-address'].lower()] = lease['ip-address']
+
+    elif _DHCPD_LEASE.search(text):
+        for ip, body in _DHCPD_LEASE.findall(text):
+            mac = _DHCPD_HWADDR.search(body)
+            if mac:
+                leases[mac.group(1).lower()] = ip
+
+    else:
+        # <expiry> <mac> <ip> <hostname> <client-id>
+        for row in text.splitlines():
+            fields = row.split()
+            if len(fields) >= 3 and ':' in fields[1]:
+                leases[fields[1].lower()] = fields[2]
+
+    return leases
+
+
+class LeaseFileResolver(object):
+    """Resolve macs from DHCP lease files."""
+    def __init__(self, patterns=DNSMASQ_LEASES):
+        self.patterns = patterns
+
+    def resolve(self, wanted):
+        leases = {}
+        for pattern in self.patterns:
+            for path in sorted(glob.glob(pattern)):
+                try:
+                    with open(path) as fh:
+                        leases.update(parse_lease_file(fh.read()))
+                except (IOError, OSError, ValueError):
+                    continue
+        return dict(
+            (mac, leases[mac.lower()]) for mac in wanted if mac.lower() in leases
+        )
+
+
+class NeighbourResolver(object):
+    """Resolve macs from the kernel neighbour table."""
+    def __init__(self, table=None):
+        self.table = table or _neighbours
+
+    def resolve(self, wanted):
+        found = self.table.resolve(wanted)
+        return dict((mac, ip) for mac, ip in found.items() if ip)
+
+
+class DomifaddrResolver(object):
+    """Resolve macs with `virsh domifaddr --source <source>`, or its
+    equivalent in the libvirt backend. With virsh, all domains are
+    queried in a single invocation.
+    :param libvirt: `hobo.libvirt.Libvirt`
+    :param source: 'lease' (libvirt managed networks) or 'agent'
+        (requires the qemu guest agent)
+    """
+    def __init__(self, libvirt, source='lease'):
+        self.libvirt = libvirt
+        self.source = source
+
+    def resolve(self, wanted):
+        names = sorted(set(wanted.values()))
+        found = self.libvirt.backend.interface_addresses(names, self.source)
+        return dict(
+            (mac, found[mac.lower()]) for mac in wanted if mac.lower() in found
+        )
+
+
+def parse_domifaddr(output):
+    """Parse `virsh domifaddr` into a dict of lowercase mac to ipv4."""
+    found = {}
+    for row in output.splitlines():
+        fields = row.split()
+        if len(fields) == 4 and fields[2] == 'ipv4':
+            found[fields[1].lower()] = fields[3].split('/')[0]
+    return found
+
+
+# one bridge-wide sweep at a time; domains resolved concurrently share
+# the neighbour table it fills
+_sweep_lock = threading.Lock()
+
+
+def _swept(wanted, table, sweep):
+    """Run `sweep()` under the sweep lock, unless a sweep that finished
+    while we waited for the lock already found every wanted mac.
+    """
+    with _sweep_lock:
+        found = NeighbourResolver(table).resolve(wanted)
+        if len(found) == len(wanted):
+            return found
+        return sweep()
+
+
+# a /22; a bigger bridge network is only partly swept
+MAX_PROBE_HOSTS = 1022
+
+
+class ProbeResolver(object):
+    """Resolve macs by making the kernel ARP for candidate addresses.
+
+    Addresses previously seen for the wanted macs are probed first;
+    only if that fails are the bridge's addresses probed, the first
+    `max_hosts` of them. All probes
+    go out at once, then the neighbour table is watched for up to
+    `wait` seconds.
+    """
+    uses_hints = True
+
+    def __init__(self, device, wait=2.0, max_hosts=MAX_PROBE_HOSTS, table=None):
+        self.device = device
+        self.wait = wait
+        self.max_hosts = max_hosts
+        self.table = table or _neighbours
+
+    def resolve(self, wanted, hints=None):
+        """:param hints: dict of mac to an ip it had before"""
+        hints = [hints[mac] for mac in wanted if mac in (hints or {})]
+        if hints:
+            found = self._probe(wanted, hints)
+            if len(found) == len(wanted):
+                return found
+
+        def sweep():
+            hosts = network_hosts(
+                get_ip_address(self.device), get_netmask(self.device)
+            )
+            return self._probe(wanted, itertools.islice(hosts, self.max_hosts))
+        return _swept(wanted, self.table, sweep)
+
+    def _probe(self, wanted, ips):
+        probe_hosts(ips)
+        deadline = time.time() + self.wait
+        while True:
+            found = NeighbourResolver(self.table).resolve(wanted)
+            if len(found) == len(wanted) or time.time() >= deadline:
+                return found
+            time.sleep(0.1)
+
+
+class NmapResolver(object):
+    """Resolve macs with a full nmap sweep of the bridge network."""
+    def __init__(self, device, table=None):
+        self.device = device
+        self.table = table or _neighbours
+
+    def resolve(self, wanted):
+        def sweep():
+            populate_arp_cache(self.device)
+            return NeighbourResolver(self.table).resolve(wanted)
+        return _swept(wanted, self.table, sweep)
+
+
+# resolver name, as used in hobo.ini, to a factory taking a Libvirt
+RESOLVERS = {
+    'lease': lambda libvirt: LeaseFileResolver(),
+    'neighbour': lambda libvirt: NeighbourResolver(),
+    'domifaddr': lambda libvirt: DomifaddrResolver(libvirt, 'lease'),
+    'agent': lambda libvirt: DomifaddrResolver(libvirt, 'agent'),
+    'probe': lambda libvirt: ProbeResolver(libvirt.bridge_device),
+    'nmap': lambda libvirt: NmapResolver(libvirt.bridge_device),
+}
+
+DEFAULT_RESOLVERS = ('lease', 'neighbour', 'domifaddr', 'probe')
+
+
+class ResolverChain(object):
+    """Ask each resolver in turn about the macs still unresolved.
+    Answers are cached for `ttl` seconds.
+    """
+    def __init__(self, resolvers, ttl=30):
+        self.resolvers = resolvers
+        self.ttl = ttl
+        self._cache = {}
+
+    def resolve(self, wanted):
+        """:param wanted: dict of mac to domain name
+        :returns: dict of mac to ip, or to None if no resolver knew it
+        """
+        now = time.time()
+        result = {}
+        pending = {}
+        for mac, name in wanted.items():
+            cached = self._cache.get(mac)
+            if cached and now - cached[1] < self.ttl:
+                result[mac] = cached[0]
+            else:
+                pending[mac] = name
+
+        for resolver in self.resolvers:
+            if not pending:
+                break
+            if getattr(resolver, 'uses_hints', False):
+                # expired answers are still good guesses for a probe
+                hints = dict(
+                    (mac, ip) for mac, (ip, _) in list(self._cache.items())
+                )
+                found = resolver.resolve(pending, hints=hints)
+            else:
+                found = resolver.resolve(pending)
+            for mac, ip in found.items():
+                result[mac] = ip
+                self._cache[mac] = (ip, now)
+                pending.pop(mac, None)
+
+        for mac in pending:
+            result[mac] = None
+        return result
+
+    def invalidate(self, mac=None):
+        if mac:
+            self._cache.pop(mac, None)
+        else:
+            self._cache.clear()
+
+
+def get_resolver(names, libvirt, ttl=30):
+    """Build a ResolverChain from a list of resolver names."""
+    try:
+        resolvers = [RESOLVERS[name.strip()](libvirt) for name in names if name.strip()]
+    except KeyError as ex:
+        raise ValueError('unknown ip resolver {}'.format(ex))
+    return ResolverChain(resolvers, ttl=ttl)
+
+
+# rtnetlink, see <linux/netlink.h>, <linux/rtnetlink.h>, <linux/neighbour.h>
+NETLINK_ROUTE = 0
+RTMGRP_NEIGH = 0x4
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+NDA_DST = 1
+NDA_LLADDR = 2
+# NUD_REACHABLE | NUD_STALE | NUD_DELAY | NUD_PROBE | NUD_NOARP | NUD_PERMANENT
+NUD_VALID = 0x02 | 0x04 | 0x08 | 0x10 | 0x40 | 0x80
+
+_NLMSGHDR = struct.Struct('=IHHII')
+_NDMSG = struct.Struct('=BxxxiHBB')
+_RTATTR = struct.Struct('=HH')
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def parse_neigh_messages(data):
+    """Parse a buffer of rtnetlink neighbour messages.
+    :returns: list of (msg_type, ifindex, nud_state, ip, mac) tuples,
+        for ipv4 entries that carry both an address and a mac
+    """
+    entries = []
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        length, msg_type, _, _, _ = _NLMSGHDR.unpack_from(data, offset)
+        if length < _NLMSGHDR.size:
+            break
+        end = offset + length
+        if msg_type in (RTM_NEWNEIGH, RTM_DELNEIGH):
+            body = offset + _NLMSGHDR.size
+            family, ifindex, state, _, _ = _NDMSG.unpack_from(data, body)
+            attrs = {}
+            pos = body + _NDMSG.size
+            while pos + _RTATTR.size <= end:
+                rta_len, rta_type = _RTATTR.unpack_from(data, pos)
+                if rta_len < _RTATTR.size:
+                    break
+                attrs[rta_type] = data[pos + _RTATTR.size:pos + rta_len]
+                pos += _align(rta_len)
+
+            dst = attrs.get(NDA_DST)
+            lladdr = attrs.get(NDA_LLADDR)
+            if family == socket.AF_INET and dst and lladdr and len(dst) == 4:
+                mac = ':'.join('{:02x}'.format(b) for b in bytearray(lladdr))
+                entries.append(
+                    (msg_type, ifindex, state, socket.inet_ntoa(dst), mac)
+                )
+        offset += _align(length)
+    return entries
+
+
+class NeighbourWatcher(object):
+    """Follow the kernel neighbour table through rtnetlink events, so
+    callers can block until a mac appears instead of polling for it.
+
+    Entries already in the table when the watcher starts count as seen.
+    :param device: only follow entries on this interface, e.g. the bridge
+    :param sock: socket to read netlink messages from; by default a
+        NETLINK_ROUTE socket subscribed to neighbour events
+    """
+    def __init__(self, device=None, sock=None, table=None):
+        self.device = device
+        self.ifindex = None
+        self._sock = sock
+        self._table = table or _neighbours
+        self._known = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self._sock is None:
+            self._sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE
+            )
+            self._sock.bind((0, RTMGRP_NEIGH))
+        if self.device and self.ifindex is None:
+            self.ifindex = get_ifindex(self.device)
+
+        # subscribe first, then seed, so nothing falls in between
+        try:
+            seed = self._table.read(self.device)
+        except (IOError, OSError):
+            seed = {}
+        with self._cond:
+            self._known.update(seed)
+            self._cond.notify_all()
+
+        self._thread = threading.Thread(target=self._run, name='hobo-neigh')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        if self._thread is not None:
+            self._thread.join(1)
+
+    def _run(self):
+        while self._sock is not None:
+            try:
+                data = self._sock.recv(65536)
+            except (socket.error, AttributeError):
+                return
+            if not data:
+                return
+            self.feed(data)
+
+    def feed(self, data):
+        """Apply a buffer of netlink messages and wake any waiters."""
+        with self._cond:
+            for msg_type, ifindex, state, ip, mac in parse_neigh_messages(data):
+                if self.ifindex is not None and ifindex != self.ifindex:
+                    continue
+                if msg_type == RTM_NEWNEIGH and state & NUD_VALID:
+                    self._known[mac] = ip
+                elif self._known.get(mac) == ip:
+                    self._known.pop(mac)
+            self._cond.notify_all()
+
+    def get(self, mac):
+        with self._cond:
+            return self._known.get(mac.lower())
+
+    def wait_for(self, mac, timeout=None):
+        """Block until `mac` has an ip.
+        :returns: the ip, or None if `timeout` seconds passed first
+        """
+        mac = mac.lower()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while mac not in self._known:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self._known[mac]
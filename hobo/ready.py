@@ -0,0 +1,142 @@
+"""Readiness probing: wait for many domains to accept connections.
+
+A domain is ready once a TCP connection to its port succeeds and, for
+ssh, the server has sent its "SSH-" banner; sshd can be listening a
+moment before it answers. Every domain is probed at once on one asyncio
+loop, each backing off exponentially between attempts, under a single
+deadline. Requires Python 3; `Libvirt.wait_ready` refuses to import
+it on Python 2.
+"""
+from __future__ import print_function
+import time
+import asyncio
+import threading
+
+__all__ = ['wait_ready', 'SSH_PORT', 'SSH_BANNER']
+
+SSH_PORT = 22
+SSH_BANNER = b'SSH-'
+
+# seconds between attempts on one domain, doubling from INITIAL_DELAY
+INITIAL_DELAY = 0.1
+MAX_DELAY = 5.0
+CONNECT_TIMEOUT = 2.0
+
+
+async def probe(host, port=SSH_PORT, banner=SSH_BANNER, timeout=CONNECT_TIMEOUT):
+    """One attempt at connecting to `host`.
+    :returns: True if it accepted, and sent `banner` if given
+    """
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        if banner is None:
+            return True
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        return line.startswith(banner)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+
+def _in_thread(loop, func):
+    """Call `func` in a daemon thread.
+    A resolver that blocks past the deadline is abandoned rather than
+    waited for, so neither `wait_ready` nor interpreter exit hangs on it.
+    :returns: future of its result
+    """
+    future = loop.create_future()
+
+    def settle(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run():
+        result, error = None, None
+        try:
+            result = func()
+        except Exception as ex:
+            error = ex
+        try:
+            loop.call_soon_threadsafe(settle, result, error)
+        except RuntimeError:
+            # the loop was closed while we ran
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+async def _wait_one(address, deadline, port, banner, initial, maximum):
+    """Probe one domain until it is ready or the deadline passes.
+    :param address: its ip, or a callable returning the ip or None,
+        called in a daemon thread as resolving may block, and given up
+        on at the deadline
+    :returns: seconds until ready, or None on timeout
+    """
+    loop = asyncio.get_event_loop()
+    start = time.time()
+    delay = initial
+    while True:
+        host = address
+        if callable(address):
+            try:
+                host = await asyncio.wait_for(
+                    _in_thread(loop, address),
+                    max(0, deadline - time.time())
+                )
+            except asyncio.TimeoutError:
+                return None
+        remaining = deadline - time.time()
+        if host and remaining > 0 and await probe(
+                host, port, banner, min(CONNECT_TIMEOUT, remaining)):
+            return time.time() - start
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, maximum)
+
+
+async def _wait_all(addresses, deadline, port, banner, initial, maximum):
+    names = list(addresses)
+    results = await asyncio.gather(*[
+        _wait_one(addresses[name], deadline, port, banner, initial, maximum)
+        for name in names
+    ])
+    return dict(zip(names, results))
+
+
+def wait_ready(addresses, port=SSH_PORT, timeout=300, banner=SSH_BANNER,
+               initial=INITIAL_DELAY, maximum=MAX_DELAY):
+    """Block until every domain accepts connections on `port`, or
+    `timeout` seconds have passed.
+    :param addresses: dict of domain name to ip, or to a callable
+        returning the ip once it is known
+    :param banner: what the server must send first, None to accept any
+        connection
+    :returns: dict of domain name to seconds until ready, or to None if
+        it was not ready in time
+    """
+    if not addresses:
+        return {}
+    deadline = time.time() + timeout
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _wait_all(addresses, deadline, port, banner, initial, maximum)
+        )
+    finally:
+        loop.close()
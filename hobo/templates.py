@@ -0,0 +1,483 @@
+"""virt-builder template indexes.
+
+`TemplateCatalog` answers template lookups from the index files behind
+virt-builder's repos.d sources, parsed in-process and cached on disk,
+instead of forking `virt-builder --list` for each one.
+"""
+import os
+import glob
+import json
+import hashlib
+import time
+import subprocess
+from collections import OrderedDict
+
+try:
+    from configparser import ConfigParser, Error as ConfigParserError
+except ImportError:
+    from ConfigParser import Error as ConfigParserError, SafeConfigParser as ConfigParser #py2 compat
+
+from hobo.util import mkdir_all, file_lock
+
+__all__ = [
+    'TemplateCatalog', 'TemplateWriter', 'parse_index', 'validate_index',
+    'validate_cached', 'IndexParseError',
+]
+
+REPOS_DIRS = (
+    '/etc/virt-builder/repos.d',
+    '/etc/xdg/virt-builder/repos.d',
+    os.path.join(os.path.expanduser('~'), '.config', 'virt-builder', 'repos.d'),
+)
+
+# fields virt-builder needs in every template section
+REQUIRED_FIELDS = ('file', 'arch', 'size')
+
+
+class IndexParseError(ValueError):
+    """A template index could not be parsed."""
+
+
+def _strip_signature(text):
+    """Drop the armor of a cleartext-signed index, if there is one."""
+    if not text.startswith('-----BEGIN PGP SIGNED MESSAGE-----'):
+        return text
+    body = text.split('\n\n', 1)[1] if '\n\n' in text else ''
+    return body.split('-----BEGIN PGP SIGNATURE-----', 1)[0]
+
+
+def parse_index(text):
+    """Parse a virt-builder index.
+    :returns: list of (section name, dict of fields), in file order
+    :raises: IndexParseError
+    """
+    sections = []
+    fields = None
+    key = None
+    for lineno, line in enumerate(_strip_signature(text).splitlines(), 1):
+        if not line.strip() or line.startswith('#'):
+            key = None
+            continue
+        if line.startswith('['):
+            if not line.rstrip().endswith(']'):
+                raise IndexParseError('line {}: bad section header'.format(lineno))
+            fields = {}
+            key = None
+            sections.append((line.strip()[1:-1], fields))
+        elif line[0] in ' \t':
+            if key is None:
+                raise IndexParseError('line {}: continuation of nothing'.format(lineno))
+            fields[key] += '\n' + line.strip()
+        elif '=' in line:
+            if fields is None:
+                raise IndexParseError('line {}: field outside of a section'.format(lineno))
+            key, value = line.split('=', 1)
+            fields[key] = value
+        else:
+            raise IndexParseError('line {}: expected key=value'.format(lineno))
+    return sections
+
+
+def validate_index(text, base_dir=None):
+    """Check an index the way virt-builder would, without running it.
+    :param base_dir: if given, template files must exist relative to it
+    :returns: list of problems, empty if the index is good
+    """
+    try:
+        sections = parse_index(text)
+    except IndexParseError as ex:
+        return ['parse error: {}'.format(ex)]
+
+    problems = []
+    seen = set()
+    for name, fields in sections:
+        ident = (name, fields.get('arch'))
+        if ident in seen:
+            problems.append('[{}]: duplicate template'.format(name))
+        seen.add(ident)
+
+        for field in REQUIRED_FIELDS:
+            if not fields.get(field):
+                problems.append('[{}]: missing {}'.format(name, field))
+        for field in ('size', 'compressed_size'):
+            if field in fields and not fields[field].isdigit():
+                problems.append('[{}]: {} is not a number'.format(name, field))
+        if base_dir and fields.get('file') and '://' not in fields['file'] \
+                and not os.path.exists(os.path.join(base_dir, fields['file'])):
+            problems.append('[{}]: missing image {}'.format(name, fields['file']))
+    return problems
+
+
+def _image_paths(template_file):
+    """Local image files a template file refers to."""
+    try:
+        with open(template_file) as fh:
+            sections = parse_index(fh.read())
+    except (IOError, OSError, IndexParseError):
+        return []
+    base_dir = os.path.dirname(template_file)
+    return [
+        os.path.join(base_dir, fields['file']) for _, fields in sections
+        if fields.get('file') and '://' not in fields['file']
+    ]
+
+
+def _content_key(template_file, repos_dirs):
+    """Hash of the template file, every repos.d config, and the size and
+    mtime of each image the template file refers to.
+    """
+    digest = hashlib.sha1()
+    paths = [template_file]
+    for repos_dir in repos_dirs:
+        paths.extend(sorted(glob.glob(os.path.join(repos_dir, '*.conf'))))
+    for path in paths:
+        digest.update(path.encode('utf-8') + b'\0')
+        try:
+            with open(path, 'rb') as fh:
+                digest.update(fh.read())
+        except (IOError, OSError):
+            digest.update(b'\0missing')
+        digest.update(b'\0')
+    for path in _image_paths(template_file):
+        digest.update('{}\0{}\0'.format(path, _signature(path)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def validate_cached(template_file, cache_path=None, repos_dirs=REPOS_DIRS):
+    """`validate_index` for a template file, remembered in `cache_path`
+    until the template file, its images or the repos.d configs change.
+    :returns: list of problems, empty if the template file is good
+    """
+    key = _content_key(template_file, repos_dirs)
+    cached = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as fh:
+                cached = json.load(fh)
+        except (IOError, OSError, ValueError):
+            pass
+    if cached and cached.get('key') == key:
+        return cached['problems']
+
+    with open(template_file) as fh:
+        problems = validate_index(fh.read(), os.path.dirname(template_file))
+
+    if cache_path:
+        mkdir_all(os.path.dirname(cache_path))
+        tmp = '{}.{}'.format(cache_path, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump({'key': key, 'problems': problems}, fh)
+        os.rename(tmp, cache_path)
+    return problems
+
+
+def section_offsets(text):
+    """Character offsets of each section of an index, comments and
+    blank lines before a section header belonging to the previous
+    section. They index the decoded text, for slicing it; they are not
+    byte offsets into the file once it holds non-ASCII text.
+    :returns: OrderedDict of section name to (start, end)
+    """
+    offsets = OrderedDict()
+    name = None
+    start = pos = 0
+    for line in text.splitlines(True):
+        if line.startswith('['):
+            if name is not None:
+                offsets[name] = (start, pos)
+            name = line.strip()[1:-1]
+            start = pos
+        pos += len(line)
+    if name is not None:
+        offsets[name] = (start, pos)
+    return offsets
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+class TemplateCatalog(object):
+    """All templates virt-builder can see, keyed by os-version.
+
+    Sources with file:// uris are parsed directly. Remote sources are
+    listed with one `virt-builder --list`, reused for `remote_ttl`
+    seconds. The parsed catalog is cached in `cache_path`, and reused for
+    as long as the mtime and size of every source file are unchanged.
+    """
+    def __init__(self, cache_path=None, extra_indexes=(), repos_dirs=REPOS_DIRS,
+                 remote_ttl=86400, session=None):
+        self.session = session
+        self.cache_path = cache_path
+        self.extra_indexes = [os.path.abspath(p) for p in extra_indexes]
+        self.repos_dirs = repos_dirs
+        self.remote_ttl = remote_ttl
+        self.listings = 0
+        self._templates = None
+        self._sources = None
+        # (repos.d signatures, conf signatures, _source_files result)
+        self._parsed = None
+
+    def _source_files(self):
+        """Every file whose change invalidates the catalog, and the
+        local indexes and remote uris named by the repos.d configs.
+        The configs are parsed again only once a repos.d directory or
+        one of them changes.
+        :returns: (conf files, local index paths, remote uris)
+        """
+        dirs = [_signature(repos_dir) for repos_dir in self.repos_dirs]
+        if self._parsed is not None:
+            dir_signatures, conf_signatures, found = self._parsed
+            if dirs == dir_signatures and \
+                    conf_signatures == [_signature(conf) for conf in found[0]]:
+                return found
+
+        confs = []
+        for repos_dir in self.repos_dirs:
+            confs.extend(sorted(glob.glob(os.path.join(repos_dir, '*.conf'))))
+
+        indexes = list(self.extra_indexes)
+        remotes = []
+        for conf in confs:
+            parser = ConfigParser()
+            try:
+                parser.read(conf)
+            except ConfigParserError:
+                continue
+            for section in parser.sections():
+                try:
+                    uri = parser.get(section, 'uri')
+                except ConfigParserError:
+                    continue
+                if uri.startswith('file://'):
+                    # hobo.conf is written as file:///<abspath>
+                    path = '/' + uri[len('file://'):].lstrip('/')
+                    if path not in indexes:
+                        indexes.append(path)
+                else:
+                    remotes.append(uri)
+        found = confs, indexes, remotes
+        self._parsed = (dirs, [_signature(conf) for conf in confs], found)
+        return found
+
+    def _read_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_cache(self, data):
+        if not self.cache_path:
+            return
+        mkdir_all(os.path.dirname(self.cache_path))
+        tmp = '{}.{}'.format(self.cache_path, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump(data, fh)
+        os.rename(tmp, self.cache_path)
+
+    def _remote_fresh(self, cached, remotes):
+        return bool(cached) and cached.get('remotes') == remotes and \
+            (not remotes or time.time() - cached.get('listed', 0) < self.remote_ttl)
+
+    def load(self):
+        """:returns: dict of os-version to template fields"""
+        confs, indexes, remotes = self._source_files()
+        sources = dict((path, _signature(path)) for path in confs + indexes)
+        if self._templates is not None and sources == self._sources:
+            return self._templates
+
+        cached = self._read_cache()
+        if self._remote_fresh(cached, remotes) and cached.get('sources') == sources:
+            self._templates = cached['templates']
+            self._sources = sources
+            return self._templates
+
+        templates = {}
+        listed = time.time()
+        listed_remote = {}
+        if remotes:
+            # only virt-builder can fetch and verify remote indexes
+            if self._remote_fresh(cached, remotes):
+                listed, listed_remote = cached['listed'], cached['remote_templates']
+            else:
+                listed_remote = self._list_remote()
+            templates.update(listed_remote)
+
+        for path in indexes:
+            if not sources.get(path):
+                continue
+            with open(path) as fh:
+                text = fh.read()
+            try:
+                sections = parse_index(text)
+            except IndexParseError:
+                # leave broken indexes to check_template_file to report
+                continue
+            for name, fields in sections:
+                entry = dict(fields)
+                entry['index'] = path
+                templates[name] = entry
+
+        self._write_cache({
+            'sources': sources,
+            'remotes': remotes,
+            'listed': listed,
+            'remote_templates': listed_remote,
+            'templates': templates,
+        })
+        self._templates = templates
+        self._sources = sources
+        return templates
+
+    def _list_remote(self):
+        self.listings += 1
+        cmd = ['virt-builder', '--list', '--list-format', 'json']
+        if self.session:
+            output = self.session.check_output(cmd)
+        else:
+            output = subprocess.check_output(cmd).decode('utf-8')
+        templates = {}
+        for item in json.loads(output).get('templates', []):
+            templates[item['os-version']] = {
+                'name': item.get('full-name', ''),
+                'arch': item.get('arch', ''),
+                'size': str(item.get('size', '')),
+            }
+            if item.get('revision') is not None:
+                templates[item['os-version']]['revision'] = str(item['revision'])
+        return templates
+
+    def invalidate(self):
+        self._templates = None
+        self._parsed = None
+        if self.cache_path and os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+    def __contains__(self, name):
+        return name in self.load()
+
+    def __getitem__(self, name):
+        return self.load()[name]
+
+    def get(self, name, default=None):
+        return self.load().get(name, default)
+
+    def names(self):
+        return sorted(self.load())
+
+
+class TemplateWriter(object):
+    """Adds, replaces and removes single templates in an index file.
+
+    Every change is validated in-process first, then written to a temp
+    file which is fsynced and renamed over the index, so readers see
+    the old file or the new one and never a partial record. Writers
+    serialize on a lock file next to the index.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self._text = None
+        self._offsets = None
+        self._signature = None
+
+    def _load(self):
+        signature = _signature(self.path)
+        if self._offsets is None or signature != self._signature:
+            text = ''
+            if signature:
+                with open(self.path, 'rb') as fh:
+                    text = fh.read().decode('utf-8')
+            self._text = text
+            self._offsets = section_offsets(text)
+            self._signature = signature
+        return self._text, self._offsets
+
+    def names(self):
+        return list(self._load()[1])
+
+    def __contains__(self, name):
+        return name in self._load()[1]
+
+    def read(self, name):
+        """:returns: the text of one template section, or None"""
+        text, offsets = self._load()
+        if name in offsets:
+            start, end = offsets[name]
+            return text[start:end]
+
+    def write(self, name, record, replace=False):
+        """Add the template `name`, or replace it if `replace` is set.
+        :param record: the full section text, starting with [name]
+        :raises: ValueError if the record is invalid, or already exists
+        """
+        sections = parse_index(record)
+        if [section for section, _ in sections] != [name]:
+            raise ValueError('record must be exactly one [{}] section'.format(name))
+        problems = validate_index(record, os.path.dirname(self.path))
+        if problems:
+            raise ValueError('invalid template {}: {}'.format(name, ', '.join(problems)))
+        if not record.endswith('\n\n'):
+            # virt-builder requires the blank line between sections
+            record = record.rstrip('\n') + '\n\n'
+
+        with file_lock(self.lock_path):
+            text, offsets = self._load()
+            if name in offsets:
+                if not replace:
+                    raise ValueError('template {} exists'.format(name))
+                start, end = offsets[name]
+                text = text[:start] + record + text[end:]
+            else:
+                if text and not text.endswith('\n\n'):
+                    text = text.rstrip('\n') + '\n\n'
+                text = text + record
+            self._commit(text)
+
+    def remove(self, name):
+        """Remove the template `name`.
+        :returns: True if it was there
+        """
+        with file_lock(self.lock_path):
+            text, offsets = self._load()
+            if name not in offsets:
+                return False
+            start, end = offsets[name]
+            self._commit(text[:start] + text[end:])
+        return True
+
+    def _commit(self, text):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp = os.path.join(directory, '.{}.{}.tmp'.format(
+            os.path.basename(self.path), os.getpid()
+        ))
+        try:
+            with open(tmp, 'wb') as fh:
+                fh.write(text.encode('utf-8'))
+                fh.flush()
+                os.fsync(fh.fileno())
+            if os.path.exists(self.path):
+                os.chmod(tmp, os.stat(self.path).st_mode & 0o7777)
+            os.rename(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        # make the rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        self._text = text
+        self._offsets = section_offsets(text)
+        self._signature = _signature(self.path)
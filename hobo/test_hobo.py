@@ -0,0 +1,1682 @@
+import os
+import time
+import pytest
+
+from commandsession import CommandSession, ParamDict
+import hobo
+import hobo.api
+from hobo.api import Hobo, config
+from hobo.libvirt import Libguestfs, Libvirt
+
+def test_db(tmpdir):
+    from hobo.util import Db
+    db = Db(str(tmpdir.join('hobo.db')))
+    assert db.read('domains') is None
+    assert db.read('domains', 'a') is None
+
+    db.write('domains', 'a', {'hostname': 'a.local', 'tags': ['web', 'db']})
+    db.write('domains', 'b', {'hostname': 'b.local', 'tags': ['web']})
+    assert db.read('domains', 'a')['hostname'] == 'a.local'
+    assert sorted(db.read('domains').keys()) == ['a', 'b']
+    assert db.keys('domains') == ['a', 'b']
+    assert db.tagged('domains', 'web') == ['a', 'b']
+    assert db.tagged('domains', 'db') == ['a']
+
+    db.write('domains', 'a', {'hostname': 'a.local', 'tags': []})
+    assert db.tagged('domains', 'db') == []
+
+    db.delete('domains', 'b')
+    db.delete('domains', 'missing')
+    assert db.keys('domains') == ['a']
+    assert db.tagged('domains', 'web') == []
+
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.delete('domains', 'a')
+            raise RuntimeError
+    assert db.keys('domains') == ['a']
+
+def test_db_pickle_migration(tmpdir):
+    from hobo.util import Db, PickleDb
+    path = str(tmpdir.join('hobo.db'))
+    old = PickleDb(path)
+    old.write('domains', 'a', {'hostname': 'a.local', 'tags': ['web']})
+
+    db = Db(path)
+    assert db.read('domains', 'a') == {'hostname': 'a.local', 'tags': ['web']}
+    assert db.tagged('domains', 'web') == ['a']
+    assert os.path.exists(path + '.pickle')
+
+    # a second open must not migrate again
+    db.close()
+    assert Db(path).keys('domains') == ['a']
+
+def test_db_pickle_migration_failure(tmpdir, monkeypatch):
+    from hobo.util import Db, PickleDb
+    path = str(tmpdir.join('hobo.db'))
+    PickleDb(path).write('domains', 'a', {'hostname': 'a.local', 'tags': []})
+
+    def broken(self, section, k, v):
+        raise IOError('disk full')
+    with monkeypatch.context() as m:
+        m.setattr(Db, 'write', broken)
+        with pytest.raises(IOError):
+            Db(path)
+
+    # nothing was lost; the next open migrates
+    assert PickleDb(path).read('domains', 'a')['hostname'] == 'a.local'
+    assert Db(path).keys('domains') == ['a']
+    assert os.path.exists(path + '.pickle')
+    assert not [f for f in os.listdir(str(tmpdir)) if 'migrate' in f]
+
+def _fake_virsh(tmpdir, monkeypatch, script):
+    """Put a fake `virsh` on PATH. Every invocation is logged to
+    <tmpdir>/virsh.log, one line per call.
+    """
+    bindir = tmpdir.mkdir('bin')
+    virsh = bindir.join('virsh')
+    virsh.write('#!/bin/sh\necho "$@" >> {}\n{}'.format(
+        tmpdir.join('virsh.log'), script
+    ))
+    virsh.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bindir, os.environ['PATH']))
+    return tmpdir.join('virsh.log')
+
+VIRSH_LIST = """\
+ Id    Name                           State
+----------------------------------------------------
+ 1     web1                           running
+ -     web2                           shut off
+"""
+
+FAKE_VIRSH = """\
+case "$1" in
+  list) cat <<'OUT'
+""" + VIRSH_LIST + """OUT
+  ;;
+  *) for dom in web1 web2; do
+       echo "@@hobo@@ $dom"
+       echo "Interface  Type       Source     Model       MAC"
+       echo "-------------------------------------------------------"
+       if [ $dom = web1 ]; then
+         echo "vnet0      bridge     hob0       virtio      52:54:00:00:00:01"
+       else
+         echo "-          bridge     hob0       virtio      52:54:00:00:00:02"
+       fi
+     done
+  ;;
+esac
+"""
+
+def test_libvirt_snapshot(tmpdir, monkeypatch):
+    log = _fake_virsh(tmpdir, monkeypatch, FAKE_VIRSH)
+    lv = Libvirt('hob0', images_dir=str(tmpdir), session=CommandSession())
+
+    doms = [lv.get_domain(name) for name in ('web1', 'web2')]
+    assert doms[0].running and doms[0].state == 'running'
+    assert doms[1].stopped
+    assert doms[0].mac_address == '52:54:00:00:00:01'
+    assert doms[1].mac_address == '52:54:00:00:00:02'
+    with pytest.raises(ValueError):
+        lv.get_domain('web')
+
+    # one `list --all` and one batched domiflist, however many lookups
+    assert len(log.readlines()) == 2
+
+    table = lv.snapshot()
+    with pytest.raises(AttributeError):
+        table.taken = 0
+    assert list(table) == ['web1', 'web2']
+
+    lv.refresh()
+    assert doms[0].running
+    assert len(log.readlines()) == 4
+
+ARP_TABLE = """\
+IP address       HW type     Flags       HW address            Mask     Device
+192.168.122.10   0x1         0x2         52:54:00:00:00:01     *        hob0
+192.168.122.11   0x1         0x0         00:00:00:00:00:00     *        hob0
+192.168.122.12   0x1         0x2         52:54:00:00:00:03     *        hob0
+"""
+
+def test_neighbour_table(tmpdir):
+    from hobo.net import NeighbourTable
+    arp = tmpdir.join('arp')
+    arp.write(ARP_TABLE)
+    table = NeighbourTable(str(arp))
+
+    ret = table.resolve(['52:54:00:00:00:01', '52:54:00:00:00:02', '52:54:00:00:00:03'])
+    assert ret == {
+        '52:54:00:00:00:01': '192.168.122.10',
+        '52:54:00:00:00:02': None,
+        '52:54:00:00:00:03': '192.168.122.12',
+    }
+    assert table.resolve(['52:54:00:00:00:0A'.lower()]) == {'52:54:00:00:00:0a': None}
+
+    # unchanged content is not re-parsed
+    index = table.read()
+    assert table.read() is index
+
+    arp.write(ARP_TABLE + "192.168.122.13   0x1         0x2         52:54:00:00:00:02     *        hob0\n")
+    assert table.resolve(['52:54:00:00:00:02'])['52:54:00:00:00:02'] == '192.168.122.13'
+
+DNSMASQ_LEASES = """\
+1700000000 52:54:00:00:00:01 192.168.122.10 web1 01:52:54:00:00:00:01
+1700000000 52:54:00:00:00:02 192.168.122.11 * *
+"""
+
+LIBVIRT_STATUS = """\
+[
+  {
+    "ip-address": "192.168.122.12",
+    "mac-address": "52:54:00:00:00:03",
+    "hostname": "web3",
+    "expiry-time": 1700000000
+  }
+]
+"""
+
+DHCPD_LEASES = """\
+lease 10.0.0.5 {
+  starts 4 2016/01/01 00:00:00;
+  hardware ethernet 52:54:00:00:00:04;
+}
+lease 10.0.0.6 {
+  hardware ethernet 52:54:00:00:00:04;
+}
+"""
+
+def test_lease_file_resolver(tmpdir):
+    from hobo.net import LeaseFileResolver
+    tmpdir.join('default.leases').write(DNSMASQ_LEASES)
+    tmpdir.join('virbr0.status').write(LIBVIRT_STATUS)
+    tmpdir.join('dhcpd.leases').write(DHCPD_LEASES)
+    resolver = LeaseFileResolver([str(tmpdir.join('*'))])
+
+    ret = resolver.resolve({
+        '52:54:00:00:00:01': 'web1',
+        '52:54:00:00:00:03': 'web3',
+        '52:54:00:00:00:04': 'web4',
+        '52:54:00:00:00:05': 'web5',
+    })
+    assert ret == {
+        '52:54:00:00:00:01': '192.168.122.10',
+        '52:54:00:00:00:03': '192.168.122.12',
+        '52:54:00:00:00:04': '10.0.0.6',
+    }
+
+FAKE_VIRSH_DOMIFADDR = """\
+for dom in web1 web2; do
+  echo "@@hobo@@ $dom"
+  echo " Name       MAC address          Protocol     Address"
+  echo "-------------------------------------------------------------------------------"
+  if [ $dom = web1 ]; then
+    echo " vnet0      52:54:00:00:00:01    ipv4         192.168.122.10/24"
+    echo " -          -                    ipv6         fe80::1/64"
+  fi
+done
+"""
+
+def test_domifaddr_resolver(tmpdir, monkeypatch):
+    from hobo.net import DomifaddrResolver
+    log = _fake_virsh(tmpdir, monkeypatch, FAKE_VIRSH_DOMIFADDR)
+    lv = Libvirt('hob0', images_dir=str(tmpdir), session=CommandSession())
+    resolver = DomifaddrResolver(lv, 'agent')
+
+    ret = resolver.resolve({'52:54:00:00:00:01': 'web1', '52:54:00:00:00:02': 'web2'})
+    assert ret == {'52:54:00:00:00:01': '192.168.122.10'}
+    calls = log.readlines()
+    assert len(calls) == 1
+    assert "domifaddr web2 --source agent" in calls[0]
+
+def test_virsh_batch_quoting():
+    from hobo.libvirt import _VIRSH_MARKER
+    class FakeVirsh(object):
+        def run_line(self, line):
+            self.line = line
+            return 0, "{} it's\nrunning".format(_VIRSH_MARKER)
+    lv = Libvirt.__new__(Libvirt)
+    lv.virsh = FakeVirsh()
+    assert lv.virsh_batch('domstate {}', ["it's"]) == {"it's": 'running'}
+    assert "domstate 'it'\\''s'" in lv.virsh.line
+
+def test_resolver_chain(monkeypatch):
+    from hobo.net import ResolverChain
+    class Fake(object):
+        def __init__(self, known):
+            self.known = known
+            self.asked = []
+        def resolve(self, wanted):
+            self.asked.append(sorted(wanted))
+            return dict((m, self.known[m]) for m in wanted if m in self.known)
+
+    cheap = Fake({'a': '10.0.0.1'})
+    costly = Fake({'b': '10.0.0.2'})
+    chain = ResolverChain([cheap, costly], ttl=30)
+
+    ret = chain.resolve({'a': 'web1', 'b': 'web2', 'c': 'web3'})
+    assert ret == {'a': '10.0.0.1', 'b': '10.0.0.2', 'c': None}
+    # only what the cheap resolver missed reaches the costly one
+    assert costly.asked == [['b', 'c']]
+
+    # cached answers are not asked for again until they expire
+    chain.resolve({'a': 'web1', 'b': 'web2'})
+    assert cheap.asked == [['a', 'b', 'c']]
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 31)
+    chain.resolve({'a': 'web1'})
+    assert cheap.asked[-1] == ['a']
+
+def test_probe_resolver_hints(monkeypatch):
+    import itertools
+    from hobo import net
+    assert list(itertools.islice(net.network_hosts('10.1.2.3', '255.255.0.0'), 3)) == \
+        ['10.1.0.1', '10.1.0.2', '10.1.0.3']
+
+    probed = []
+    monkeypatch.setattr(net, 'probe_hosts', lambda ips: probed.append(list(ips)))
+    monkeypatch.setattr(net, 'get_ip_address', lambda dev: '10.0.0.1')
+    monkeypatch.setattr(net, 'get_netmask', lambda dev: '255.0.0.0')
+    class Table(object):
+        def resolve(self, macs):
+            return {}
+    resolver = net.ProbeResolver('hob0', wait=0, table=Table())
+
+    # hints come with the call, not from shared state
+    resolver.resolve({'aa': 'web1'}, hints={'aa': '10.0.0.7'})
+    assert probed[0] == ['10.0.0.7']
+    # a /8 is swept no further than the cap
+    assert len(probed[1]) == net.MAX_PROBE_HOSTS
+
+def test_get_resolver():
+    from hobo.net import get_resolver, LeaseFileResolver, NeighbourResolver
+    chain = get_resolver(['lease', ' neighbour'], None)
+    assert [type(r) for r in chain.resolvers] == [LeaseFileResolver, NeighbourResolver]
+    with pytest.raises(ValueError):
+        get_resolver(['bogus'], None)
+
+def _neigh_message(msg_type, ifindex, state, ip, mac):
+    """Build an rtnetlink neighbour message, as the kernel sends them."""
+    import socket
+    import struct
+    lladdr = bytes(bytearray(int(b, 16) for b in mac.split(':')))
+    attrs = struct.pack('=HH', 8, 1) + socket.inet_aton(ip)
+    attrs += struct.pack('=HH', 10, 2) + lladdr + b'\0\0'
+    body = struct.pack('=BxxxiHBB', socket.AF_INET, ifindex, state, 0, 1) + attrs
+    return struct.pack('=IHHII', 16 + len(body), msg_type, 0, 0, 0) + body
+
+def test_get_ifindex(tmpdir):
+    import socket
+    from hobo.net import get_ifindex
+    tmpdir.mkdir('hob0').join('ifindex').write('7\n')
+    assert get_ifindex('hob0', str(tmpdir)) == 7
+    with pytest.raises(IOError):
+        get_ifindex('nope', str(tmpdir))
+    if os.path.exists('/sys/class/net/lo') and hasattr(socket, 'if_nametoindex'):
+        assert get_ifindex('lo') == socket.if_nametoindex('lo')
+
+def test_neighbour_watcher(tmpdir):
+    import socket
+    import threading
+    from hobo.net import NeighbourWatcher, NeighbourTable, RTM_NEWNEIGH, RTM_DELNEIGH
+    arp = tmpdir.join('arp')
+    arp.write(ARP_TABLE)
+    ours, kernel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    watcher = NeighbourWatcher(sock=ours, table=NeighbourTable(str(arp)))
+    watcher.ifindex = 7
+    watcher.start()
+    try:
+        # seeded from the current table
+        assert watcher.wait_for('52:54:00:00:00:01', 0) == '192.168.122.10'
+        assert watcher.wait_for('52:54:00:00:00:09', 0.05) is None
+
+        def boot():
+            time.sleep(0.1)
+            # other interface, and an incomplete entry: both ignored
+            kernel.send(_neigh_message(RTM_NEWNEIGH, 3, 0x02, '10.0.0.9', '52:54:00:00:00:09'))
+            kernel.send(_neigh_message(RTM_NEWNEIGH, 7, 0x01, '10.0.0.9', '52:54:00:00:00:09'))
+            kernel.send(
+                _neigh_message(RTM_NEWNEIGH, 7, 0x02, '192.168.122.20', '52:54:00:00:00:09') +
+                _neigh_message(RTM_NEWNEIGH, 7, 0x04, '192.168.122.21', '52:54:00:00:00:0a')
+            )
+        threading.Thread(target=boot).start()
+        assert watcher.wait_for('52:54:00:00:00:09', 5) == '192.168.122.20'
+        assert watcher.wait_for('52:54:00:00:00:0A', 5) == '192.168.122.21'
+
+        kernel.send(_neigh_message(RTM_DELNEIGH, 7, 0x20, '192.168.122.20', '52:54:00:00:00:09'))
+        time.sleep(0.1)
+        assert watcher.get('52:54:00:00:00:09') is None
+    finally:
+        watcher.stop()
+        kernel.close()
+
+def test_neighbour_watcher_seed_device(tmpdir):
+    import socket
+    from hobo.net import NeighbourWatcher, NeighbourTable
+    arp = tmpdir.join('arp')
+    arp.write(ARP_TABLE + '10.9.9.9         0x1         0x2         52:54:00:00:00:07     *        eth0\n')
+    ours, kernel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    watcher = NeighbourWatcher('hob0', sock=ours, table=NeighbourTable(str(arp)))
+    watcher.ifindex = 7
+    watcher.start()
+    try:
+        assert watcher.get('52:54:00:00:00:01') == '192.168.122.10'
+        # a stale entry on another interface is not the domain's ip
+        assert watcher.get('52:54:00:00:00:07') is None
+    finally:
+        watcher.stop()
+        kernel.close()
+
+def test_expand_names():
+    from hobo.util import expand_names
+    assert expand_names(['web{1..3}']) == ['web1', 'web2', 'web3']
+    assert expand_names(['a,b', 'c']) == ['a', 'b', 'c']
+    assert expand_names(['n{08..10}']) == ['n08', 'n09', 'n10']
+    assert expand_names(['r{1..2}c{1..2}']) == ['r1c1', 'r1c2', 'r2c1', 'r2c2']
+
+def _dying_build_worker(base_os, name, log_path, kwargs, slots):
+    # the shared semaphores reach the workers
+    with slots[0], slots[1]:
+        pass
+    if name == 'dies':
+        time.sleep(0.5)
+        os._exit(1)
+    return {'name': name, 'log': log_path, 'status': 'ok', 'seconds': 0,
+            'error': '', 'record': {'hostname': name, 'tags': []}}
+
+def test_cli_build_requires_name(capsys):
+    from hobo.cli import main
+    with pytest.raises(SystemExit):
+        main(['build', 'centos-7'])
+    assert '--name' in capsys.readouterr()[1]
+
+def test_build_many_worker_death(tmpdir, monkeypatch):
+    from hobo.util import Db
+    monkeypatch.setattr(hobo.api, '_build_worker', _dying_build_worker)
+    monkeypatch.setattr(config, 'log_dir', str(tmpdir))
+    monkeypatch.setattr(config, 'build_workers', 2)
+    hobo_ = Hobo.__new__(Hobo)
+    hobo_.db = Db(str(tmpdir.join('hobo.db')))
+    monkeypatch.setattr(hobo_, '_domains_changed', lambda: None)
+
+    # a worker dying breaks the pool, but what was built is kept
+    assert not hobo_._build_many('centos-7', ['built', 'dies'])
+    assert hobo_.db.keys('domains') == ['built']
+
+def test_layer_digest(tmpdir):
+    from hobo.api import _layer_digest
+    base = tmpdir.join('base.qcow2')
+    base.write('base')
+    pubkey = tmpdir.join('id_rsa.pub')
+    pubkey.write('ssh-rsa AAAA user@host')
+
+    params = ParamDict()
+    params.add('run_command', 'chmod 0700 /root/.ssh')
+    params.add('run_command', 'restorecon -FRvv /root/.ssh')
+    digest = _layer_digest(str(base), ['selinux-relabel'], params, str(pubkey))
+    assert digest == _layer_digest(str(base), ['selinux-relabel'], params, str(pubkey))
+
+    reordered = ParamDict()
+    reordered.add('run_command', 'restorecon -FRvv /root/.ssh')
+    reordered.add('run_command', 'chmod 0700 /root/.ssh')
+    assert digest != _layer_digest(str(base), ['selinux-relabel'], reordered, str(pubkey))
+
+    pubkey.write('ssh-rsa BBBB user@host')
+    assert digest != _layer_digest(str(base), ['selinux-relabel'], params, str(pubkey))
+
+def test_layer_eviction(tmpdir, monkeypatch):
+    from hobo.util import Db, allocated_size
+    h = Hobo.__new__(Hobo)
+    h.db = Db(str(tmpdir.join('hobo.db')))
+    now = time.time()
+    for i, digest in enumerate(['old', 'used', 'new', 'recent']):
+        path = tmpdir.join(digest)
+        path.write('x' * 8192)
+        atime = now if digest == 'recent' else now - 86400 + i
+        h.db.write('layers', digest, {'path': str(path), 'atime': atime})
+    h.db.write('domains', 'web1', {'backing': str(tmpdir.join('used')), 'tags': []})
+
+    size = allocated_size(str(tmpdir.join('old')))
+    monkeypatch.setattr(hobo.api.config, 'layer_cache_size', 2 * size)
+    h._evict_layers()
+
+    assert h.db.keys('layers') == ['recent', 'used']
+    assert not tmpdir.join('old').exists()
+    assert not tmpdir.join('new').exists()
+
+def test_stale_base_retired(tmpdir, monkeypatch):
+    from hobo.util import Db
+    lv = Libvirt('hob0', images_dir=str(tmpdir), session=CommandSession())
+    libgf = Libguestfs(libvirt=lv)
+    image = tmpdir.join('web.qcow2.xz')
+    image.write('v1')
+    index = str(tmpdir.join('hobo.templates'))
+    class Catalog(object):
+        def get(self, name, default=None):
+            return {'file': 'web.qcow2.xz', 'index': index, 'size': '1'}
+    libgf.catalog = Catalog()
+
+    old = libgf.base_path('web')
+    # repackaged under the same name
+    image.write('v2 is longer')
+    new = libgf.base_path('web')
+    assert old != new and old.startswith(str(tmpdir.join('_base', 'web-')))
+
+    h = Hobo.__new__(Hobo)
+    h.libgf = libgf
+    h.db = Db(str(tmpdir.join('hobo.db')))
+    tmpdir.mkdir('_base')
+    for path in (old, new, str(tmpdir.join('_base', 'web-minimal-0123456789ab.qcow2'))):
+        open(path, 'w').close()
+    for digest in ('stale', 'stale_used', 'fresh'):
+        tmpdir.join(digest).write('layer')
+        h.db.write('layers', digest, {
+            'base_os': 'web', 'path': str(tmpdir.join(digest)),
+            'base': new if digest == 'fresh' else old, 'atime': 0,
+        })
+    h.db.write('domains', 'web1', {'backing': str(tmpdir.join('stale_used')), 'tags': []})
+
+    h._retire_bases('web', new)
+    assert h.db.keys('layers') == ['fresh', 'stale_used']
+    assert not tmpdir.join('stale').exists()
+    # still under web1
+    assert os.path.exists(old)
+
+    h.db.delete('domains', 'web1')
+    h._retire_bases('web', new)
+    assert h.db.keys('layers') == ['fresh']
+    assert not os.path.exists(old) and os.path.exists(new)
+    assert libgf.base_paths('web-minimal') != []
+
+class FakeImageTools(object):
+    """Stands in for qemu-img and virt-*; an image file holds the path
+    of its backing file, or nothing.
+    """
+    def __init__(self, tmpdir):
+        self.tmpdir = tmpdir
+    def base_paths(self, base_os):
+        return [self.materialize_base(base_os)]
+    def materialize_base(self, base_os):
+        path = self.tmpdir.join('_base-{}.qcow2'.format(base_os))
+        if not path.exists():
+            path.write('')
+        return str(path)
+    def create_overlay(self, img_path, backing):
+        with open(img_path, 'w') as fh:
+            fh.write(backing)
+    def backing(self, img_path):
+        with open(img_path) as fh:
+            return fh.read() or None
+    def flatten(self, name):
+        open(str(self.tmpdir.join('{}.qcow2'.format(name))), 'w').close()
+    def convert(self, src_path, img_path):
+        open(img_path, 'w').close()
+    def virt_customize(self, *args, **kwargs):
+        pass
+    def virt_import(self, *args, **kwargs):
+        pass
+
+def test_linked_clone(tmpdir, monkeypatch):
+    from hobo.util import Db
+    class FakeDomain(object):
+        stopped = True
+    class FakeBackend(object):
+        def undefine(self, name):
+            pass
+    class FakeLibvirt(object):
+        backend = FakeBackend()
+        def disk_path(self, name):
+            return str(tmpdir.join('{}.qcow2'.format(name)))
+        def get_domain(self, name):
+            return FakeDomain()
+        def shutdown_many(self, names, timeout, on_stopped):
+            for name in names:
+                on_stopped(name)
+            return []
+
+    tmpdir.mkdir('.ssh').join('id_rsa.pub').write('ssh-rsa AAAA')
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.setattr(config, 'layer_cache_size', 0)
+    h = Hobo.__new__(Hobo)
+    h.libvirt = FakeLibvirt()
+    h.libgf = FakeImageTools(tmpdir)
+    h.db = Db(str(tmpdir.join('hobo.db')))
+    monkeypatch.setattr(h, '_domains_changed', lambda: None)
+
+    # the overlays of two clones share one base
+    for name in ('web1', 'web2'):
+        h.db.write('domains', name, h._build('centos-7', name, linked=True))
+    base = h.libgf.materialize_base('centos-7')
+    for name in ('web1', 'web2'):
+        assert h.libgf.backing(h.libvirt.disk_path(name)) == base
+        assert h.db.read('domains', name)['backing'] == base
+
+    assert h.flatten('web1')
+    assert h.libgf.backing(h.libvirt.disk_path('web1')) is None
+    assert h.db.read('domains', 'web1')['backing'] is None
+
+    # destroying a clone leaves the base for the others
+    assert h.destroy('web2', timeout=0)
+    assert not os.path.exists(h.libvirt.disk_path('web2'))
+    assert os.path.exists(base)
+
+def test_package_linked_clone(tmpdir, monkeypatch):
+    from hobo.util import Db, CopyResult
+    class FakeDomain(object):
+        stopped = True
+    class FakeLibvirt(object):
+        def disk_path(self, name):
+            return str(tmpdir.join('{}.qcow2'.format(name)))
+        def disk_exists(self, name):
+            return os.path.exists(self.disk_path(name))
+        def get_domain(self, name):
+            return FakeDomain()
+    class FakePackagingTools(FakeImageTools):
+        def template_available(self, name):
+            return False
+        def finalize(self, img_path, ops=None):
+            pass
+        def delete_cache(self, name):
+            pass
+        def get_template(self, *args, **kwargs):
+            return ''
+
+    h = Hobo.__new__(Hobo)
+    h.libvirt = FakeLibvirt()
+    h.libgf = FakePackagingTools(tmpdir)
+    h.db = Db(str(tmpdir.join('hobo.db')))
+    monkeypatch.setattr(h, '_check_template_file', lambda: None)
+    copies = []
+    def sparse_copy(src, dst):
+        copies.append(src)
+        open(dst, 'w').close()
+        return CopyResult('chunked', 0)
+    monkeypatch.setattr(hobo.api, 'sparse_copy', sparse_copy)
+
+    # a linked clone is packaged whole, without its backing file
+    base = h.libgf.materialize_base('centos-7')
+    h.libgf.create_overlay(h.libvirt.disk_path('web1'), base)
+    h.db.write('domains', 'web1', {'backing': base, 'tags': []})
+    assert h.package('web1', 'web-image', 'web', compress=False)
+    assert h.libgf.backing(h.libvirt.disk_path('web-image')) is None
+    assert copies == []
+
+    # a standalone disk is still copied sparsely
+    h.db.write('domains', 'web2', {'backing': None, 'tags': []})
+    assert h.package('web2', 'web2-image', 'web', compress=False)
+    assert copies == [h.libvirt.disk_path('web2')]
+
+def test_cli_linked_clone(monkeypatch):
+    from hobo.cli import main
+    calls = []
+    class FakeHobo(object):
+        def __init__(self, session=None):
+            pass
+        def __getattr__(self, command):
+            return lambda **kwargs: calls.append((command, kwargs)) or True
+    monkeypatch.setattr(hobo.api, 'Hobo', FakeHobo)
+
+    assert main(['build', 'centos-7', '--name', 'web1', '--linked']) == 0
+    assert calls[-1][0] == 'build' and calls[-1][1]['linked'] is True
+    assert main(['flatten', 'web1']) == 0
+    assert calls[-1] == ('flatten', {'domain': 'web1'})
+
+@pytest.mark.skipif(not any(
+    os.access(os.path.join(d, 'qemu-img'), os.X_OK)
+    for d in os.environ.get('PATH', '').split(os.pathsep)
+), reason='requires qemu-img')
+def test_overlay_backing_chain(tmpdir):
+    import json
+    import subprocess
+    lv = Libvirt('hob0', images_dir=str(tmpdir), session=CommandSession())
+    libgf = Libguestfs(libvirt=lv)
+    base = str(tmpdir.join('base.qcow2'))
+    subprocess.check_call(['qemu-img', 'create', '-f', 'qcow2', base, '16M'])
+
+    def backing(path):
+        info = json.loads(subprocess.check_output(
+            ['qemu-img', 'info', '--output', 'json', path]
+        ).decode('utf-8'))
+        return info.get('backing-filename')
+
+    libgf.create_overlay(lv.disk_path('web1'), base)
+    assert backing(lv.disk_path('web1')) == base
+    libgf.flatten('web1')
+    assert backing(lv.disk_path('web1')) is None
+
+def test_finalize_single_appliance(tmpdir, monkeypatch):
+    import hobo.libvirt
+    calls = []
+    class FakeGuestFS(object):
+        def __init__(self, **kwargs):
+            pass
+        def __getattr__(self, name):
+            def call(*args, **kwargs):
+                calls.append((name,) + args)
+                if name == 'inspect_os':
+                    return ['/dev/sda3']
+                if name == 'inspect_get_mountpoints':
+                    return {'/': '/dev/sda3', '/boot': '/dev/sda1'}
+                if name == 'glob_expand':
+                    return [args[0]] if not '*' in args[0] else []
+                if name == 'is_file':
+                    return True
+            return call
+    class FakeModule(object):
+        GuestFS = FakeGuestFS
+
+    monkeypatch.setattr(hobo.libvirt, 'guestfs', FakeModule)
+    sysprep = []
+    monkeypatch.setattr(
+        Libguestfs, '_virt_sysprep', lambda self, ops, path: sysprep.append(ops)
+    )
+    lv = Libvirt('hob0', images_dir=str(tmpdir), session=CommandSession())
+    libgf = Libguestfs(libvirt=lv)
+
+    stats = libgf.finalize(
+        str(tmpdir.join('img.qcow2')),
+        ['udev_persistent_net', 'machine-id', 'net-hostname'],
+        run=['echo hi']
+    )
+    names = [c[0] for c in calls]
+    assert names.count('launch') == 1
+    assert ('rm_rf', '/etc/udev/rules.d/70-persistent-net.rules') in calls
+    assert ('truncate', '/etc/machine-id') in calls
+    assert ('sh', 'echo hi') in calls
+    assert ('fstrim', '/boot') in calls and ('fstrim', '/') in calls
+    # only what guestfs cannot do goes to virt-sysprep
+    assert sysprep == [['net-hostname']]
+    assert stats.launches == 2
+    assert stats.engine == 'guestfs'
+
+def test_compress_xz_roundtrip(tmpdir):
+    import lzma
+    from hobo.compress import get_codec, parse_xz_flags
+    src = tmpdir.join('img')
+    data = os.urandom(100000) + b'\0' * 300000 + b'hobo' * 50000
+    src.write_binary(data)
+
+    codec = get_codec('xz', 1, block_size=64 * 1024, threads=4)
+    result = codec.compress(str(src), str(tmpdir.join('img.xz')))
+    assert result.in_bytes == len(data)
+    assert result.out_bytes == tmpdir.join('img.xz').size()
+    assert result.ratio > 1
+    # concatenated per-block streams decode as one file
+    assert lzma.decompress(tmpdir.join('img.xz').read_binary()) == data
+
+    assert parse_xz_flags('-1 -T0 --block-size=16777216') == (1, 16777216)
+    assert parse_xz_flags('--best') == (9, 16 * 1024 * 1024)
+    with pytest.raises(ValueError):
+        get_codec('bogus')
+
+def test_compress_sampling(tmpdir):
+    from hobo.util import data_extents
+    from hobo.compress import sample_blocks, choose, get_codec
+    path = str(tmpdir.join('img'))
+    mb = 1024 * 1024
+    with open(path, 'wb') as fh:
+        fh.write(b'hobo ' * (mb // 5))
+        fh.seek(64 * mb)
+        fh.write(os.urandom(mb))
+        fh.truncate(128 * mb)
+
+    extents = data_extents(path)
+    allocated = sum(length for _, length in extents)
+    if len(extents) == 1 and allocated == 128 * mb:
+        pytest.skip('filesystem does not report holes')
+    assert allocated < 16 * mb
+
+    blocks, total = sample_blocks(path, fraction=0.5, block_size=64 * 1024)
+    assert total == allocated
+    assert blocks and all(blocks)
+
+    # uncompressed, the holes alone are far over the target
+    decision = choose(path, 'size:{}'.format(allocated), fraction=0.5)
+    assert decision['codec'] == 'xz'
+    assert decision['estimate']['out_bytes'] <= allocated
+    assert len(decision['candidates']) > 1
+
+    decision = choose(path, 'time:0', fraction=0.5)
+    assert decision['codec'] == 'none'
+
+    # holes are read and compressed too, and are costed in
+    assert decision['size_bytes'] == 128 * mb
+    predicted = [c for c in decision['candidates'] if c['codec'] == 'xz' and c['level'] == 1][0]
+    actual = get_codec('xz', 1).compress(path, path + '.xz')
+    assert actual.out_bytes / 2 < predicted['out_bytes'] < actual.out_bytes * 2
+
+    with pytest.raises(ValueError):
+        choose(path, 'fast')
+
+def _sparse_image(path, mb=1024 * 1024):
+    with open(path, 'wb') as fh:
+        fh.write(os.urandom(mb))
+        fh.seek(32 * mb)
+        fh.write(b'\0' * mb)
+        fh.write(os.urandom(mb))
+        fh.truncate(64 * mb)
+
+@pytest.mark.parametrize('method', ['auto', 'chunked'])
+def test_sparse_copy(tmpdir, monkeypatch, method):
+    import fcntl
+    import hobo.util
+    from hobo.util import sparse_copy, allocated_size
+    src = str(tmpdir.join('src.qcow2'))
+    dst = str(tmpdir.join('dst.qcow2'))
+    _sparse_image(src)
+    os.chmod(src, 0o640)
+    if allocated_size(src) >= 64 * 1024 * 1024:
+        pytest.skip('filesystem does not support holes')
+
+    if method == 'chunked':
+        def no_reflink(*args):
+            raise IOError(95, 'Operation not supported')
+        monkeypatch.setattr(fcntl, 'ioctl', no_reflink)
+        monkeypatch.delattr(os, 'copy_file_range', raising=False)
+
+    ret = sparse_copy(src, dst)
+    if method == 'chunked':
+        assert ret.method == 'chunked'
+        # the explicit run of zeroes is skipped too
+        assert ret.bytes_moved == 2 * 1024 * 1024
+    assert ret.bytes_moved <= allocated_size(src)
+
+    with open(src, 'rb') as a, open(dst, 'rb') as b:
+        assert a.read() == b.read()
+    assert os.stat(dst).st_size == 64 * 1024 * 1024
+    assert allocated_size(dst) <= allocated_size(src)
+    assert os.stat(dst).st_mode == os.stat(src).st_mode
+
+HOBO_INDEX = """-----BEGIN PGP SIGNED MESSAGE-----
+Hash: SHA256
+
+[web-base]
+name=Web server base
+arch=x86_64
+file=web-base.qcow2.xz
+format=qcow2
+size=6442450944
+notes=Built by hobo
+ from centos-7
+
+-----BEGIN PGP SIGNATURE-----
+abc
+-----END PGP SIGNATURE-----
+"""
+
+def test_template_catalog(tmpdir, monkeypatch):
+    import hobo.templates
+    from hobo.templates import TemplateCatalog, parse_index, validate_index
+    index = tmpdir.join('hobo.templates')
+    index.write(HOBO_INDEX)
+    repos = tmpdir.mkdir('repos.d')
+    repos.join('hobo.conf').write('[hobo]\nuri=file:///{}\nproxy=off\n'.format(index))
+    cache = str(tmpdir.join('cache', 'templates.json'))
+
+    catalog = TemplateCatalog(cache_path=cache, repos_dirs=[str(repos)])
+    assert 'web-base' in catalog
+    assert catalog['web-base']['arch'] == 'x86_64'
+    assert catalog['web-base']['notes'] == 'Built by hobo\nfrom centos-7'
+    assert 'xxx' not in catalog
+    assert catalog.listings == 0
+
+    # repeated lookups only stat; repos.d is not listed or parsed again
+    import glob
+    globbed = []
+    real_glob = glob.glob
+    monkeypatch.setattr(hobo.templates.glob, 'glob', lambda p: globbed.append(p) or real_glob(p))
+    for i in range(10):
+        assert 'web-base' in catalog
+    assert globbed == []
+    monkeypatch.undo()
+
+    # a fresh catalog is served from the disk cache, without parsing
+    def fail(text):
+        raise AssertionError('parsed again')
+    monkeypatch.setattr(hobo.templates, 'parse_index', fail)
+    assert TemplateCatalog(cache_path=cache, repos_dirs=[str(repos)]).names() == ['web-base']
+    monkeypatch.undo()
+
+    index.write('[db-base]\narch=x86_64\nfile=db-base.qcow2\nsize=1\n')
+    assert 'db-base' in catalog
+    assert 'web-base' not in catalog
+
+    # a new config is noticed through its directory
+    other = tmpdir.join('other.templates')
+    other.write('[app-base]\narch=x86_64\nfile=app-base.qcow2\nsize=1\n')
+    repos.join('other.conf').write('[other]\nuri=file:///{}\n'.format(other))
+    assert 'app-base' in catalog and 'db-base' in catalog
+
+    assert validate_index(HOBO_INDEX, str(tmpdir)) == ['[web-base]: missing image web-base.qcow2.xz']
+    assert validate_index('[a]\nfile=a\n') == ['[a]: missing arch', '[a]: missing size']
+    assert validate_index('foo\n')[0].startswith('parse error')
+
+def test_template_writer(tmpdir):
+    import threading
+    from hobo.templates import TemplateWriter, parse_index
+    path = str(tmpdir.join('hobo.templates'))
+    record = '[{0}]\nname={1}\narch=x86_64\nfile={0}.qcow2\nsize=1024\n'
+    writer = TemplateWriter(path)
+
+    def add(name, desc='base', replace=False):
+        tmpdir.join('{}.qcow2'.format(name)).ensure()
+        writer.write(name, record.format(name, desc), replace=replace)
+
+    threads = [threading.Thread(target=add, args=('t{}'.format(i),)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(writer.names()) == ['t{}'.format(i) for i in range(8)]
+
+    # offsets hold past non-ASCII text
+    add('t3', u'chang\xe9d', replace=True)
+    assert writer.read('t4').startswith('[t4]\n')
+    add('t3', 'changed', replace=True)
+    with pytest.raises(ValueError):
+        add('t3')
+    # missing image, rejected before anything is written
+    before = tmpdir.join('hobo.templates').read()
+    with pytest.raises(ValueError):
+        writer.write('nope', record.format('nope', 'x'))
+    assert tmpdir.join('hobo.templates').read() == before
+
+    assert writer.remove('t5')
+    assert not writer.remove('t5')
+    sections = dict(parse_index(tmpdir.join('hobo.templates').read()))
+    assert sorted(sections) == ['t{}'.format(i) for i in (0, 1, 2, 3, 4, 6, 7)]
+    assert sections['t3']['name'] == 'changed'
+    assert not [p for p in os.listdir(str(tmpdir)) if p.endswith('.tmp')]
+
+def test_template_validation_cache(tmpdir, monkeypatch):
+    import hobo.templates
+    from hobo.templates import validate_cached
+    from hobo.api import Hobo
+    template_file = tmpdir.join('hobo.templates')
+    template_file.write('[a]\nfile=a.qcow2\narch=x86_64\nsize=1\n')
+    repos = tmpdir.mkdir('repos.d')
+    cache = str(tmpdir.join('validated.json'))
+
+    assert validate_cached(str(template_file), cache, [str(repos)]) == ['[a]: missing image a.qcow2']
+    calls = []
+    monkeypatch.setattr(hobo.templates, 'validate_index', lambda *a: calls.append(a) or [])
+    assert validate_cached(str(template_file), cache, [str(repos)]) == ['[a]: missing image a.qcow2']
+    assert not calls
+
+    repos.join('hobo.conf').write('[hobo]\nuri=file:///x\n')
+    assert validate_cached(str(template_file), cache, [str(repos)]) == []
+    assert len(calls) == 1
+    monkeypatch.undo()
+
+    # images are checked again once they appear, change or go away
+    image = tmpdir.join('a.qcow2')
+    image.write('v1')
+    assert validate_cached(str(template_file), cache, [str(repos)]) == []
+    image.write('v2 is longer')
+    calls = []
+    monkeypatch.setattr(hobo.templates, 'validate_index', lambda *a: calls.append(a) or [])
+    assert validate_cached(str(template_file), cache, [str(repos)]) == []
+    assert len(calls) == 1
+    monkeypatch.undo()
+    image.remove()
+    assert validate_cached(str(template_file), cache, [str(repos)]) == ['[a]: missing image a.qcow2']
+
+    # commands that never touch templates never validate them
+    import xdg.BaseDirectory
+    from hobo.util import Config
+    for attr in ('xdg_config_home', 'xdg_data_home', 'xdg_cache_home'):
+        monkeypatch.setattr(xdg.BaseDirectory, attr, str(tmpdir.join(attr)))
+    monkeypatch.setitem(hobo.api.config.__dict__, '_config', Config())
+    checked = []
+    monkeypatch.setattr(Hobo, '_check_template_file', lambda self: checked.append(1))
+    Hobo(check_templates=True)
+    assert not checked
+
+# modules never needed to show or query domains
+NEVER_IMPORTED = set(['yaml', 'hobo.compress', 'concurrent.futures'])
+# modules --help must not load
+NOT_FOR_HELP = set(['hobo.api', 'commandsession', 'hobo.libvirt'])
+
+_SHOW_MODULES = """\
+import sys, json
+from hobo.cli import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps(sorted(sys.modules)))
+"""
+
+def _imported_modules(args, env):
+    """Run the cli in a fresh interpreter.
+    :returns: set of the modules in sys.modules once it is done
+    """
+    import sys
+    import json
+    import subprocess
+    proc = subprocess.Popen(
+        [sys.executable, '-c', _SHOW_MODULES] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    _, err = proc.communicate()
+    return set(json.loads(err.decode('utf-8').splitlines()[-1]))
+
+@pytest.mark.parametrize('args', [('info', '--help'), ('info',)])
+def test_lazy_imports(tmpdir, monkeypatch, args):
+    _fake_virsh(tmpdir, monkeypatch, FAKE_VIRSH)
+    env = dict(os.environ)
+    for var in ('XDG_DATA_HOME', 'XDG_CONFIG_HOME', 'XDG_CACHE_HOME'):
+        env[var] = str(tmpdir.join(var.lower()))
+
+    modules = _imported_modules(args, env)
+    assert 'hobo.cli' in modules
+    assert not modules & NEVER_IMPORTED
+    if '--help' in args:
+        assert not modules & NOT_FOR_HELP
+        # nothing is created before a command runs
+        assert not tmpdir.join('xdg_data_home').check()
+
+# an interactive virsh, with a prompt and readline-style echo of its input
+FAKE_VIRSH_SHELL = """\
+import sys, time, shlex
+sys.stdout.write('Welcome to virsh\\n')
+states = {'web1': 'running', 'web2': 'shut off'}
+for line in iter(sys.stdin.readline, ''):
+    sys.stdout.write('virsh # ' + line)
+    for cmd in line.split(' ; '):
+        args = shlex.split(cmd)
+        if not args:
+            continue
+        if args[0] == 'quit':
+            sys.exit(0)
+        elif args[0] == 'echo':
+            print(' '.join(args[1:]))
+        elif args[0] == 'list':
+            print(' Id    Name    State')
+            print('------------------------')
+            for i, name in enumerate(sorted(states)):
+                print(' {}     {}    {}'.format(i if states[name] == 'running' else '-', name, states[name]))
+        elif args[0] == 'domstate':
+            print(states[args[1]])
+        elif args[0] == 'sleep':
+            sys.stdout.flush()
+            time.sleep(float(args[1]))
+            print('slept')
+        elif args[0] == 'domiflist':
+            print('Interface  Type       Source     Model       MAC')
+            print('-------------------------------------------------------')
+            print('vnet0      bridge     hob0       virtio      52:54:00:00:00:01')
+        elif args[0] == 'start' and states.get(args[1]) == 'shut off':
+            states[args[1]] = 'running'
+            print("Domain '{}' started".format(args[1]))
+            print('')
+        else:
+            sys.stderr.write('error: failed to run {}\\n'.format(args[0]))
+    sys.stdout.flush()
+"""
+
+def test_virsh_shell(tmpdir, monkeypatch):
+    import sys
+    from commandsession import CommandSession, CommandError
+    log = _fake_virsh(tmpdir, monkeypatch, 'exec {} -c "{}"\n'.format(
+        sys.executable, FAKE_VIRSH_SHELL.replace('\\', '\\\\').replace('"', '\\"')
+    ))
+    lv = Libvirt('hob0', images_dir=str(tmpdir), session=CommandSession(), virsh='shell')
+
+    assert lv.snapshot()['web2'].state == 'shut off'
+    assert lv.snapshot()['web1'].interfaces[0].mac == '52:54:00:00:00:01'
+    for i in range(50):
+        assert lv.virsh.check_output(['domstate', 'web1']) == 'running'
+
+    dom = lv.get_domain('web2')
+    dom.start()
+    assert dom.running
+    with pytest.raises(CommandError):
+        lv.virsh.check_call(['start', 'web1'])
+    assert lv.virsh.check_output(['echo', "it's quoted"]) == "it's quoted"
+
+    # a virsh that went away is started again
+    lv.virsh.proc.kill()
+    lv.virsh.proc.wait()
+    assert lv.virsh.check_output(['domstate', 'web2']) == 'shut off'
+
+    # one virsh process per connection, not per command
+    assert len(log.readlines()) == 2
+    assert lv.virsh.commands > 50
+
+    # a command that times out takes its virsh with it, so its late
+    # output is not read as the next command's
+    lv.virsh.timeout = 0.2
+    with pytest.raises(RuntimeError):
+        lv.virsh.check_output(['sleep', '0.5'])
+    lv.virsh.timeout = 5
+    assert lv.virsh.check_output(['domstate', 'web2']) == 'shut off'
+    lv.virsh.close()
+
+# virsh -c test:///default, for the one domain of libvirt's test driver;
+# state is kept in a file across invocations
+FAKE_VIRSH_TEST = """\
+import sys, json, shlex
+state_file = sys.argv[1]
+argv = sys.argv[2:]
+if argv[:1] == ['-c']:
+    argv = argv[2:]
+with open(state_file) as fh:
+    doms = json.load(fh)
+failed = False
+for cmd in (' '.join(argv).split(' ; ') if len(argv) == 1 else [' '.join(argv)]):
+    args = shlex.split(cmd)
+    name = args[1] if len(args) > 1 else None
+    if args[0] == 'echo':
+        print(' '.join(args[1:]))
+    elif args[0] == 'list':
+        print(' Id   Name   State')
+        print('----------------------')
+        for dom in sorted(doms):
+            print(' {}    {}   {}'.format(doms[dom]['id'], dom, doms[dom]['state']))
+    elif name not in doms:
+        sys.stderr.write("error: failed to get domain '{}'\\n".format(name))
+        failed = True
+    elif args[0] == 'domiflist':
+        print(' Interface   Type      Source    Model   MAC')
+        print('---------------------------------------------------------')
+        print(' testnet0    network   default   -       aa:bb:cc:dd:ee:ff')
+    elif args[0] == 'start' and doms[name]['state'] == 'shut off':
+        doms[name] = {'id': '2', 'state': 'running'}
+    elif args[0] in ('shutdown', 'destroy') and doms[name]['state'] == 'running':
+        doms[name] = {'id': '-', 'state': 'shut off'}
+    elif args[0] == 'undefine':
+        del doms[name]
+    else:
+        sys.stderr.write('error: Requested operation is not valid\\n')
+        failed = True
+with open(state_file, 'w') as fh:
+    json.dump(doms, fh)
+sys.exit(1 if failed else 0)
+"""
+
+@pytest.fixture(params=['virsh', 'python'])
+def test_driver(request, tmpdir, monkeypatch):
+    """A Libvirt on test:///default, through each backend."""
+    import sys
+    from commandsession import CommandSession
+    if request.param == 'python':
+        pytest.importorskip('libvirt')
+    else:
+        state = tmpdir.join('state.json')
+        state.write('{"test": {"id": "1", "state": "running"}}')
+        tmpdir.join('fake_virsh.py').write(FAKE_VIRSH_TEST)
+        _fake_virsh(tmpdir, monkeypatch, 'exec {} {} {} "$@"\n'.format(
+            sys.executable, tmpdir.join('fake_virsh.py'), state
+        ))
+    lv = Libvirt(
+        'default', images_dir=str(tmpdir), session=CommandSession(),
+        uri='test:///default', backend=request.param
+    )
+    yield lv
+    lv.backend.close()
+
+def test_libvirt_backend(test_driver):
+    import re
+    from hobo.libvirt import DomainError
+    lv = test_driver
+    assert lv.get_domains() == [['1', 'test', 'running']]
+    dom = lv.get_domain('test')
+    assert dom.running
+    assert dom.info.interfaces
+    assert all(re.match(r'^([0-9a-f]{2}:){5}[0-9a-f]{2}$', i.mac) for i in dom.info.interfaces)
+    with pytest.raises(DomainError):
+        lv.backend.start('test')
+    with pytest.raises(DomainError):
+        lv.backend.shutdown('nope')
+
+    dom.stop()
+    assert dom.stopped
+    assert dom.was('running')
+    assert lv.get_domains() == []
+    assert lv.get_domains(running=False) == [['-', 'test', 'shut', 'off']]
+
+    dom.start()
+    assert dom.running
+    dom.undefine()
+    assert 'test' not in lv.snapshot()
+    with pytest.raises(ValueError):
+        lv.get_domain('test')
+
+def test_python_backend_bulk_listing(monkeypatch):
+    import hobo.libvirt
+    from hobo.libvirt import PythonBackend
+
+    xml = ("<domain><devices><interface type='network'><mac address='aa:bb:cc:dd:ee:ff'/>"
+           "<source network='default'/><target dev='vnet0'/></interface></devices></domain>")
+
+    class FakeDom(object):
+        def __init__(self, name, id):
+            self._name, self._id, self.xml_calls = name, id, 0
+        def name(self):
+            return self._name
+        def ID(self):
+            return self._id
+        def XMLDesc(self, flags):
+            self.xml_calls += 1
+            return xml
+
+    doms = [FakeDom('web1', 3), FakeDom('web2', -1)]
+
+    class FakeConn(object):
+        stats_calls = 0
+        def getAllDomainStats(self, stats, flags):
+            self.stats_calls += 1
+            return [(doms[0], {'state.state': 1}), (doms[1], {'state.state': 5})]
+
+    class FakeApi(object):
+        VIR_DOMAIN_STATS_STATE = 1
+        @staticmethod
+        def open(uri):
+            return FakeConn()
+
+    monkeypatch.setattr(hobo.libvirt, 'libvirt_api', FakeApi)
+    backend = PythonBackend(None)
+    infos = backend.list_domains()
+    assert backend.conn.stats_calls == 1
+    assert [(i.id, i.name, i.state) for i in infos] == [('3', 'web1', 'running'), ('-', 'web2', 'shut off')]
+    assert [d.xml_calls for d in doms] == [0, 0]
+    assert infos[0].interfaces[0].mac == 'aa:bb:cc:dd:ee:ff'
+    assert len(infos[0].interfaces) == 1
+    assert [d.xml_calls for d in doms] == [1, 0]
+
+def test_state_tracker():
+    import threading
+    from hobo.libvirt import StateTracker
+
+    class FakeDom(object):
+        def __init__(self, name):
+            self._name = name
+        def name(self):
+            return self._name
+
+    tracker = StateTracker()
+    web1 = FakeDom('web1')
+    tracker.handle_lifecycle(None, web1, 0, 0, None)   # defined
+    assert tracker.state('web1') == 'shut off'
+    tracker.handle_lifecycle(None, web1, 2, 0, None)   # started
+    tracker.handle_lifecycle(None, web1, 0, 1, None)   # redefined while running
+    assert tracker.state('web1') == 'running'
+    assert tracker.agent_connected('web1') is None
+    tracker.handle_agent(None, web1, 1, 2, None)
+    assert tracker.agent_connected('web1')
+
+    timer = threading.Timer(0.05, tracker.handle_lifecycle, (None, web1, 5, 0, None))
+    timer.start()
+    assert tracker.wait_for('web1', 'shut off', timeout=5)
+    assert not tracker.wait_for('web1', 'running', timeout=0.01)
+    assert [s for _, s in tracker.timeline('web1')] == ['shut off', 'running', 'shut off']
+    assert tracker.was('web1', 'running')
+    assert 'web2' not in tracker
+
+def test_state_tracker_test_driver(tmpdir):
+    pytest.importorskip('libvirt')
+    from commandsession import CommandSession
+    lv = Libvirt(
+        'default', images_dir=str(tmpdir), session=CommandSession(),
+        uri='test:///default', backend='python', events=True
+    )
+    try:
+        dom = lv.get_domain('test')
+        assert dom.running
+        dom.stop()
+        assert lv.backend.tracker.wait_for('test', 'shut off', timeout=5)
+        assert dom.stopped
+        assert dom.was('running')
+        # changes hobo did not make show up too
+        lv.backend.conn.lookupByName('test').create()
+        assert lv.backend.tracker.wait_for('test', 'running', timeout=5)
+        assert [s for _, s in dom.states] == ['running', 'shut off', 'running']
+    finally:
+        lv.backend.close()
+
+def test_hobod(tmpdir):
+    import threading
+    from hobo.daemon import InfoCache, Server, query
+
+    class FakeBackend(object):
+        tracker = None
+
+    class FakeLibvirt(object):
+        backend = FakeBackend()
+
+    class FakeHobo(object):
+        libvirt = FakeLibvirt()
+        calls = 0
+        # cleared to hold up refreshes
+        gate = threading.Event()
+        def info_records(self):
+            FakeHobo.gate.wait()
+            FakeHobo.calls += 1
+            return {'web1': {'hostname': 'web1', 'state': 'running', 'ip': '10.0.0.2',
+                             'tags': ['web'], 'calls': FakeHobo.calls}}
+
+    path = str(tmpdir.join('hobod.sock'))
+    assert query(path, {'op': 'ping'}) is None
+
+    FakeHobo.gate.set()
+    cache = InfoCache(FakeHobo(), interval=60)
+    cache.start()
+    umask = os.umask(0o022)
+    try:
+        server = Server(path, cache)
+    finally:
+        os.umask(umask)
+    assert os.stat(path).st_mode & 0o077 == 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        assert query(path, {'op': 'ping'})['ok']
+        first = query(path, {'op': 'info', 'domain': None})
+        assert first['records']['web1']['ip'] == '10.0.0.2'
+        # answered from the cache, without gathering again
+        for i in range(20):
+            assert query(path, {'op': 'info', 'domain': 'web1'})['records'] == first['records']
+        assert FakeHobo.calls == 1
+
+        assert not query(path, {'op': 'info', 'domain': 'nope'})['ok']
+        assert query(path, {'op': 'invalidate'})['ok']
+        # the next query waits for the refresh the invalidation asked for
+        assert query(path, {'op': 'info'})['records']['web1']['calls'] == 2
+        assert FakeHobo.calls == 2
+
+        # a refresh that misses the query's timeout leaves the old records, stale
+        FakeHobo.gate.clear()
+        assert query(path, {'op': 'invalidate'})['ok']
+        start = time.time()
+        response = query(path, {'op': 'info', 'timeout': 0.2})
+        assert time.time() - start < 1
+        assert response['stale'] and response['records']['web1']['calls'] == 2
+    finally:
+        FakeHobo.gate.set()
+        cache.stop()
+        server.shutdown()
+        server.server_close()
+
+def test_cli_daemon_timeout(monkeypatch, capsys):
+    import json
+    import hobo.util
+    import hobo.daemon
+    from hobo.cli import main
+
+    class FakeConfig(object):
+        daemon_socket = '/nonexistent/hobod.sock'
+        info_timeout = 5.0
+    requests = []
+    def query(path, request, timeout=None):
+        requests.append(request)
+        return {'ok': True, 'age': 40.0, 'error': None, 'stale': True, 'records': {
+            'web1': {'hostname': 'web1', 'ip': '10.0.0.2', 'state': 'running', 'tags': []},
+        }}
+    monkeypatch.setattr(hobo.util, 'LazyConfig', FakeConfig)
+    monkeypatch.setattr(hobo.daemon, 'query', query)
+
+    assert main(['info', '--format', 'jsonl', '--timeout', '0.5']) == 0
+    assert requests[-1]['timeout'] == 0.5
+    line = json.loads(capsys.readouterr()[0])
+    assert line['name'] == 'web1' and line['timed_out'] is True
+
+    # without --timeout, hobod is given info_timeout
+    assert main(['info', '--format', 'jsonl']) == 0
+    assert requests[-1]['timeout'] == 5.0
+
+def test_cli_daemon_error(monkeypatch, capsys):
+    import json
+    import hobo.api
+    import hobo.daemon
+    import hobo.inventory
+    from hobo.cli import main
+
+    class FakeHobo(object):
+        def __init__(self, *args, **kwargs):
+            pass
+        def info_records(self):
+            return {'web1': {'hostname': 'web1', 'user': 'root', 'ip': '10.0.0.2',
+                             'state': 'running', 'tags': ['web']}}
+
+    class FakeCache(object):
+        def __init__(self, *args):
+            pass
+        def get(self):
+            return None
+        def put(self, text):
+            pass
+
+    monkeypatch.setattr(hobo.daemon, 'query', lambda *a, **kw: {'ok': False, 'error': 'boom'})
+    monkeypatch.setattr(hobo.api, 'Hobo', FakeHobo)
+    monkeypatch.setattr(hobo.inventory, 'InventoryCache', FakeCache)
+    assert main(['inventory', '--list']) == 0
+    out, err = capsys.readouterr()
+    assert 'boom' in err
+    assert json.loads(out)['web']['hosts'] == ['web1']
+
+def test_ansible_inventory(tmpdir):
+    import json
+    from hobo.inventory import ansible_inventory, InventoryCache
+    def record(hostname, state, tags):
+        return {'hostname': hostname, 'user': 'root', 'ip': '10.0.0.1',
+                'state': state, 'tags': tags}
+    records = {
+        'a': record('a.local', 'running', ['web', 'db']),
+        'b': record('b.local', 'running', ['web']),
+        'c': record('c.local', 'shut off', ['web']),
+    }
+    inventory = ansible_inventory(records)
+    assert sorted(inventory['all']['hosts']) == ['a.local', 'b.local']
+    assert sorted(inventory['web']['hosts']) == ['a.local', 'b.local']
+    assert inventory['db']['hosts'] == ['a.local']
+    assert inventory['_meta']['hostvars']['a.local']['ansible_ssh_host'] == '10.0.0.1'
+    assert 'c.local' not in inventory['_meta']['hostvars']
+
+    cache = InventoryCache(str(tmpdir.join('inventory.json')), ttl=30)
+    assert cache.get() is None
+    cache.put(json.dumps(inventory))
+    assert json.loads(cache.get())['db'] == {'hosts': ['a.local']}
+    cache.invalidate()
+    assert cache.get() is None
+
+    cache.put('{}')
+    os.utime(cache.path, (time.time() - 60,) * 2)
+    assert cache.get() is None
+
+def test_iter_info_records():
+    import json
+    from hobo.inventory import jsonl_line
+
+    class FakeDomain(object):
+        def __init__(self, name):
+            self.name = name
+            self.state = 'shut off' if name == 'off' else 'running'
+            self.running = self.state == 'running'
+            self.mac_address = '52:54:00:00:00:01'
+
+    class FakeLibvirt(object):
+        def refresh(self):
+            pass
+        def get_domain(self, name):
+            return FakeDomain(name)
+        def resolve_ips(self, domains):
+            # one stuck resolver must not hold up the rest
+            time.sleep(5 if domains[0].name == 'stuck' else 0.05)
+            return {domains[0].name: '10.0.0.2'}
+
+    class FakeDb(object):
+        def read(self, section):
+            names = ['dom{}'.format(i) for i in range(20)] + ['stuck', 'off']
+            return dict((name, {'hostname': name, 'tags': []}) for name in names)
+
+    hobo = Hobo.__new__(Hobo)
+    hobo.libvirt = FakeLibvirt()
+    hobo.db = FakeDb()
+
+    start = time.time()
+    seen = []
+    for name, record in hobo.iter_info_records(workers=8, timeout=0.5):
+        seen.append((name, time.time() - start, record))
+    elapsed = time.time() - start
+
+    assert seen[0][0] == 'off' and seen[0][1] < 0.1
+    assert seen[-1][0] == 'stuck' and seen[-1][2]['timed_out']
+    assert elapsed < 1.5
+    assert all(record['ip'] == '10.0.0.2' for name, _, record in seen[1:-1])
+    assert len(seen) == 22
+
+    line = json.loads(jsonl_line('dom0', seen[1][2]))
+    assert line['name'] == 'dom0' and line['timed_out'] is False
+
+def test_iter_info_records_deadline(monkeypatch, capsys):
+    """With one worker and two stuck domains, the second is never
+    started; it must still time out at the same deadline as the first.
+    """
+    class FakeDomain(object):
+        running = True
+        state = 'running'
+        mac_address = '52:54:00:00:00:01'
+        def __init__(self, name):
+            self.name = name
+
+    class FakeLibvirt(object):
+        def refresh(self):
+            pass
+        def get_domain(self, name):
+            return FakeDomain(name)
+        def resolve_ips(self, domains):
+            time.sleep(5)
+            return {domains[0].name: '10.0.0.2'}
+
+    class FakeDb(object):
+        def read(self, section):
+            return dict((name, {'hostname': name, 'tags': []}) for name in ['stuck1', 'stuck2'])
+
+    hobo = Hobo.__new__(Hobo)
+    hobo.libvirt = FakeLibvirt()
+    hobo.db = FakeDb()
+
+    start = time.time()
+    seen = dict(hobo.iter_info_records(workers=1, timeout=0.3))
+    assert time.time() - start < 1
+    assert sorted(seen) == ['stuck1', 'stuck2']
+    assert all(record['timed_out'] for record in seen.values())
+
+    # every format of info keeps to --timeout, not just jsonl
+    monkeypatch.setattr(config, 'info_workers', 1)
+    start = time.time()
+    assert hobo.info(timeout=0.3)
+    assert time.time() - start < 1
+    assert capsys.readouterr()[0].count("'timed_out': True") == 2
+
+def test_parallel_destroy(tmpdir, monkeypatch):
+    from hobo.util import Db
+    from hobo.libvirt import DomainInfo, DomainError
+
+    class FakeBackend(object):
+        """Guests power off a while after an ACPI shutdown, except
+        'stubborn', which ignores it.
+        """
+        tracker = None
+        def __init__(self):
+            self.defined = dict(('dom{}'.format(i), None) for i in range(10))
+            self.defined['stubborn'] = None
+            self.calls = []
+        def list_domains(self):
+            now = time.time()
+            return [
+                DomainInfo('1' if off is None or off > now else '-', name,
+                           'running' if off is None or off > now else 'shut off', [])
+                for name, off in self.defined.items()
+            ]
+        def run_many(self, command, names):
+            self.calls.append((command, sorted(names)))
+            for name in names:
+                if command == 'shutdown' and name != 'stubborn':
+                    self.defined[name] = time.time() + 0.2
+                elif command == 'destroy':
+                    self.defined[name] = time.time()
+        def undefine(self, name):
+            if name not in self.defined:
+                raise DomainError(name)
+            del self.defined[name]
+
+    backend = FakeBackend()
+    libvirt = Libvirt.__new__(Libvirt)
+    libvirt.backend = backend
+    libvirt.images_dir = str(tmpdir)
+    libvirt._snapshot = None
+
+    db = Db(str(tmpdir.join('hobo.db')))
+    for name in list(backend.defined) + ['gone']:
+        db.write('domains', name, {'hostname': name, 'tags': []})
+        tmpdir.join('{}.qcow2'.format(name)).write('disk')
+
+    hobo = Hobo.__new__(Hobo)
+    hobo.libvirt = libvirt
+    hobo.db = db
+    monkeypatch.setattr(hobo, '_domains_changed', lambda: None)
+
+    start = time.time()
+    assert hobo.destroy(timeout=1)
+    # one shared deadline, not one per domain
+    assert time.time() - start < 2
+
+    # all shut down at once, and only the straggler forced
+    assert backend.calls[0][0] == 'shutdown'
+    assert len(backend.calls[0][1]) == 11
+    assert backend.calls[1] == ('destroy', ['stubborn'])
+    assert backend.defined == {}
+    assert tmpdir.listdir(lambda p: p.ext == '.qcow2') == []
+    assert db.keys('domains') == []
+
+def test_wait_ready():
+    import socket
+    import threading
+    from hobo.ready import wait_ready
+
+    def sshd(delay=0):
+        """A listener that sends an ssh banner to whoever connects,
+        starting `delay` seconds from now.
+        """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        def serve():
+            time.sleep(delay)
+            sock.listen(5)
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except socket.error:
+                    return
+                conn.sendall(b'SSH-2.0-OpenSSH_test\r\n')
+                conn.close()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        return sock, port
+
+    up, port = sshd()
+    results = wait_ready({'up': '127.0.0.1'}, port=port, timeout=2)
+    assert results['up'] is not None and results['up'] < 0.5
+    up.close()
+
+    late, port = sshd(delay=0.5)
+    # no ip until the domain has been "booting" a while
+    start = time.time()
+    address = lambda: '127.0.0.1' if time.time() - start > 0.3 else None
+    results = wait_ready({'late': address, 'never': '127.0.0.2'}, port=port, timeout=2)
+    assert 0.4 < results['late'] < 1.5
+    assert results['never'] is None
+    assert time.time() - start < 3
+    late.close()
+
+    # a resolver that blocks past the deadline is given up on then
+    import asyncio
+    from hobo.ready import _wait_one
+    slow = lambda: time.sleep(1) or '127.0.0.1'
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.time()
+        assert loop.run_until_complete(
+            _wait_one(slow, start + 0.2, port, None, 0.1, 1)) is None
+        assert time.time() - start < 0.6
+    finally:
+        loop.close()
+
+    # and wait_ready returns at its deadline, not when the resolver does
+    start = time.time()
+    results = wait_ready({'stuck': lambda: time.sleep(2) or '127.0.0.1'}, port=port, timeout=0.3)
+    assert results == {'stuck': None}
+    assert time.time() - start < 1
+
+def test_bench_boot():
+    import json
+    from hobo.bench import bench_boot, percentile
+
+    class FakeBootDriver(object):
+        """Each phase takes a fixed, short time; no KVM needed."""
+        def __init__(self):
+            self.defined = set()
+            self.builds = 0
+        def exists(self, name):
+            return name in self.defined
+        def build(self, base_os, name, timeline):
+            self.builds += 1
+            time.sleep(0.02)
+            timeline.mark('imaged')
+            time.sleep(0.01)
+            self.defined.add(name)
+            timeline.mark('defined')
+        def remove(self, name):
+            self.defined.discard(name)
+        def stop(self, name):
+            pass
+        def start(self, name, timeline):
+            timeline.extend([(time.time(), 'running')])
+            return name
+        def wait_visible(self, domain):
+            time.sleep(0.03)
+            return '10.0.0.2'
+        def wait_ssh(self, domain, ip):
+            time.sleep(0.01)
+            return True
+
+    driver = FakeBootDriver()
+    results = bench_boot(driver, 'centos-7', runs=4)
+    assert driver.builds == 1
+    assert results['domain'] == 'hobo-bench-centos-7'
+    assert all(run['ok'] for run in results['runs'])
+    # only the first run builds
+    assert results['runs'][0]['virt_builder'] >= 0.02
+    assert results['runs'][1]['virt_builder'] is None
+    phases = results['phases']
+    assert phases['virt_install']['count'] == 1
+    assert phases['boot']['count'] == 4
+    assert 0.04 <= phases['boot']['p50'] <= phases['boot']['p99'] < 0.5
+    assert 0.03 <= phases['start_to_ip']['min']
+    json.dumps(results)
+
+    bench_boot(driver, 'centos-7', runs=2, rebuild=True)
+    assert driver.builds == 3
+
+    assert percentile([1, 2, 3, 4], 50) == 2.5
+    assert percentile([5], 99) == 5
+
+def test_boot_driver_invalidates(tmpdir):
+    from hobo.util import Db
+    from hobo.bench import BootDriver, BootTimeline
+
+    class FakeLibvirt(object):
+        def undefine_with_prejudice(self, name):
+            pass
+        def delete_disk(self, name):
+            pass
+
+    class FakeHobo(object):
+        def __init__(self):
+            self.db = Db(str(tmpdir.join('hobo.db')))
+            self.libvirt = FakeLibvirt()
+            self.changes = 0
+        def _build(self, base_os, name, timeline=None):
+            return {'hostname': name, 'tags': []}
+        def destroy(self, name, timeout):
+            self.db.delete('domains', name)
+            self._domains_changed()
+        def _domains_changed(self):
+            self.changes += 1
+
+    hobo_ = FakeHobo()
+    driver = BootDriver(hobo_, timeout=0)
+    driver.build('centos-7', 'bench1', BootTimeline())
+    assert hobo_.db.keys('domains') == ['bench1'] and hobo_.changes == 1
+    driver.remove('bench1')
+    assert hobo_.changes == 2
+    # a leftover domain hobo never recorded
+    driver.remove('stray')
+    assert hobo_.changes == 3
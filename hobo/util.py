@@ -5,9 +5,19 @@ import base64
 import hashlib
 import tempfile
 import os
+import re
 import errno
+import fcntl
 import pickle
+import shutil
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections import namedtuple
 from xdg import BaseDirectory as xdg
+from six.moves import queue
+
+from hobo.net import DEFAULT_RESOLVERS
 
 try:
     from configparser import ConfigParser, Error as ConfigParserError
@@ -15,9 +25,30 @@ except ImportError:
     from ConfigParser import Error as ConfigParserError, SafeConfigParser as ConfigParser #py2 compat
 
 
-class Db(object):
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+_DB_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS records (
+        section TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value BLOB NOT NULL,
+        PRIMARY KEY (section, key)
+    )""",
+    "CREATE INDEX IF NOT EXISTS records_key ON records (key)",
+    """CREATE TABLE IF NOT EXISTS tags (
+        section TEXT NOT NULL,
+        key TEXT NOT NULL,
+        tag TEXT NOT NULL,
+        PRIMARY KEY (section, key, tag)
+    )""",
+    "CREATE INDEX IF NOT EXISTS tags_tag ON tags (section, tag)",
+)
+
+
+class PickleDb(object):
     """This is stupid.
-    To be replaced with sqlite or something, when I have more then 5 minutes free
+    The original single-pickle-file store, kept around to migrate old
+    databases and to benchmark against `Db`.
     """
     def __init__(self, path):
         assert os.path.exists(os.path.dirname(path))
@@ -60,19 +91,181 @@ class Db(object):
             pickle.dump(db, pkl)
 
 
+class Db(object):
+    """Section/key store backed by sqlite.
+
+    Same interface as the old pickle store, but every call touches only
+    the rows it needs. Records carrying a ``tags`` list are indexed by tag,
+    see `tagged()`. Use `transaction()` to batch several writes into one
+    commit.
+
+    An existing pickle database at `path` is migrated on first open, and
+    kept alongside as ``<path>.pickle``.
+    """
+    def __init__(self, path):
+        assert os.path.exists(os.path.dirname(path))
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+
+        # only one process migrates; the others wait and open the result
+        with file_lock(self.path + '.lock'):
+            if os.path.exists(self.path) and os.path.getsize(self.path) \
+                    and not _is_sqlite(self.path):
+                self._migrate()
+
+            self._conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None,
+                check_same_thread=False
+            )
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self.transaction():
+            for stmt in _DB_SCHEMA:
+                self._conn.execute(stmt)
+
+    def _migrate(self):
+        """Import the pickle db at `path` into a new sqlite file, and
+        rename that over it once committed. The pickle is copied to
+        ``<path>.pickle`` first, so a failure at any point leaves either
+        the pickle or both in place.
+        """
+        with open(self.path, 'rb') as pkl:
+            legacy = pickle.load(pkl)
+
+        tmp = '{}.{}.migrate'.format(self.path, os.getpid())
+        for stale in (tmp, tmp + '-wal', tmp + '-shm'):
+            if os.path.exists(stale):
+                os.remove(stale)
+        try:
+            db = Db(tmp)
+            try:
+                with db.transaction():
+                    for section, records in legacy.items():
+                        for k, v in records.items():
+                            db.write(section, k, v)
+            finally:
+                db.close()
+            shutil.copy2(self.path, self.path + '.pickle')
+            os.rename(tmp, self.path)
+        finally:
+            for leftover in (tmp, tmp + '-wal', tmp + '-shm', tmp + '.lock'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    @contextmanager
+    def transaction(self):
+        """Group reads and writes into a single transaction.
+        Nested calls join the outermost transaction.
+        """
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield self
+                finally:
+                    self._depth -= 1
+                return
+
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._depth = 1
+            try:
+                yield self
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            else:
+                self._conn.execute('COMMIT')
+            finally:
+                self._depth = 0
+
+    def read(self, section, k=None):
+        with self._lock:
+            if k:
+                row = self._conn.execute(
+                    'SELECT value FROM records WHERE section=? AND key=?',
+                    (section, str(k))
+                ).fetchone()
+                if row is None: return
+                return pickle.loads(row[0])
+
+            rows = self._conn.execute(
+                'SELECT key, value FROM records WHERE section=?',
+                (section,)
+            ).fetchall()
+        if not rows: return
+        return dict((key, pickle.loads(value)) for key, value in rows)
+
+    def write(self, section, k, v):
+        k = str(k)
+        with self.transaction():
+            self._conn.execute(
+                'INSERT OR REPLACE INTO records (section, key, value) VALUES (?, ?, ?)',
+                (section, k, sqlite3.Binary(pickle.dumps(v, pickle.HIGHEST_PROTOCOL)))
+            )
+            self._conn.execute(
+                'DELETE FROM tags WHERE section=? AND key=?', (section, k)
+            )
+            tags = v.get('tags') if isinstance(v, dict) else None
+            if tags:
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO tags (section, key, tag) VALUES (?, ?, ?)',
+                    [(section, k, tag) for tag in tags]
+                )
+
+    def delete(self, section, k):
+        k = str(k)
+        with self.transaction():
+            self._conn.execute(
+                'DELETE FROM records WHERE section=? AND key=?', (section, k)
+            )
+            self._conn.execute(
+                'DELETE FROM tags WHERE section=? AND key=?', (section, k)
+            )
+
+    def keys(self, section):
+        """List the keys of a section without loading any records."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                'SELECT key FROM records WHERE section=? ORDER BY key',
+                (section,)
+            )]
+
+    def tagged(self, section, tag):
+        """List the keys of a section whose records carry `tag`."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                'SELECT key FROM tags WHERE section=? AND tag=? ORDER BY key',
+                (section, tag)
+            )]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _is_sqlite(path):
+    with open(path, 'rb') as fh:
+        return fh.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
 class Config(object):
     def __init__(self):
         config_dir = xdg.save_config_path('hobo')
         data_dir = xdg.save_data_path('hobo')
+        self.cache_dir = xdg.save_cache_path('hobo')
         self.images_dir = os.path.join(data_dir, 'images')
 
         if not os.path.isdir(self.images_dir):
             os.mkdir(self.images_dir)
 
+        self.log_dir = os.path.join(data_dir, 'logs')
+
         self.template_file = os.path.join(self.images_dir, 'hobo.templates')
         touch(self.template_file)
 
-        self.db = Db(os.path.join(data_dir, 'hobo.db'))
+        self.db_path = os.path.join(data_dir, 'hobo.db')
+        self._db = None
 
         config_file = os.path.join(config_dir, 'hobo.ini')
         self._cfg = ConfigParser()
@@ -82,6 +275,43 @@ class Config(object):
         self.base_mem = self.get('config', 'base_mem') or '1024'
         self.base_cpu = self.get('config', 'base_cpu') or '1'
 
+        # ordered ip resolvers, see hobo.net.RESOLVERS
+        resolvers = self.get('config', 'resolvers')
+        self.resolvers = resolvers.split(',') if resolvers else DEFAULT_RESOLVERS
+        self.resolver_ttl = float(self.get('config', 'resolver_ttl') or 30)
+
+        # how virsh is run, see hobo.virsh.VIRSH_BACKENDS
+        self.virsh_backend = self.get('config', 'virsh_backend') or 'exec'
+        # virsh, or python for the libvirt bindings; see hobo.libvirt.BACKENDS
+        self.libvirt_backend = self.get('config', 'libvirt_backend') or 'virsh'
+        self.libvirt_uri = self.get('config', 'libvirt_uri')
+        # track domain states from libvirt events, python backend only
+        self.libvirt_events = (self.get('config', 'libvirt_events') or 'yes') == 'yes'
+
+        # hobod, see hobo.daemon
+        self.daemon_socket = self.get('config', 'daemon_socket') or \
+            os.path.join(data_dir, 'hobod.sock')
+        self.daemon_interval = float(self.get('config', 'daemon_interval') or 10)
+
+        # seconds `destroy` gives guests to power off before forcing them
+        self.shutdown_timeout = float(self.get('config', 'shutdown_timeout') or 60)
+
+        # seconds `wait` gives domains to accept ssh
+        self.ready_timeout = float(self.get('config', 'ready_timeout') or 300)
+
+        # `info --format jsonl` resolves this many domains at once, and
+        # gives up on those left after this many seconds
+        self.info_workers = int(self.get('config', 'info_workers') or 16)
+        self.info_timeout = float(self.get('config', 'info_timeout') or 5)
+
+        # `hobo inventory --list` output is reused for this many seconds,
+        # or until a build or destroy
+        self.inventory_cache = os.path.join(self.cache_dir, 'inventory.json')
+        self.inventory_ttl = float(self.get('config', 'inventory_ttl') or 30)
+
+        # seconds a listing of remote virt-builder sources is reused
+        self.catalog_ttl = float(self.get('config', 'catalog_ttl') or 86400)
+
         # compression analysis:
         #  -1 256M
         #  -9 213M
@@ -91,6 +321,34 @@ class Config(object):
         #   --best --block-size=16777216
         # but it's sloooow
         self.compress_flags = self.get('config', 'compress_flags') or '-1 -T0 --block-size=16777216'
+        # see hobo.compress.CODECS; the xz preset and block size
+        # come from compress_flags
+        self.compress_codec = self.get('config', 'compress_codec') or 'xz'
+        # "time:<seconds>" or "size:<bytes>" picks codec and level per
+        # image by sampling it, overriding compress_codec/compress_flags
+        self.compress_target = self.get('config', 'compress_target')
+
+        # disk budget for cached customization layers; off unless set,
+        # see `Hobo._customization_layer`
+        self.layer_cache_size = parse_size(
+            self.get('config', 'layer_cache_size') or '0'
+        )
+
+        # concurrent multi-domain builds
+        import multiprocessing
+        cpus = multiprocessing.cpu_count()
+        self.build_workers = int(self.get('config', 'build_workers') or cpus)
+        self.appliance_slots = int(
+            self.get('config', 'appliance_slots') or max(1, cpus // 2)
+        )
+        self.io_slots = int(self.get('config', 'io_slots') or 2)
+
+    @property
+    def db(self):
+        """opened on first use"""
+        if self._db is None:
+            self._db = Db(self.db_path)
+        return self._db
 
     def get(self, section, attr):
         try:
@@ -101,6 +359,19 @@ class Config(object):
         return result
 
 
+class LazyConfig(object):
+    """Stands in for a `Config`, which is only read on first use.
+    Importing hobo should not create directories or open the db.
+    """
+    def __init__(self):
+        self.__dict__['_config'] = None
+
+    def __getattr__(self, name):
+        if self._config is None:
+            self.__dict__['_config'] = Config()
+        return getattr(self._config, name)
+
+
 def mkdir_all(path):
     """Emulate "mkdir -p"
     """
@@ -113,6 +384,240 @@ def mkdir_all(path):
             raise
 
 
+def expand_names(values):
+    """Expand comma-separated names and bash-style {1..20} ranges.
+        >>> expand_names(['web{1..3}', 'db1,db2'])
+        ['web1', 'web2', 'web3', 'db1', 'db2']
+    """
+    names = []
+    for value in values:
+        for item in value.split(','):
+            match = _NAME_RANGE.search(item)
+            if not match:
+                if item:
+                    names.append(item)
+                continue
+            first, last = match.group(1), match.group(2)
+            width = len(first) if first.startswith('0') else 0
+            step = 1 if int(last) >= int(first) else -1
+            for i in range(int(first), int(last) + step, step):
+                names.extend(expand_names([
+                    item[:match.start()] + str(i).zfill(width) + item[match.end():]
+                ]))
+    return names
+
+_NAME_RANGE = re.compile(r'{(\d+)\.\.(\d+)}')
+
+
+class NoLimit(object):
+    """Stand-in for a semaphore that never blocks."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def print_table(rows, columns):
+    """Print a list of dicts as a fixed-width table."""
+    widths = [
+        max([len(col)] + [len(_fmt_cell(row.get(col))) for row in rows])
+        for col in columns
+    ]
+    print('  '.join(col.ljust(w) for col, w in zip(columns, widths)))
+    print('  '.join('-' * w for w in widths))
+    for row in rows:
+        print('  '.join(
+            _fmt_cell(row.get(col)).ljust(w) for col, w in zip(columns, widths)
+        ))
+
+
+def _fmt_cell(value):
+    if isinstance(value, float):
+        return '{:.6f}'.format(value).rstrip('0').rstrip('.')
+    return '' if value is None else str(value)
+
+
+def parse_size(value):
+    """Parse a size like "512M" or "20G" into bytes."""
+    value = str(value).strip().upper()
+    units = 'KMGT'
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * 1024 ** (units.index(value[-1]) + 1))
+    return int(value)
+
+
+def human_size(nbytes):
+    """Format a byte count like "1.5G"."""
+    for unit in ('', 'K', 'M', 'G'):
+        if abs(nbytes) < 1024:
+            return '{:.1f}{}'.format(nbytes, unit) if unit else '{}B'.format(nbytes)
+        nbytes /= 1024.0
+    return '{:.1f}T'.format(nbytes)
+
+
+def data_extents(path):
+    """List the (offset, length) extents of a file that hold data.
+    Falls back to the whole file where SEEK_DATA is not supported.
+    """
+    size = os.stat(path).st_size
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)] if size else []
+
+    extents = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError:
+                # ENXIO: nothing but a hole past offset
+                break
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            extents.append((start, end - start))
+            offset = end
+    except OSError:
+        extents = [(0, size)]
+    finally:
+        os.close(fd)
+    return extents
+
+
+# ioctl to share a file's extents with another file, <linux/fs.h>
+FICLONE = 0x40049409
+
+CopyResult = namedtuple('CopyResult', ['method', 'bytes_moved'])
+
+
+def sparse_copy(src, dst, chunk_size=1024 * 1024):
+    """Copy a disk image without reading or writing its holes.
+
+    Tries, in order: a reflink (FICLONE), which moves no data at all;
+    copy_file_range over only the data extents; and a chunked copy that
+    skips all-zero chunks. Mode, times and, where permitted, ownership
+    are preserved, as with `cp --preserve=all`.
+    :returns: CopyResult(method, bytes_moved)
+    """
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        size = os.fstat(fin.fileno()).st_size
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            result = CopyResult('reflink', 0)
+        except (IOError, OSError):
+            fout.truncate(size)
+            extents = data_extents(src)
+            result = None
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    result = CopyResult(
+                        'copy_file_range', _copy_file_range(fin, fout, extents)
+                    )
+                except OSError as ex:
+                    if ex.errno not in (errno.EXDEV, errno.ENOSYS,
+                                        errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+            if result is None:
+                result = CopyResult(
+                    'chunked', _copy_chunks(fin, fout, extents, chunk_size)
+                )
+
+    shutil.copystat(src, dst)
+    st = os.stat(src)
+    try:
+        os.chown(dst, st.st_uid, st.st_gid)
+    except OSError:
+        pass
+    return result
+
+
+def _copy_file_range(fin, fout, extents):
+    moved = 0
+    for offset, length in extents:
+        done = 0
+        while done < length:
+            n = os.copy_file_range(
+                fin.fileno(), fout.fileno(), length - done,
+                offset + done, offset + done
+            )
+            if not n:
+                break
+            done += n
+        moved += done
+    return moved
+
+
+def _copy_chunks(fin, fout, extents, chunk_size):
+    moved = 0
+    for offset, length in extents:
+        fin.seek(offset)
+        end = offset + length
+        pos = offset
+        while pos < end:
+            data = fin.read(min(chunk_size, end - pos))
+            if not data:
+                break
+            # leave all-zero chunks as holes in the (pre-sized) output
+            if data.count(b'\0') != len(data):
+                fout.seek(pos)
+                fout.write(data)
+                moved += len(data)
+            pos += len(data)
+    return moved
+
+
+def allocated_size(path):
+    """Bytes actually allocated on disk for `path`, holes excluded."""
+    return os.stat(path).st_blocks * 512
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive flock on `path` for the duration of the block."""
+    with open(path, 'a') as fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+
+class FileReaper(object):
+    """Remove files on a background thread, e.g. the disks of destroyed
+    domains while the next ones are still being torn down.
+    """
+    def __init__(self):
+        self.removed = []
+        self.failed = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='hobo-reaper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                return
+            try:
+                os.remove(path)
+                self.removed.append(path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    self.failed.append((path, ex))
+
+    def put(self, path):
+        self._queue.put(path)
+
+    def join(self):
+        """Wait until every queued file is removed.
+        :returns: list of (path, error) that could not be removed
+        """
+        self._queue.put(None)
+        self._thread.join()
+        return self.failed
+
+
 def tempname():
     """Generate a filesystem-friendly random name"""
     return '_hobo_{}'.format(
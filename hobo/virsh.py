@@ -0,0 +1,217 @@
+"""Ways of running virsh commands.
+
+`VirshExec` starts a virsh process per command, as hobo always has.
+`VirshShell` keeps one interactive virsh, and its libvirt connection,
+open for the life of a `Libvirt`, so a command costs a round-trip
+instead of a fork, a connect and an authentication.
+"""
+import os
+import re
+import time
+import select
+import threading
+import subprocess
+
+from commandsession import CommandError
+
+__all__ = ['VirshExec', 'VirshShell', 'VIRSH_BACKENDS', 'get_virsh', 'quote']
+
+# ends the output of each command sent to an interactive virsh
+_FRAME_MARKER = '@@hobo-end@@'
+
+# "virsh # " as root, "virsh > " otherwise, with the uri when not default
+_PROMPT = re.compile(r'^virsh(?: \([^)]*\))? ?[#>] ?')
+
+
+def quote(arg):
+    """Quote an argument for virsh's own command line parser,
+    which follows sh rules for quotes.
+    """
+    arg = str(arg)
+    if arg and re.match(r'^[\w@%+=:,./-]+$', arg):
+        return arg
+    return "'" + arg.replace("'", "'\\''") + "'"
+
+
+class VirshExec(object):
+    """One virsh process per command."""
+    name = 'exec'
+
+    def __init__(self, session, uri=None):
+        self.session = session
+        self.uri = uri
+
+    def _cmd(self, args):
+        return ['virsh'] + (['-c', self.uri] if self.uri else []) + list(args)
+
+    def run(self, args):
+        """:returns: (returncode, output)"""
+        return self.session._exec(self._cmd(args))
+
+    def run_line(self, line):
+        """Run a raw virsh command line, e.g. several commands joined
+        with ' ; '.
+        :returns: (returncode, output)
+        """
+        return self.session._exec(self._cmd([line]))
+
+    def check_output(self, args):
+        return self.session.check_output(self._cmd(args))
+
+    def check_call(self, args):
+        return self.session.check_call(self._cmd(args))
+
+    def call(self, args):
+        return self.session.call(self._cmd(args))
+
+    def close(self):
+        pass
+
+
+class VirshShell(VirshExec):
+    """A long-lived interactive virsh, fed commands on stdin.
+
+    Every command is followed by `echo <marker> <seq>`; whatever virsh
+    prints before the marker comes back (stdout and stderr together) as
+    that command's output. Interactive virsh has no exit status per
+    command, so a command failed if virsh printed an "error:" line.
+    Calls from several threads are serialized. A virsh that died, or was
+    killed after not answering within `timeout`, is restarted on the
+    next call.
+    """
+    name = 'shell'
+
+    def __init__(self, session, uri=None, timeout=60):
+        super(VirshShell, self).__init__(session, uri)
+        self.timeout = timeout
+        self.proc = None
+        self.commands = 0
+        self._seq = 0
+        self._buf = b''
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self.proc = subprocess.Popen(
+            self._cmd(['--quiet']),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        self._buf = b''
+        # skip past any banner
+        self._roundtrip(None)
+
+    def _readline(self, deadline):
+        while b'\n' not in self._buf:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeError('virsh did not answer within {}s'.format(self.timeout))
+            ready, _, _ = select.select([self.proc.stdout], [], [], remaining)
+            if not ready:
+                continue
+            data = os.read(self.proc.stdout.fileno(), 65536)
+            if not data:
+                raise EOFError('virsh exited')
+            self._buf += data
+        line, self._buf = self._buf.split(b'\n', 1)
+        return line.decode('utf-8')
+
+    def _roundtrip(self, line):
+        self._seq += 1
+        marker = '{} {}'.format(_FRAME_MARKER, self._seq)
+        sent = ([line] if line is not None else []) + ['echo {}'.format(marker)]
+        self.proc.stdin.write(('\n'.join(sent) + '\n').encode('utf-8'))
+        self.proc.stdin.flush()
+
+        output = []
+        deadline = time.time() + self.timeout
+        while True:
+            out = _PROMPT.sub('', self._readline(deadline)).strip()
+            if out == marker:
+                break
+            # readline may echo what it was sent
+            if out in sent:
+                continue
+            output.append(out)
+        while output and not output[-1]:
+            output.pop()
+        return output
+
+    def run_line(self, line):
+        with self._lock:
+            for attempt in (0, 1):
+                try:
+                    if self.proc is None or self.proc.poll() is not None:
+                        self._start()
+                    output = self._roundtrip(line)
+                    break
+                except (EOFError, IOError, OSError):
+                    self.close()
+                    if attempt:
+                        raise
+                except RuntimeError:
+                    # timed out; its late output would be taken for the
+                    # next command's, so this virsh cannot be reused
+                    self.kill()
+                    raise
+            self.commands += 1
+
+        ret = 1 if any(out.startswith('error:') for out in output) else 0
+        self.session.log.append(['virsh> {}'.format(line), ret, output])
+        return ret, '\n'.join(output)
+
+    def run(self, args):
+        return self.run_line(' '.join(quote(arg) for arg in args))
+
+    def check_output(self, args):
+        ret, output = self.run(args)
+        if ret:
+            raise CommandError(self.session)
+        return output
+
+    def check_call(self, args):
+        ret, _ = self.run(args)
+        if ret:
+            raise CommandError(self.session)
+        return ret
+
+    def call(self, args):
+        return self.run(args)[0]
+
+    def close(self):
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        try:
+            if proc.poll() is None:
+                proc.stdin.write(b'quit\n')
+                proc.stdin.close()
+                proc.wait()
+        except (IOError, OSError):
+            proc.kill()
+            proc.wait()
+
+    def kill(self):
+        proc, self.proc = self.proc, None
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+VIRSH_BACKENDS = {
+    'exec': VirshExec,
+    'shell': VirshShell,
+}
+
+
+def get_virsh(name, session, uri=None):
+    try:
+        backend = VIRSH_BACKENDS[name]
+    except KeyError:
+        raise ValueError('unknown virsh backend {}'.format(name))
+    return backend(session, uri=uri)
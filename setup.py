@@ -44,9 +44,17 @@ setup(
         'Natural Language :: English',
     ],
     entry_points={
-        'console_scripts': ['hobo = hobo.cli:main'],
+        'console_scripts': [
+            'hobo = hobo.cli:main',
+            'hobod = hobo.daemon:main',
+            'hobo-inventory = hobo.cli:inventory_main',
+        ],
     },
-    install_requires=['pyyaml', 'pyxdg', 'boltons', 'six', 'commandsession'],
+    install_requires=[
+        'pyyaml', 'pyxdg', 'boltons', 'six', 'commandsession',
+        'futures; python_version < "3"',
+        'backports.lzma; python_version < "3"',
+    ],
     #data_files=[
     #    (XDG_HOBO_HOME, ['build/hobo.ini'])
     #]